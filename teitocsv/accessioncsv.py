@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+import argparse
+import itertools
+import operator
+import time
+from functools import partial
+
+from accessions import (ACCESSION_COLUMNS, ACCESSION_SCHEMA, CONTEXT_WINDOW,
+                        hit_row)
+from bacteriacsv import all_teis, init_worker, paper_files, tei_inputs
+from failures import isolated, report_errors, write_errors
+from parse_cache import ParseCache, open_cache
+from pipeline import (OUTPUT_FORMATS, columns_to_rows, create_pool,
+                      imap_batches, output_format, report_busy_times,
+                      rows_to_columns, task_size, write_column_batches,
+                      write_csv)
+from prefetch import Prefetcher
+from progress import DEFAULT_INTERVAL, open_progress
+from stage_timings import StageTimings, document
+from teireader import BacteriaPaper
+
+
+def set_up_argparser():
+    parser = argparse.ArgumentParser(
+        description="Accession numbers of TEI files and their pdftotext, "
+                    "one row per paper and accession number")
+    parser.add_argument('inputdir', help="input directory containing TEI XML files")
+    parser.add_argument('pdftotexts',
+        help="directory containing pdftotext files")
+    parser.add_argument('outfile', help="output file with the accession numbers")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS,
+                        help="output format, by default from the outfile extension or csv")
+    parser.add_argument('--context', type=int, default=CONTEXT_WINDOW,
+                        help="characters of text to keep before and after "
+                             "each accession number")
+    parser.add_argument('--cache',
+                        help="SQLite file to cache parsed TEI and pdftotext fields across runs")
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help="maximal size of the cache in MB")
+    parser.add_argument('--workers', type=int,
+                        help="number of worker processes, by default the number of CPUs")
+    parser.add_argument('--chunksize', type=int, default=16,
+                        help="number of TEI files sent to a worker at once")
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help="read up to so many input files at once ahead of "
+                             "the workers, e.g. on slow network storage")
+    parser.add_argument('--ordered', action='store_true',
+                        help="write rows in the order of the TEI file names")
+    parser.add_argument('--progress-interval', type=float,
+                        default=DEFAULT_INTERVAL,
+                        help="seconds between progress reports")
+    parser.add_argument('--progress-log',
+                        help="append progress reports to this file instead of "
+                             "stderr")
+    parser.add_argument('--quiet', action='store_true',
+                        help="do not report progress")
+    parser.add_argument('--timings', action='store_true',
+                        help="report the time per stage and the slowest files")
+    return parser
+
+
+def tei_to_accession_rows(param, cache_file=None, cache_size=None,
+                          window=CONTEXT_WINDOW):
+    tei_file, pdftotexts_directory = param
+    with document(tei_file):
+        cache = open_cache(cache_file, cache_size)
+        tei = BacteriaPaper(tei_file, pdftotexts_directory, cache=cache)
+        rows = [hit_row(tei.basename(), hit)
+                for hit in tei.accession_hits(window)]
+        tei.update_cache()
+        return rows
+
+
+def tei_batch_to_accession_columns(params, cache_file=None, cache_size=None,
+                                   window=CONTEXT_WINDOW):
+    to_rows = partial(tei_to_accession_rows, cache_file=cache_file,
+                      cache_size=cache_size, window=window)
+    rows = isolated(to_rows, params, operator.itemgetter(0))
+    return rows_to_columns(ACCESSION_COLUMNS,
+                           itertools.chain.from_iterable(rows))
+
+
+def main():
+    args = set_up_argparser().parse_args()
+
+    file_format = output_format(args.outfile, args.format)
+    teis = all_teis(args.inputdir)
+    mapped_teis = [(str(tei), args.pdftotexts) for tei in teis]
+    sizes = [task_size(tei_inputs(tei, args.pdftotexts)) for tei in teis]
+    prefetcher = None
+    if args.prefetch:
+        prefetcher = Prefetcher(paper_files, args.prefetch)
+    stage_timings = StageTimings() if args.timings else None
+    progress = open_progress(len(teis), args.progress_interval,
+                             args.progress_log, args.quiet)
+    busy_times = {}
+    errors = []
+    start = time.perf_counter()
+
+    cache_size = args.cache_size * 1024 ** 2
+    batch_task = partial(tei_batch_to_accession_columns, cache_file=args.cache,
+                         cache_size=cache_size, window=args.context)
+    with create_pool(args.workers, None, init_worker,
+                     (args.cache, cache_size, args.timings)) as pool, progress:
+        batches = imap_batches(pool, batch_task, mapped_teis, sizes,
+                               args.chunksize, args.ordered, busy_times,
+                               prefetcher, stage_timings, progress, errors)
+        if file_format == 'csv':
+            rows = itertools.chain.from_iterable(
+                columns_to_rows(batch) for batch in batches)
+            write_csv(args.outfile, ACCESSION_COLUMNS, rows)
+        else:
+            write_column_batches(args.outfile, file_format, ACCESSION_SCHEMA,
+                                 batches)
+        pool.close()
+        pool.join()
+        progress.finish()
+    report_busy_times(busy_times, time.perf_counter() - start)
+    if stage_timings is not None:
+        stage_timings.report()
+    write_errors(args.outfile, errors)
+    report_errors(args.outfile, errors)
+    print(f"Done with {file_format}")
+
+    if args.cache:
+        # Evict entries beyond the cache size.
+        ParseCache(args.cache, cache_size).close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+from dataclasses import dataclass
+
+from bacteria_regex import BacteriaMatcher
+
+
+# Characters of text before and after an accession number in its context.
+CONTEXT_WINDOW = 80
+
+# One row per accession number of a paper, in the long format.
+ACCESSION_SCHEMA = [('ID', 'string'), ('accession', 'string'),
+                    ('type', 'string'), ('source', 'string'),
+                    ('offset', 'int64'), ('occurrences', 'int64'),
+                    ('context', 'string')]
+ACCESSION_COLUMNS = [name for name, _ in ACCESSION_SCHEMA]
+
+
+@dataclass
+class AccessionHit:
+    accession: str
+    # Prefix of the archive, e.g. PRJ for BioProject, SAM for BioSample or
+    # SRR for a run in the SRA.
+    type: str
+    # Text the accession number is found in: tei or pdftotext.
+    source: str
+    # Character offset of the accession number in that text.
+    offset: int
+    context: str
+    occurrences: int = 1
+
+
+def accession_type(accession):
+    return accession[:3].upper()
+
+
+def find_accessions(text, source, window=CONTEXT_WINDOW):
+    # All accession numbers in the text in order, with the text around
+    # them.
+    hits = []
+    for start, end in BacteriaMatcher.accession_no_matcher.spans(text):
+        accession = text[start:end]
+        context = text[max(start - window, 0):end + window]
+        hits.append(AccessionHit(accession, accession_type(accession),
+                                 source, start, context))
+    return hits
+
+
+def unique_hits(hits):
+    # First hit of each accession number in the order of the hits, which
+    # counts the occurrences of all of them. Accession numbers differing
+    # only in case are the same.
+    unique = {}
+    for hit in hits:
+        key = hit.accession.upper()
+        if key in unique:
+            unique[key].occurrences += hit.occurrences
+        else:
+            unique[key] = AccessionHit(hit.accession, hit.type, hit.source,
+                                       hit.offset, hit.context,
+                                       hit.occurrences)
+    return list(unique.values())
+
+
+def hit_row(paper_id, hit):
+    return (paper_id, hit.accession, hit.type, hit.source, hit.offset,
+            hit.occurrences, hit.context)
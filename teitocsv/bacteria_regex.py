@@ -1,30 +1,365 @@
 
 import re
+from dataclasses import dataclass
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    # Python < 3.11
+    import sre_parse
+
+
+# Characters that re.I matches to an ASCII letter, but str.lower() does not
+# map to one.
+CASE_FOLDING_EXCEPTIONS = ['\u0131', '\u017f']
+
+
+def lowercase_text(text):
+    # Lowercased copy of the text with the same offsets, or None if lowering
+    # does not keep the offsets or drops case-insensitive matches.
+    if not isinstance(text, str):
+        # Bytes or a memory map. Only ASCII letters are lowered.
+        return bytes(text).lower()
+    lowered = text.lower()
+    if len(lowered) != len(text):
+        return None
+    if any(char in text for char in CASE_FOLDING_EXCEPTIONS):
+        return None
+    return lowered
+
+
+# Non-ASCII characters that re.I matches to an ASCII letter.
+ASCII_LOOKALIKES = '\u0130\u0131\u017f\u212a'
+NON_ASCII_RUN = re.compile(rb'[\x80-\xff]+')
+# ASCII characters that \s matches in str but not in bytes.
+ASCII_STR_SPACES = re.compile(rb'[\x1c-\x1f]')
+
+
+def _ascii_char(code):
+    # Whitespace literals would tell line breaks and spaces apart, which
+    # pdftotext text does not.
+    return code < 128 and not chr(code).isspace()
+
+
+def _caseless_char(code):
+    char = chr(code)
+    return char.lower() == char and char.upper() == char
+
+
+class BytesPattern(object):
+    def __init__(self, pattern, flags=re.I):
+        # The same pattern as a bytes regex for UTF-8 text. It finds the same
+        # matches as the str regex in the decoded text if equivalent holds
+        # for the text. regex is None if the pattern has parts that cannot
+        # be matched the same on bytes, e.g. . or \b.
+        self.uses_digits = False
+        self.uses_spaces = False
+        if self._supported(sre_parse.parse(pattern, flags)):
+            self.regex = re.compile(pattern.encode('utf-8'), flags)
+        else:
+            self.regex = None
+        # Non-ASCII characters the str regex may match where the bytes regex
+        # cannot: ASCII look-alikes, and digits or spaces for \d and \s.
+        hazards = [f'[{ASCII_LOOKALIKES}]']
+        if self.uses_digits:
+            hazards.append(r'\d')
+        if self.uses_spaces:
+            hazards.append(r'\s')
+        self.hazards = re.compile('|'.join(hazards))
+
+    def _supported(self, items):
+        for op, av in items:
+            if op == sre_parse.LITERAL:
+                # Non-ASCII literals are matched as their UTF-8 bytes.
+                if not _ascii_char(av) and\
+                    (av < 128 or not _caseless_char(av)):
+                    return False
+            elif op == sre_parse.IN:
+                if not self._supported_set(av):
+                    return False
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+                repeated = av[2]
+                # A repeat of a non-ASCII literal would repeat its last byte.
+                if len(repeated) == 1 and repeated[0][0] == sre_parse.LITERAL\
+                    and repeated[0][1] >= 128:
+                    return False
+                if not self._supported(repeated):
+                    return False
+            elif op == sre_parse.SUBPATTERN:
+                if not self._supported(av[-1]):
+                    return False
+            elif op == sre_parse.BRANCH:
+                if not all(self._supported(branch) for branch in av[1]):
+                    return False
+            else:
+                return False
+        return True
+
+    def _supported_set(self, items):
+        for op, av in items:
+            if op == sre_parse.LITERAL:
+                if not _ascii_char(av):
+                    return False
+            elif op == sre_parse.RANGE:
+                if not (_ascii_char(av[0]) and _ascii_char(av[1])):
+                    return False
+            elif op == sre_parse.CATEGORY and\
+                av == sre_parse.CATEGORY_DIGIT:
+                self.uses_digits = True
+            elif op == sre_parse.CATEGORY and\
+                av == sre_parse.CATEGORY_SPACE and len(items) == 1:
+                self.uses_spaces = True
+            else:
+                return False
+        return True
+
+    def equivalent(self, data):
+        # Every run of non-ASCII bytes must be valid UTF-8 without any
+        # character the str regex could match.
+        if self.regex is None:
+            return False
+        if self.uses_spaces and ASCII_STR_SPACES.search(data):
+            return False
+        for run in set(NON_ASCII_RUN.findall(data)):
+            try:
+                decoded = run.decode('utf-8')
+            except UnicodeDecodeError:
+                return False
+            if self.hazards.search(decoded):
+                return False
+        return True
+
+
+# Anchors shorter than this find too many candidates to be useful.
+MIN_ANCHOR_LENGTH = 3
+MAX_ANCHOR_LITERALS = 16
+
+
+def _literal_chars(op, av):
+    # Lowercase characters a single pattern item matches, or None.
+    if op == sre_parse.LITERAL:
+        return {chr(av).lower()}
+    elif op == sre_parse.IN:
+        chars = set()
+        for item_op, item_av in av:
+            if item_op != sre_parse.LITERAL:
+                return None
+            chars.add(chr(item_av).lower())
+        return chars
+    elif op == sre_parse.SUBPATTERN:
+        sub_pattern = av[-1]
+        if len(sub_pattern) == 1:
+            return _literal_chars(*sub_pattern[0])
+    return None
+
+
+def pattern_anchor(pattern, window):
+    # Longest run of literals every match of the pattern contains, with the
+    # number of characters to search before and after its start. Returns None
+    # if the pattern has no such run.
+    parsed = sre_parse.parse(pattern, re.I)
+    # A pattern in a single group has the anchor of the group.
+    while len(parsed) == 1 and parsed[0][0] == sre_parse.SUBPATTERN:
+        parsed = parsed[0][1][-1]
+    best = None
+    for start in range(len(parsed)):
+        literals = ['']
+        end = start
+        while end < len(parsed):
+            chars = _literal_chars(*parsed[end])
+            if not chars or len(literals) * len(chars) > MAX_ANCHOR_LITERALS:
+                break
+            literals = [literal + char
+                        for literal in literals for char in sorted(chars)]
+            end += 1
+        length = end - start
+        if length >= MIN_ANCHOR_LENGTH and (not best or length > best[0]):
+            best = length, start, literals
+
+    if not best:
+        return None
+    _, start, literals = best
+    before = _width(parsed[:start], window)
+    after = _width(parsed[start:], window)
+    return literals, before, after
+
+
+def _width(parsed, window):
+    min_width, max_width = parsed.getwidth()
+    return min(max_width, min_width + window)
+
+
+class LiteralPrefilter(object):
+    def __init__(self, patterns, window=64):
+        # Unbounded parts of a pattern, like \s* or \d+, are only searched
+        # up to window characters longer than their shortest match.
+        anchors = [pattern_anchor(pattern, window) for pattern in patterns]
+        if all(anchors):
+            self.anchors = anchors
+            # Same anchors to search UTF-8 bytes.
+            self.bytes_anchors = [
+                ([literal.encode('utf-8') for literal in literals], before,
+                 after)
+                for literals, before, after in anchors]
+        else:
+            # Without a literal in every pattern, scan the full text.
+            self.anchors = None
+            self.bytes_anchors = None
+
+    def _anchors_for(self, text):
+        if not isinstance(text, str):
+            return self.bytes_anchors
+        return self.anchors
+
+    def may_match(self, lowered):
+        anchors = self._anchors_for(lowered)
+        if anchors is None:
+            return True
+        return any(literal in lowered
+                   for literals, _, _ in anchors for literal in literals)
+
+    def windows(self, text):
+        # Sorted and merged (start, end) offsets around all anchors in the
+        # text, or None if the full text needs to be scanned.
+        anchors = self._anchors_for(text)
+        if anchors is None:
+            return None
+        lowered = lowercase_text(text)
+        if lowered is None:
+            return None
+
+        windows = []
+        for literals, before, after in anchors:
+            for literal in literals:
+                offset = lowered.find(literal)
+                while offset != -1:
+                    windows.append((max(offset - before, 0), offset + after))
+                    offset = lowered.find(literal, offset + 1)
+        windows.sort()
+
+        merged = []
+        for start, end in windows:
+            if merged and start <= merged[-1][1]:
+                merged[-1] = merged[-1][0], max(merged[-1][1], end)
+            else:
+                merged.append((start, end))
+        return merged
+
+
+class RegexPrefilter(object):
+    def __init__(self, anchor, patterns, window=64):
+        # Same as LiteralPrefilter for patterns whose every match contains a
+        # match of the regex anchor, e.g. [vV]\d, but no literal run. Each
+        # window spans a whole match of any pattern around an anchor, with
+        # unbounded parts up to window characters longer than their shortest
+        # match.
+        self.regex = re.compile(anchor, re.I)
+        self.bytes_regex = re.compile(anchor.encode('utf-8'), re.I)
+        self.width = max(_width(sre_parse.parse(pattern, re.I), window)
+                         for pattern in patterns)
+
+    def _regex_for(self, text):
+        if not isinstance(text, str):
+            return self.bytes_regex
+        return self.regex
+
+    def may_match(self, lowered):
+        return self._regex_for(lowered).search(lowered) is not None
+
+    def windows(self, text):
+        merged = []
+        for anchor in self._regex_for(text).finditer(text):
+            start = max(anchor.start() - self.width, 0)
+            end = anchor.start() + self.width
+            if merged and start <= merged[-1][1]:
+                merged[-1] = merged[-1][0], end
+            else:
+                merged.append((start, end))
+        return merged
+
+
+def match_text(match, group):
+    # Group of a str or bytes match as str.
+    text = match.group(group)
+    if isinstance(text, bytes):
+        return text.decode('utf-8')
+    return text
+
 
 class UnionPatternMatcher(object):
-    def __init__(self, patterns):
+    def __init__(self, patterns, prefilter=False):
         combined_pattern = f'({"|".join(patterns)})'
+        self.patterns = patterns
         self.pattern = combined_pattern
         self.regex = re.compile(combined_pattern, re.I)
+        # Scans UTF-8 bytes directly if that gives the same matches.
+        self.bytes_pattern = BytesPattern(combined_pattern)
+        if prefilter:
+            self.prefilter = LiteralPrefilter(patterns)
+        else:
+            self.prefilter = None
+
+    def _windows(self, text):
+        if self.prefilter is None:
+            return None
+        return self.prefilter.windows(text)
+
+    def scans_bytes(self, data):
+        # True if matches and match give the same results for the UTF-8 data
+        # as for its decoding.
+        return self.bytes_pattern.equivalent(data)
+
+    def _regex_for(self, text):
+        if not isinstance(text, str):
+            return self.bytes_pattern.regex
+        return self.regex
+
+    def _finditer(self, text):
+        # Same matches as finditer, but only searched around anchors if the
+        # prefilter is used.
+        regex = self._regex_for(text)
+        windows = self._windows(text)
+        if windows is None:
+            yield from regex.finditer(text)
+            return
+
+        pos = 0
+        for start, end in windows:
+            pos = max(pos, start)
+            while pos < end:
+                window_match = regex.search(text, pos, end)
+                if not window_match:
+                    break
+                # Match again without the window end to get the full match.
+                match = regex.match(text, window_match.start()) or\
+                    window_match
+                yield match
+                pos = match.end()
 
     def matches(self, text):
+        # text may also be UTF-8 bytes or a memory map for which scans_bytes
+        # holds.
         matches = []
-        for match in self.regex.findall(text):
-            group = match[0]
+        for match in self._finditer(text):
+            # Same as the items of findall.
+            if self.regex.groups == 1:
+                group = match_text(match, 1)[0]
+            else:
+                group = match_text(match, 1)
             matches.append(group)
         return matches
 
     def match(self, text, default_val=''):
-        match = self.regex.search(text)
+        match = next(self._finditer(text), None)
         if match:
-            group = match.group(0)
+            group = match_text(match, 0)
             return group.lower()
         else:
             return default_val
 
 
 class AccessionNumberMatcher(UnionPatternMatcher):
-    def __init__(self):
+    def __init__(self, prefilter=True):
 
         """
         ·         PRJ
@@ -68,16 +403,20 @@ class AccessionNumberMatcher(UnionPatternMatcher):
         """
         analysis_pattern = r'(E|D|S)RZ\d{6,}'
         patterns = [projects_pattern, studies_pattern, biosamples_pattern, samples_pattern, runs_pattern, experiments_pattern, analysis_pattern]
-        super().__init__(patterns)
+        super().__init__(patterns, prefilter)
 
     def accession_numbers(self, text):
         return list(set(self.matches(text)))
 
+    def spans(self, text):
+        # (start, end) of each accession number in the text, in order.
+        return [match.span(1) for match in self._finditer(text)]
+
 
 class DataSourceMatcher(UnionPatternMatcher):
-    def __init__(self):
+    def __init__(self, prefilter=True):
         sources = ['Figshare', 'QIITA', 'MG-RAST', 'bioproject']
-        super().__init__(patterns=sources)
+        super().__init__(patterns=sources, prefilter=prefilter)
 
         combined_pattern = f'({"|".join(sources)})'
         self.pattern = combined_pattern
@@ -94,19 +433,32 @@ class SequencingMethodMatcher(UnionPatternMatcher):
 
         # Then check for illumina.
         self.illumina_regex = re.compile('Illumina', re.I)
+        self.illumina_bytes = BytesPattern('Illumina')
 
         # Otherswise: check for emaining methods.
         sequencing_methods = ['Solexa', '454', 'Iontorrent']
 
         super().__init__(patterns=sequencing_methods)
 
+    def scans_bytes(self, data):
+        return self.miseq_hiseq_matcher.scans_bytes(data) and\
+            self.illumina_bytes.equivalent(data) and\
+            super().scans_bytes(data)
+
+    def _illumina_regex_for(self, text):
+        if not isinstance(text, str):
+            return self.illumina_bytes.regex
+        return self.illumina_regex
+
     def matches(self, text):
         # Override these methods as stated in __init__.
         hi_miseq_matches = self.miseq_hiseq_matcher.matches(text)
         if hi_miseq_matches:
             return hi_miseq_matches
         else:
-            illumina_matches = self.illumina_regex.findall(text)
+            illumina_matches = self._illumina_regex_for(text).finditer(text)
+            illumina_matches = [match_text(match, 0)
+                                for match in illumina_matches]
             if illumina_matches:
                 return [match.lower() for match in illumina_matches]
             else:
@@ -119,9 +471,9 @@ class SequencingMethodMatcher(UnionPatternMatcher):
         if hi_miseq_match:
             return hi_miseq_match
         else:
-            illumina_match = self.illumina_regex.search(text)
+            illumina_match = self._illumina_regex_for(text).search(text)
             if illumina_match:
-                match = illumina_match.group(0)
+                match = match_text(illumina_match, 0)
                 return match.lower()
             else:
                 return super().match(text, default_val)
@@ -131,7 +483,7 @@ class SequencingMethodMatcher(UnionPatternMatcher):
 
 
 class Primer515Matcher(UnionPatternMatcher):
-    def __init__(self):
+    def __init__(self, prefilter=True):
         primer_515 = [
             r'515\s*(:?[fF](?:wd)?)?',
             r'(:?[fF](?:wd)?)?\s*515',
@@ -141,7 +493,7 @@ class Primer515Matcher(UnionPatternMatcher):
             r"AATGATACGGCGACCACCGAGATCTACACGCT\s+XXXXXXXXXXXX\s+TATGGTAATT\s+GT\s+GTGYCAGCMGCCGCGGTAA"
         ]
         
-        super().__init__(patterns=primer_515)
+        super().__init__(patterns=primer_515, prefilter=prefilter)
     
     def primer_515(self, text, default_val=''):
         if self.match(text):
@@ -152,7 +504,7 @@ class Primer515Matcher(UnionPatternMatcher):
 
 
 class Primer806Matcher(UnionPatternMatcher):
-    def __init__(self):
+    def __init__(self, prefilter=True):
         primer_806 = [
             r'806\s*(:?[rR](?:ev)?)?',
             r'(:?[rR](?:ev)?)?\s*806', 
@@ -163,7 +515,7 @@ class Primer806Matcher(UnionPatternMatcher):
             r'CAAGCAGAAGACGGCATACGAGAT\s+AGTCAGCCAG\s+CC\s+GGACTACNVGGGTWTCTAAT' # barcode
         ]
 
-        super().__init__(patterns=primer_806)
+        super().__init__(patterns=primer_806, prefilter=prefilter)
 
     def primer_806(self, text, default_val=''):
         if self.match(text):
@@ -173,7 +525,7 @@ class Primer806Matcher(UnionPatternMatcher):
 
 
 class GeneRegionsMatcher(UnionPatternMatcher):
-    def __init__(self):
+    def __init__(self, prefilter=True):
         gene_regions_patterns = [
             r'([vV]\d),\s*([vV]\d)',
             r'([vV]\d)?,?\s+and\s*([vV]\d)',
@@ -184,20 +536,60 @@ class GeneRegionsMatcher(UnionPatternMatcher):
         ]
 
         super().__init__(patterns=gene_regions_patterns)
+        # Every match has a region like V4, which is rare in other text,
+        # while matches of the union may start at any whitespace.
+        if prefilter:
+            self.prefilter = RegexPrefilter(r'[vV]\d', gene_regions_patterns)
 
     def gene_regions(self, text):
-        matches = self.regex.findall(text)
         regions = set()
-        for match in matches:
-            if match:
-                # check all groups but group(0)
-                for region in match[1:]:
-                    # Add only non-empty groups.
-                    if region:
-                        regions.add(region.lower())
+        for match in self._finditer(text):
+            # check all groups but the outer group.
+            for region in match.groups()[1:]:
+                # Add only non-empty groups.
+                if region:
+                    if isinstance(region, bytes):
+                        region = region.decode('utf-8')
+                    regions.add(region.lower())
         return regions
 
 
+def locator_pattern(pattern, lowercase=True):
+    # Drop capturing groups and optionally lowercase the literals, but not
+    # escapes like \S or \D. The result matches at the same positions as
+    # long as the pattern has no backreferences.
+    chars = []
+    escaped = False
+    in_class = False
+    for index, char in enumerate(pattern):
+        if escaped:
+            chars.append(char)
+            escaped = False
+            continue
+        if char == '(' and not in_class and\
+            not pattern.startswith('?', index + 1):
+            chars.append('(?:')
+        else:
+            chars.append(char.lower() if lowercase else char)
+        escaped = char == '\\'
+        if char == '[':
+            in_class = True
+        elif char == ']':
+            in_class = False
+    return ''.join(chars)
+
+
+@dataclass
+class TextFeatures:
+    matches_16ness: bool
+    sequencing_method: str
+    has_515_primer: bool
+    has_806_primer: bool
+    gene_regions: set
+    accession_numbers: list
+    data_source: str
+
+
 class BacteriaMatcher(object):
     
     sequencing_matcher = SequencingMethodMatcher()
@@ -205,11 +597,40 @@ class BacteriaMatcher(object):
     primer_806 = Primer806Matcher()
     
     gene_region_16ness = re.compile(r'(16[sS]\s*rRNA)')
+    gene_region_16ness_bytes = BytesPattern(gene_region_16ness.pattern, 0)
     gene_regions_matcher = GeneRegionsMatcher()
 
     accession_no_matcher = AccessionNumberMatcher()
     data_source_matcher = DataSourceMatcher()
 
+    @staticmethod
+    def features(text):
+        # All features of a text in one record. Each matcher searches only
+        # around its own anchors, which with re is cheaper than one fused
+        # scan over the whole text.
+        return TextFeatures(
+            matches_16ness=bool(BacteriaMatcher.matches_16ness(text)),
+            sequencing_method=BacteriaMatcher.sequencing_method(text),
+            has_515_primer=BacteriaMatcher.has_515_primer(text),
+            has_806_primer=BacteriaMatcher.has_806_primer(text),
+            gene_regions=BacteriaMatcher.gene_regions(text),
+            accession_numbers=BacteriaMatcher.accession_numbers(text),
+            data_source=BacteriaMatcher.data_source(text)
+        )
+
+    @staticmethod
+    def scans_bytes(data):
+        # True if all matchers below give the same results for the UTF-8
+        # data as for its decoding.
+        return BacteriaMatcher.gene_region_16ness_bytes.equivalent(data) and\
+            all(matcher.scans_bytes(data) for matcher in [
+                BacteriaMatcher.sequencing_matcher,
+                BacteriaMatcher.primer_515,
+                BacteriaMatcher.primer_806,
+                BacteriaMatcher.gene_regions_matcher,
+                BacteriaMatcher.accession_no_matcher,
+                BacteriaMatcher.data_source_matcher])
+
     @staticmethod
     def accession_numbers(text):
         return BacteriaMatcher.accession_no_matcher.accession_numbers(text)
@@ -220,6 +641,10 @@ class BacteriaMatcher(object):
 
     @staticmethod
     def matches_16ness(text):
+        if not isinstance(text, str):
+            matches = BacteriaMatcher.gene_region_16ness_bytes.regex.findall(
+                text)
+            return [match.decode('utf-8') for match in matches]
         return BacteriaMatcher.gene_region_16ness.findall(text)
 
     @staticmethod
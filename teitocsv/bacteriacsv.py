@@ -1,12 +1,37 @@
 #!/usr/bin/env python
 import argparse
+import itertools
+import operator
+import os
+import time
 from pathlib import Path
-from multiprocessing.pool import Pool
-
-import pandas as pd
+from functools import partial
 
+from checkpoint import Checkpoint, checkpoint_batches
+from failures import isolated, read_errors, report_errors, write_errors
+from incremental import (changed_teis, load_manifest, manifest_path,
+                         merge_with_previous, row_order, tei_id)
+from parse_cache import ParseCache, open_cache
+from pipeline import (OUTPUT_FORMATS, columns_to_rows, create_pool,
+                      imap_batches, output_format, records_to_columns,
+                      report_busy_times, rows_to_columns, task_size,
+                      write_column_batches, write_csv)
+from prefetch import Prefetcher
+from progress import DEFAULT_INTERVAL, open_progress
+from sharding import (parse_shard, shard_path, shard_teis,
+                      write_shard_manifest)
+from stage_timings import StageTimings, document, init_timings
 from teireader import BacteriaPaper
 
+
+CSV_COLUMNS = ['ID', 'Title', 'DOI', '16ness', 'accession', '515f', '806r', 'seq_method', 'gene_region1', 'gene_region2', 'gene_region3', 'gene_region4', 'gene_region5', 'gene_region6', 'gene_region7', 'gene_region8', 'gene_region_9']
+# Columnar formats store accession numbers and gene regions as lists.
+RECORD_SCHEMA = [('ID', 'string'), ('Title', 'string'), ('DOI', 'string'),
+                 ('16ness', 'bool'), ('accession', 'list<string>'),
+                 ('data_source', 'string'), ('515f', 'bool'), ('806r', 'bool'),
+                 ('seq_method', 'string'), ('gene_regions', 'list<string>')]
+
+
 def set_up_argparser():
     parser = argparse.ArgumentParser()
     parser.add_argument('inputdir', help="input directory containing TEI XML files")
@@ -14,6 +39,52 @@ def set_up_argparser():
         help="directory containing pdftotext files")
     parser.add_argument('outfile',
                         help="output file as CSV with descriptive attributes on bacteria")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS,
+                        help="output format, by default from the outfile extension or csv")
+    parser.add_argument('--cache',
+                        help="SQLite file to cache parsed TEI and pdftotext fields across runs")
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help="maximal size of the cache in MB")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only process new or changed TEI files and merge "
+                             "them into the existing output")
+    parser.add_argument('--workers', type=int,
+                        help="number of worker processes, by default the number of CPUs")
+    parser.add_argument('--chunksize', type=int, default=16,
+                        help="number of TEI files sent to a worker at once")
+    parser.add_argument('--maxtasksperchild', type=int,
+                        help="replace a worker after so many chunks, e.g. to "
+                             "bound its memory")
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help="read up to so many input files at once ahead of "
+                             "the workers, e.g. on slow network storage")
+    parser.add_argument('--ordered', action='store_true',
+                        help="write rows in the order of the TEI file names")
+    parser.add_argument('--checkpoint', action='store_true',
+                        help="keep the rows of finished batches next to the "
+                             "output and resume a stopped run from them")
+    parser.add_argument('--retry-failed', action='store_true',
+                        help="only process the TEI files that failed in the "
+                             "last run and merge them into the existing output")
+    parser.add_argument('--shard', type=parse_shard,
+                        help="only process shard i/N of the TEI files, e.g. on "
+                             "one of N hosts, into a shard of the output to "
+                             "merge with sharding.py", metavar='i/N')
+    parser.add_argument('--progress-interval', type=float,
+                        default=DEFAULT_INTERVAL,
+                        help="seconds between progress reports")
+    parser.add_argument('--progress-log',
+                        help="append progress reports to this file instead of "
+                             "stderr")
+    parser.add_argument('--quiet', action='store_true',
+                        help="do not report progress")
+    parser.add_argument('--timings', action='store_true',
+                        help="report the time per stage and the slowest files")
+    parser.add_argument('--slowest', type=int, default=10,
+                        help="number of slowest files to report with --timings")
+    parser.add_argument('--profile-dir',
+                        help="write a cProfile dump per worker process to this "
+                             "directory")
     return parser
 
 
@@ -21,6 +92,25 @@ def all_teis(input_dir):
     return sorted(Path(input_dir).glob('*.tei.xml'))
 
 
+def pdftotext_path(tei_file, pdftotexts_directory):
+    return Path(pdftotexts_directory) / f"{tei_id(tei_file)}.txt"
+
+
+def paper_files(param):
+    # Files a task may read: the TEI and the pdftotext file.
+    tei_file, pdftotexts_directory = param
+    return [tei_file, pdftotext_path(tei_file, pdftotexts_directory)]
+
+
+def tei_inputs(tei_file, pdftotexts_directory):
+    # Files the entries of a TEI file depend on.
+    inputs = [tei_file]
+    pdftotext_file = pdftotext_path(tei_file, pdftotexts_directory)
+    if pdftotext_file.exists():
+        inputs.append(pdftotext_file)
+    return inputs
+
+
 def repr_gene_regions(regions, default_length=9):
     length_regions = len(regions)
     if length_regions > default_length:
@@ -38,60 +128,202 @@ def repr_gene_regions(regions, default_length=9):
         return expanded_regions
 
 
-def tei_to_csv_entries(param):
+def init_worker(cache_file=None, cache_size=None, timings=False,
+                profile_dir=None):
+    # Open the cache connection once per worker, not per task.
+    open_cache(cache_file, cache_size)
+    init_timings(timings, profile_dir)
+
+
+def tei_to_csv_entries(param, cache_file=None, cache_size=None):
     tei_file, pdftotexts_directory = param
-    tei = BacteriaPaper(tei_file, pdftotexts_directory)
+    with document(tei_file):
+        cache = open_cache(cache_file, cache_size)
+        tei = BacteriaPaper(tei_file, pdftotexts_directory, cache=cache)
+        # Scan title and text once for all features.
+        features = tei.features()
+
+        # Check if 16s RNA is mentioned in the paper.
+        is_16_ness = features.contains_16ness
+
+        # Sequencing method.
+        seq_method = features.sequencing_method
 
-    # Check if 16s RNA is mentioned in the paper.
-    is_16_ness = tei.contains_16ness()
+        # Check for primers.
+        has_515_primer = features.has_515_primer
+        has_806_primer = features.has_806_primer
 
-    # Sequencing method.
-    seq_method = tei.sequencing_method()
+        # Output all gene regions.
+        gene_regions = repr_gene_regions(features.gene_regions)
 
-    # Check for primers.
-    has_515_primer = tei.has_515_primer()
-    has_806_primer = tei.has_806_primer()
+        entries = []
+        # Expand accession numbers from the paper if present.
+        for accession_number in features.accession_numbers:
+            entry = tei.basename(), tei.title, tei.doi(), is_16_ness, accession_number, has_515_primer, has_806_primer, seq_method,  *gene_regions
+            entries.append(entry)
+        # Otherwise empty string.
+        if not entries:
+            data_source = features.data_source
+            entry = tei.basename(), tei.title, tei.doi(), is_16_ness, data_source, has_515_primer, has_806_primer, seq_method, *gene_regions
+            entries.append(entry)
+        tei.update_cache()
+        return entries
+
+
+def tei_to_record(param, cache_file=None, cache_size=None):
+    tei_file, pdftotexts_directory = param
+    with document(tei_file):
+        cache = open_cache(cache_file, cache_size)
+        tei = BacteriaPaper(tei_file, pdftotexts_directory, cache=cache)
+        features = tei.features()
+        record = {
+            'ID': tei.basename(),
+            'Title': tei.title,
+            'DOI': tei.doi(),
+            '16ness': features.contains_16ness,
+            # Sorted, as the order of the matched set differs between
+            # processes.
+            'accession': sorted(features.accession_numbers),
+            'data_source': features.data_source,
+            '515f': bool(features.has_515_primer),
+            '806r': bool(features.has_806_primer),
+            'seq_method': features.sequencing_method,
+            'gene_regions': features.gene_regions
+        }
+        tei.update_cache()
+        return record
 
-    # Output all gene regions.
-    gene_regions = repr_gene_regions(tei.gene_regions())
 
-    entries = []
-    # Expand accession numbers from the paper if present.
-    for accession_number in tei.accession_numbers():
-        entry = tei.basename(), tei.title, tei.doi(), is_16_ness, accession_number, has_515_primer, has_806_primer, seq_method,  *gene_regions
-        entries.append(entry)
-    # Otherwise empty string.
-    if not entries:
-        data_source = tei.data_source()
-        entry = tei.basename(), tei.title, tei.doi(), is_16_ness, data_source, has_515_primer, has_806_primer, seq_method, *gene_regions
-        entries.append(entry)
-    print(f"Handled {tei_file}")
-    return entries
+def tei_batch_to_csv_columns(params, cache_file=None, cache_size=None):
+    # CSV rows of a batch of TEI files, as a list per column. TEI files
+    # that fail are left out and reported separately.
+    to_entries = partial(tei_to_csv_entries, cache_file=cache_file,
+                         cache_size=cache_size)
+    entries = isolated(to_entries, params, operator.itemgetter(0))
+    return rows_to_columns(CSV_COLUMNS, itertools.chain.from_iterable(entries))
+
+
+def tei_batch_to_record_columns(params, cache_file=None, cache_size=None):
+    to_record = partial(tei_to_record, cache_file=cache_file,
+                        cache_size=cache_size)
+    records = isolated(to_record, params, operator.itemgetter(0))
+    columns = [name for name, _ in RECORD_SCHEMA]
+    return records_to_columns(columns, records)
 
 
 def main():
     parser = set_up_argparser()
     args = parser.parse_args()
 
-    teis = all_teis(args.inputdir)
-    # Store tei and path to directory for pdftotexts.
-    mapped_teis = map(lambda tei: (tei, args.pdftotexts), teis)
+    file_format = output_format(args.outfile, args.format)
+    for option in ['incremental', 'checkpoint', 'retry_failed']:
+        if getattr(args, option) and file_format != 'csv':
+            parser.error(f"--{option.replace('_', '-')} only supports csv output")
+    if args.incremental and args.retry_failed:
+        parser.error("--retry-failed cannot be combined with --incremental")
 
-    csv_entries = []
+    teis = all_teis(args.inputdir)
+    input_count = len(teis)
+    if args.shard:
+        # Outputs, manifests and checkpoints of a shard are its own.
+        teis = shard_teis(teis, *args.shard)
+        args.outfile = shard_path(args.outfile, *args.shard)
+    all_shard_teis = teis
+    deleted_teis = []
+    if args.incremental:
+        settings = {'pdftotexts': os.path.abspath(args.pdftotexts)}
+        manifest = load_manifest(args.outfile, settings)
+        inputs = partial(tei_inputs, pdftotexts_directory=args.pdftotexts)
+        teis, deleted_teis = changed_teis(manifest, teis, inputs)
+    if args.retry_failed:
+        failed = set(Path(error.file).name for error in read_errors(args.outfile))
+        teis = [tei for tei in teis if tei.name in failed]
+    # TEI files whose rows replace those in the previous output.
+    processed_teis = teis
+    checkpoint = None
+    if args.checkpoint:
+        settings = {'inputdir': os.path.abspath(args.inputdir),
+                    'pdftotexts': os.path.abspath(args.pdftotexts),
+                    'incremental': args.incremental,
+                    'retry_failed': args.retry_failed}
+        checkpoint = Checkpoint.open(args.outfile, settings)
+        teis = [tei for tei in teis if tei_id(tei) not in checkpoint.done]
+    # Store tei and path to directory for pdftotexts. Plain strings are
+    # cheaper to send to the workers than paths.
+    mapped_teis = [(str(tei), args.pdftotexts) for tei in teis]
+    # Schedule by the size of the TEI and the pdftotext file.
+    sizes = [task_size(tei_inputs(tei, args.pdftotexts)) for tei in teis]
+    prefetcher = None
+    if args.prefetch:
+        prefetcher = Prefetcher(paper_files, args.prefetch)
+    stage_timings = StageTimings() if args.timings else None
+    progress = open_progress(len(teis), args.progress_interval,
+                             args.progress_log, args.quiet)
+    busy_times = {}
+    errors = []
+    start = time.perf_counter()
 
-    pool = Pool()
-    csv_entries = pool.map(tei_to_csv_entries, mapped_teis)
+    cache_size = args.cache_size * 1024 ** 2
+    # Workers send back the results of a chunk of tasks at once, as columns.
+    if file_format == 'csv':
+        to_columns = tei_batch_to_csv_columns
+    else:
+        to_columns = tei_batch_to_record_columns
+    batch_task = partial(to_columns, cache_file=args.cache,
+                         cache_size=cache_size)
+    with create_pool(args.workers, args.maxtasksperchild, init_worker,
+                     (args.cache, cache_size, args.timings,
+                      args.profile_dir)) as pool, progress:
+        # Merging with the previous output needs the rows in order.
+        ordered = args.ordered or args.incremental or args.retry_failed
+        batches = imap_batches(pool, batch_task, mapped_teis, sizes,
+                               args.chunksize, ordered, busy_times, prefetcher,
+                               stage_timings, progress, errors)
+        if file_format == 'csv':
+            row_batches = (list(columns_to_rows(batch)) for batch in batches)
+            if checkpoint is not None:
+                checkpoint_batches(checkpoint, row_batches, errors)
+                checkpoint.close()
+                errors = checkpoint.errors
+                csv_data = checkpoint.rows()
+                if ordered:
+                    # Rows of a resumed run follow those of the earlier runs.
+                    csv_data = sorted(csv_data, key=row_order)
+            else:
+                csv_data = itertools.chain.from_iterable(row_batches)
+            if args.incremental or args.retry_failed:
+                csv_data = merge_with_previous(
+                    args.outfile, csv_data, processed_teis, deleted_teis)
+            write_csv(args.outfile, CSV_COLUMNS, csv_data)
+        else:
+            write_column_batches(args.outfile, file_format, RECORD_SCHEMA,
+                                 batches)
+        # Leaving the block terminates the workers, e.g. after an error.
+        # Otherwise let them finish cleanly.
+        pool.close()
+        pool.join()
+        progress.finish()
+    report_busy_times(busy_times, time.perf_counter() - start)
+    if stage_timings is not None:
+        stage_timings.report(args.slowest)
+    write_errors(args.outfile, errors)
+    report_errors(args.outfile, errors)
+    if checkpoint is not None:
+        checkpoint.remove()
+    print(f"Done with {file_format}")
+    if args.incremental:
+        # Failed TEI files count as changed in the next run.
+        manifest.remove(set(Path(error.file).name for error in errors))
+        manifest.save(manifest_path(args.outfile))
+    if args.shard:
+        write_shard_manifest(args.outfile, args.shard, file_format,
+                             {'tool': 'bacteriacsv'},
+                             ordered, all_shard_teis, input_count, errors)
 
-    csv_data = []
-    for entry in csv_entries:
-        csv_data.extend(entry)
-    
-    print("Done with parsing")
-    result_csv = pd.DataFrame(csv_data, columns=['ID', 'Title', 'DOI', '16ness', 'accession', '515f', '806r', 'seq_method', 'gene_region1', 'gene_region2', 'gene_region3', 'gene_region4', 'gene_region5', 'gene_region6', 'gene_region7', 'gene_region8', 'gene_region_9'])
-    print("Done with appending")
+    if args.cache:
+        # Evict entries beyond the cache size.
+        ParseCache(args.cache, cache_size).close()
 
-    result_csv.to_csv(args.outfile, index=False)
-    print("Done with csv")
 
 if __name__ == '__main__':
     main()
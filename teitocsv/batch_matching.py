@@ -0,0 +1,180 @@
+import re
+
+import pandas as pd
+
+from bacteria_regex import BacteriaMatcher, locator_pattern
+
+
+# Texts matched at once, which bounds the memory of intermediate columns.
+DEFAULT_CHUNK_SIZE = 10000
+
+# Same fields as TextFeatures, with gene regions and accession numbers as
+# sorted lists.
+FEATURE_COLUMNS = ['matches_16ness', 'sequencing_method', 'has_515_primer',
+                   'has_806_primer', 'gene_regions', 'accession_numbers',
+                   'data_source']
+
+# Characters the patterns of BacteriaMatcher match differently in re than
+# in the RE2 kernels of Arrow: whitespace beyond [ \t\n\r\f] for \s,
+# non-ASCII letters that re.I matches with ASCII letters, and non-ASCII
+# decimal digits for \d. Texts with any of them, or with the separator NUL
+# of _find_all, are matched with re.
+RE2_HAZARDS = (r'[\x00\x0b\x1c-\x1f\x85\xa0\x{1680}\x{2000}-\x{200a}\x{2028}'
+               r'\x{2029}\x{202f}\x{205f}\x{3000}'
+               r'\x{130}\x{131}\x{17f}\x{212a}]|[^\P{Nd}0-9]')
+
+
+def row_features(text):
+    # Features of a single text with re, as a row of FEATURE_COLUMNS.
+    features = BacteriaMatcher.features(text)
+    return (features.matches_16ness, features.sequencing_method,
+            features.has_515_primer, features.has_806_primer,
+            sorted(features.gene_regions), sorted(features.accession_numbers),
+            features.data_source)
+
+
+def rows_features(texts):
+    columns = {column: [] for column in FEATURE_COLUMNS}
+    values = list(columns.values())
+    for text in texts:
+        for column_values, value in zip(values, row_features(text)):
+            column_values.append(value)
+    return columns
+
+
+def _import_pyarrow():
+    # pyarrow is optional. Without it, all texts are matched with re.
+    try:
+        import pyarrow
+        import pyarrow.compute
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def text_chunks(texts, chunksize=DEFAULT_CHUNK_SIZE):
+    # Slices of up to chunksize texts as Arrow arrays, or as lists of
+    # strings without pyarrow. Missing texts are empty.
+    pa = _import_pyarrow()
+    if pa is not None and isinstance(texts, (pa.Array, pa.ChunkedArray)):
+        for start in range(0, len(texts), chunksize):
+            yield pa.compute.fill_null(texts.slice(start, chunksize), '')
+        return
+    if isinstance(texts, pd.Series):
+        texts = texts.tolist()
+    texts = list(texts)
+    for start in range(0, len(texts), chunksize):
+        chunk = [text if isinstance(text, str) else ''
+                 for text in texts[start:start + chunksize]]
+        if pa is None:
+            yield chunk
+        else:
+            yield pa.array(chunk, type=pa.large_string())
+
+
+def _contains(pc, texts, regex):
+    return pc.match_substring_regex(texts, regex.pattern,
+                                    ignore_case=bool(regex.flags & re.I))
+
+
+def _first_match(pc, texts, regex):
+    # Leftmost match of the regex lowercased, or null. The kernel only
+    # takes named groups.
+    flags = '(?i)' if regex.flags & re.I else ''
+    pattern = locator_pattern(regex.pattern, lowercase=False)
+    pattern = f'{flags}(?P<match>{pattern})'
+    matches = pc.struct_field(pc.extract_regex(texts, pattern), [0])
+    return pc.utf8_lower(matches)
+
+
+def _find_all(pc, texts, regex):
+    # All non-overlapping matches of each text, like findall without groups.
+    # The kernel puts a separator around each match of the texts that have
+    # one, so every other piece between separators is a match.
+    found = [[] for _ in range(len(texts))]
+    has_match = _contains(pc, texts, regex)
+    flags = '(?i)' if regex.flags & re.I else ''
+    pattern = locator_pattern(regex.pattern, lowercase=False)
+    marked = pc.replace_substring_regex(
+        texts.filter(has_match), f'{flags}{pattern}', '\x00\\0\x00')
+    rows = (row for row, matched in enumerate(has_match.to_pylist())
+            if matched)
+    for row, pieces in zip(rows, pc.split_pattern(marked, '\x00').to_pylist()):
+        found[row] = pieces[1::2]
+    return found
+
+
+def arrow_features(texts):
+    # Features of texts without RE2_HAZARDS with the regex kernels of Arrow,
+    # the same as those of row_features.
+    pa = _import_pyarrow()
+    pc = pa.compute
+    sequencing = BacteriaMatcher.sequencing_matcher
+    sequencing_method = pc.coalesce(
+        _first_match(pc, texts, sequencing.miseq_hiseq_matcher.regex),
+        _first_match(pc, texts, sequencing.illumina_regex),
+        _first_match(pc, texts, sequencing.regex), '')
+    data_source = pc.coalesce(
+        _first_match(pc, texts, BacteriaMatcher.data_source_matcher.regex), '')
+    accession_numbers = [
+        sorted(set(matches)) for matches in _find_all(
+            pc, texts, BacteriaMatcher.accession_no_matcher.regex)]
+    # A match alone has the same groups as in the text, which gives the
+    # regions of all groups but the outer one.
+    regions_regex = BacteriaMatcher.gene_regions_matcher.regex
+    gene_regions = [
+        sorted(set(region.lower() for match in matches
+                   for region in regions_regex.match(match).groups()[1:]
+                   if region))
+        for matches in _find_all(pc, texts, regions_regex)]
+    return {
+        'matches_16ness': _contains(
+            pc, texts, BacteriaMatcher.gene_region_16ness).to_pylist(),
+        'sequencing_method': sequencing_method.to_pylist(),
+        'has_515_primer': _contains(
+            pc, texts, BacteriaMatcher.primer_515.regex).to_pylist(),
+        'has_806_primer': _contains(
+            pc, texts, BacteriaMatcher.primer_806.regex).to_pylist(),
+        'gene_regions': gene_regions,
+        'accession_numbers': accession_numbers,
+        'data_source': data_source.to_pylist()
+    }
+
+
+def chunk_features(chunk):
+    if isinstance(chunk, list):
+        return rows_features(chunk)
+    pc = _import_pyarrow().compute
+    kernel_rows = pc.invert(pc.match_substring_regex(chunk, RE2_HAZARDS))
+    if pc.all(kernel_rows).as_py():
+        return arrow_features(chunk)
+
+    # Match the other texts with re and merge them back in order.
+    in_kernel = kernel_rows.to_pylist()
+    kernel_columns = arrow_features(chunk.filter(kernel_rows))
+    re_columns = rows_features(chunk.filter(pc.invert(kernel_rows)).to_pylist())
+    columns = {}
+    for column in FEATURE_COLUMNS:
+        kernel_values = iter(kernel_columns[column])
+        re_values = iter(re_columns[column])
+        columns[column] = [next(kernel_values) if kernel else next(re_values)
+                           for kernel in in_kernel]
+    return columns
+
+
+def text_features_columns(texts, chunksize=DEFAULT_CHUNK_SIZE):
+    # Features of a pandas Series, Arrow string array or list of texts as a
+    # list per column of FEATURE_COLUMNS, e.g. for pa.table().
+    columns = {column: [] for column in FEATURE_COLUMNS}
+    for chunk in text_chunks(texts, chunksize):
+        for column, values in chunk_features(chunk).items():
+            columns[column].extend(values)
+    return columns
+
+
+def text_features_frame(texts, chunksize=DEFAULT_CHUNK_SIZE):
+    # Same as text_features_columns as a DataFrame, with the index of a
+    # Series.
+    index = texts.index if isinstance(texts, pd.Series) else None
+    return pd.DataFrame(text_features_columns(texts, chunksize), index=index,
+                        columns=FEATURE_COLUMNS)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# Throughput of the bacteria pipeline per pool chunksize and scheduling on
+# a synthetic corpus of small and large TEI files, e.g.
+#   python benchmark_pool.py --files 400 --chunksizes 1 4 16 64
+import argparse
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+from bacteriacsv import all_teis, init_worker, tei_inputs, tei_to_csv_entries
+from pipeline import create_pool, imap_results, imap_scheduled, task_size
+from synthetic_corpus import add_corpus_arguments, write_corpus_from_args
+
+
+def quiet_init_worker():
+    # Hide any output and the parser warnings of the workers.
+    sys.stdout = open(os.devnull, 'w')
+    warnings.simplefilter('ignore')
+    init_worker()
+
+
+def time_run(teis, pdftotexts, workers, chunksize, maxtasksperchild,
+             schedule='size'):
+    tasks = [(str(tei), pdftotexts) for tei in teis]
+    sizes = [task_size(tei_inputs(tei, pdftotexts)) for tei in teis]
+    start = time.perf_counter()
+    with create_pool(workers, maxtasksperchild, quiet_init_worker) as pool:
+        if schedule == 'size':
+            results = imap_scheduled(pool, tei_to_csv_entries, tasks, sizes,
+                                     chunksize)
+        else:
+            results = imap_results(pool, tei_to_csv_entries, tasks, chunksize)
+        for _ in results:
+            pass
+        pool.close()
+        pool.join()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_corpus_arguments(parser)
+    parser.add_argument('--workers', type=int,
+                        help="number of worker processes, by default the number of CPUs")
+    parser.add_argument('--chunksizes', type=int, nargs='+',
+                        default=[1, 4, 16, 64],
+                        help="chunksizes to compare")
+    parser.add_argument('--maxtasksperchild', type=int,
+                        help="replace a worker after so many chunks")
+    parser.add_argument('--schedules', nargs='+', choices=['name', 'size'],
+                        default=['name', 'size'],
+                        help="dispatch in file name order or largest first")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as corpus:
+        write_corpus_from_args(corpus, args)
+        teis = all_teis(corpus)
+        megabytes = sum(tei.stat().st_size for tei in teis) / 1024 ** 2
+        print(f"{len(teis)} TEI files, {megabytes:.1f} MB")
+        print("schedule chunksize  seconds   docs/s    MB/s")
+        for schedule in args.schedules:
+            for chunksize in args.chunksizes:
+                seconds = time_run(teis, corpus, args.workers, chunksize,
+                                   args.maxtasksperchild, schedule)
+                print(f"{schedule:>8} {chunksize:9d} {seconds:8.2f} "
+                      f"{len(teis) / seconds:8.1f} {megabytes / seconds:7.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Throughput of the bacteria pipeline on simulated slow storage, with the
+# workers reading their files or with the files prefetched, e.g.
+#   python benchmark_prefetch.py --files 200 --latency 0.02 --prefetch 16
+import argparse
+import tempfile
+import time
+
+from bacteriacsv import all_teis, paper_files, tei_inputs, tei_to_csv_entries
+from benchmark_pool import quiet_init_worker
+from pipeline import create_pool, imap_scheduled, task_size
+from prefetch import Prefetcher, read_bytes
+from synthetic_corpus import write_corpus
+
+
+class SlowReader(object):
+    def __init__(self, latency):
+        # Reads a file after waiting latency seconds, like a request to
+        # network storage.
+        self.latency = latency
+
+    def __call__(self, filename):
+        time.sleep(self.latency)
+        return read_bytes(filename)
+
+
+class SlowTask(object):
+    def __init__(self, func, latency, files):
+        # Waits for the latency of reading files before running func in the
+        # worker.
+        self.func = func
+        self.latency = latency
+        self.files = files
+
+    def __call__(self, task):
+        time.sleep(self.latency * self.files)
+        return self.func(task)
+
+
+def time_run(teis, pdftotexts, workers, chunksize, latency, prefetch=0):
+    tasks = [(str(tei), pdftotexts) for tei in teis]
+    sizes = [task_size(tei_inputs(tei, pdftotexts)) for tei in teis]
+    start = time.perf_counter()
+    with create_pool(workers, None, quiet_init_worker) as pool:
+        if prefetch:
+            # The slow reads happen in the prefetching threads.
+            prefetcher = Prefetcher(paper_files, prefetch,
+                                    read_file=SlowReader(latency))
+            results = imap_scheduled(pool, tei_to_csv_entries, tasks, sizes,
+                                     chunksize, prefetcher=prefetcher)
+        else:
+            task = SlowTask(tei_to_csv_entries, latency, 2)
+            results = imap_scheduled(pool, task, tasks, sizes, chunksize)
+        for _ in results:
+            pass
+        pool.close()
+        pool.join()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=200,
+                        help="number of synthetic TEI files")
+    parser.add_argument('--workers', type=int,
+                        help="number of worker processes, by default the number of CPUs")
+    parser.add_argument('--chunksize', type=int, default=16,
+                        help="tasks sent to a worker at once")
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help="seconds to wait for each file read")
+    parser.add_argument('--prefetch', type=int, nargs='+', default=[4, 16, 64],
+                        help="numbers of files read at once to compare")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as corpus:
+        write_corpus(corpus, args.files)
+        teis = all_teis(corpus)
+        megabytes = sum(tei.stat().st_size for tei in teis) / 1024 ** 2
+        print(f"{len(teis)} TEI files, {megabytes:.1f} MB, "
+              f"{args.latency * 1000:.0f} ms per read")
+        print("prefetch  seconds   docs/s    MB/s")
+        for prefetch in [0] + args.prefetch:
+            seconds = time_run(teis, corpus, args.workers, args.chunksize,
+                               args.latency, prefetch)
+            print(f"{prefetch:8d} {seconds:8.2f} "
+                  f"{len(teis) / seconds:8.1f} {megabytes / seconds:7.2f}")
+
+
+if __name__ == '__main__':
+    main()
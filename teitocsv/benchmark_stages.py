@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# Throughput of each stage of the bacteria pipeline on a synthetic corpus,
+# in a single process. Stages are timed separately on the same documents,
+# e.g.
+#   python benchmark_stages.py --files 200 --json stages.json
+#   python benchmark_stages.py --files 200 --compare stages.json
+import argparse
+import contextlib
+import io
+import json
+import subprocess
+import tempfile
+import time
+import warnings
+from pathlib import Path
+
+from bacteria_regex import BacteriaMatcher
+from bacteriacsv import CSV_COLUMNS, all_teis, tei_to_csv_entries
+from pdftotext_reader import PDFToText
+from pipeline import write_csv
+from synthetic_corpus import add_corpus_arguments, write_corpus_from_args
+from teireader import TEIFile, read_tei
+
+
+MATCHERS = ['features', 'accession_numbers', 'data_source', 'matches_16ness',
+            'gene_regions', 'sequencing_method', 'has_515_primer',
+            'has_806_primer']
+
+
+class StageTimer(object):
+    def __init__(self):
+        # Seconds and bytes per stage, summed over documents.
+        self.seconds = {}
+        self.bytes = {}
+
+    def time(self, stage, func, *args, size=0):
+        start = time.perf_counter()
+        result = func(*args)
+        seconds = time.perf_counter() - start
+        self.seconds[stage] = self.seconds.get(stage, 0) + seconds
+        self.bytes[stage] = self.bytes.get(stage, 0) + size
+        return result
+
+
+def read_file(filename):
+    with open(filename, 'rb') as content:
+        return content.read()
+
+
+def time_stages(teis, pdftotexts):
+    timer = StageTimer()
+    for tei_file in teis:
+        size = tei_file.stat().st_size
+        timer.time('read', read_file, tei_file, size=size)
+        soup = timer.time('read_tei', read_tei, tei_file, size=size)
+        tei = TEIFile(tei_file)
+        # Extract the text from the parsed tree only.
+        tei._soup = soup
+        text = timer.time('text', lambda: tei.text, size=size)
+        text_size = len(text.encode('utf-8'))
+        for name in MATCHERS:
+            timer.time(name, getattr(BacteriaMatcher, name), text,
+                       size=text_size)
+
+        pdftotext_file = Path(pdftotexts) / f"{tei.basename()}.txt"
+        pdftotext = PDFToText(pdftotext_file)
+        pdftotext_size = pdftotext_file.stat().st_size
+        timer.time('pdftotext_doi', pdftotext.doi, size=pdftotext_size)
+        timer.time('pdftotext_accession_numbers', pdftotext.accession_numbers,
+                   size=pdftotext_size)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = [row for tei_file in teis
+                for row in tei_to_csv_entries((str(tei_file), pdftotexts))]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outfile = Path(tmpdir) / 'out.csv'
+        timer.time('csv_write', write_csv, outfile, CSV_COLUMNS, rows)
+        timer.bytes['csv_write'] = outfile.stat().st_size
+    return timer
+
+
+def best_of(timers):
+    # Fastest run of each stage, which is least disturbed by other load.
+    seconds = {stage: min(timer.seconds[stage] for timer in timers)
+               for stage in timers[0].seconds}
+    return seconds, timers[0].bytes
+
+
+def git_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def stage_results(seconds, stage_bytes, docs):
+    results = {}
+    for stage, stage_seconds in seconds.items():
+        results[stage] = {
+            'seconds': stage_seconds,
+            'bytes': stage_bytes[stage],
+            'docs_per_s': docs / stage_seconds if stage_seconds else None,
+            'mb_per_s': stage_bytes[stage] / 1024 ** 2 / stage_seconds
+                        if stage_seconds else None
+        }
+    return results
+
+
+def print_results(results, baseline=None):
+    header = "stage                          seconds     docs/s      MB/s"
+    if baseline:
+        header += "   vs baseline"
+    print(header)
+    for stage, result in results.items():
+        line = (f"{stage:<28} {result['seconds']:9.4f} "
+                f"{result['docs_per_s'] or 0:10.1f} {result['mb_per_s'] or 0:9.2f}")
+        if baseline and stage in baseline['stages']:
+            before = baseline['stages'][stage]['seconds']
+            # Above 1 is slower than the baseline.
+            line += f"   {result['seconds'] / before:10.2f}x"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_corpus_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs per stage, reporting the fastest")
+    parser.add_argument('--json',
+                        help="write the results as JSON to this file")
+    parser.add_argument('--compare',
+                        help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as corpus:
+        write_corpus_from_args(corpus, args)
+        teis = all_teis(corpus)
+        corpus_bytes = sum(tei.stat().st_size for tei in teis)
+        print(f"{len(teis)} TEI files, {corpus_bytes / 1024 ** 2:.1f} MB")
+        warnings.simplefilter('ignore')
+        timers = [time_stages(teis, corpus) for _ in range(args.repeat)]
+
+    seconds, stage_bytes = best_of(timers)
+    report = {
+        'commit': git_commit(),
+        'settings': vars(args),
+        'docs': len(teis),
+        'bytes': corpus_bytes,
+        'stages': stage_results(seconds, stage_bytes, len(teis))
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(report['stages'], baseline)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as json_file:
+            json.dump(report, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import csv
+import json
+import os
+from dataclasses import asdict
+
+from failures import TaskError
+from incremental import tei_id
+
+
+def partial_path(outfile):
+    return f'{outfile}.partial'
+
+
+def log_path(outfile):
+    return f'{outfile}.checkpoint.jsonl'
+
+
+class Checkpoint(object):
+    def __init__(self, outfile, settings):
+        # CSV rows of the batches finished so far, appended to
+        # outfile.partial. After each batch, outfile.checkpoint.jsonl records
+        # the size of the rows written so far with the IDs of the TEI files
+        # done and the failures. A run that stops may leave rows beyond the
+        # last record, which a resumed run drops.
+        self.outfile = outfile
+        self.settings = settings
+        self.done = set()
+        self.errors = []
+        self._partial = None
+        self._log = None
+
+    @classmethod
+    def open(cls, outfile, settings):
+        # Resume from the checkpoint of a run with the same settings,
+        # otherwise start over.
+        checkpoint = cls(outfile, settings)
+        offset = checkpoint._load()
+        if offset is None:
+            checkpoint._start()
+        else:
+            checkpoint._resume(offset)
+        return checkpoint
+
+    def _load(self):
+        if not os.path.exists(log_path(self.outfile)) or\
+                not os.path.exists(partial_path(self.outfile)):
+            return None
+        with open(log_path(self.outfile), encoding='utf-8') as log_file:
+            lines = log_file.read().splitlines()
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # Only the last line may be cut off by a crash.
+                break
+        if not records or records[0].get('settings') != self.settings:
+            return None
+        offset = 0
+        for record in records[1:]:
+            offset = record['offset']
+            self.done.update(record['done'])
+            self.errors.extend(TaskError(**error) for error in record['errors'])
+        return offset
+
+    def _start(self):
+        self.done = set()
+        self.errors = []
+        self._partial = open(partial_path(self.outfile), 'w', newline='',
+                             encoding='utf-8')
+        self._log = open(log_path(self.outfile), 'w', encoding='utf-8')
+        self._write_log({'settings': self.settings})
+
+    def _resume(self, offset):
+        self._partial = open(partial_path(self.outfile), 'r+', newline='',
+                             encoding='utf-8')
+        self._partial.truncate(offset)
+        self._partial.seek(offset)
+        # Replace the log by one without a line cut off by a crash.
+        tmp_log = f'{log_path(self.outfile)}.tmp'
+        self._log = open(tmp_log, 'w', encoding='utf-8')
+        self._write_log({'settings': self.settings})
+        self._write_log({'offset': offset, 'done': sorted(self.done),
+                         'errors': [asdict(error) for error in self.errors]})
+        self._log.close()
+        os.replace(tmp_log, log_path(self.outfile))
+        self._log = open(log_path(self.outfile), 'a', encoding='utf-8')
+
+    def _write_log(self, record):
+        self._log.write(json.dumps(record, ensure_ascii=False))
+        self._log.write('\n')
+        self._log.flush()
+        os.fsync(self._log.fileno())
+
+    def add(self, rows, errors):
+        # Rows and failures of a finished batch.
+        writer = csv.writer(self._partial, lineterminator='\n')
+        done = set()
+        for row in rows:
+            writer.writerow(row)
+            done.add(row[0])
+        self._partial.flush()
+        os.fsync(self._partial.fileno())
+        done.update(tei_id(error.file) for error in errors)
+        self.done.update(done)
+        self.errors.extend(errors)
+        self._write_log({'offset': self._partial.tell(), 'done': sorted(done),
+                         'errors': [asdict(error) for error in errors]})
+
+    def close(self):
+        self._partial.close()
+        self._log.close()
+
+    def rows(self):
+        # All rows so far, read back as strings as from a CSV output.
+        with open(partial_path(self.outfile), newline='',
+                  encoding='utf-8') as partial:
+            yield from csv.reader(partial)
+
+    def remove(self):
+        os.remove(partial_path(self.outfile))
+        os.remove(log_path(self.outfile))
+
+
+def checkpoint_batches(checkpoint, row_batches, errors):
+    # Add each batch of rows to the checkpoint together with the failures
+    # collected in errors while it was produced.
+    seen = len(errors)
+    for rows in row_batches:
+        checkpoint.add(rows, errors[seen:])
+        seen = len(errors)
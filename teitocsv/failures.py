@@ -0,0 +1,74 @@
+import json
+import os
+import traceback
+from dataclasses import asdict, dataclass
+
+
+# Failures of the tasks run by this process since the last
+# collect_errors().
+_errors = []
+
+
+@dataclass
+class TaskError:
+    file: str
+    error: str
+    message: str
+    traceback: str
+
+
+def isolated(func, tasks, name=str):
+    # Results of func for the tasks that do not fail. A failing task is
+    # recorded with the file name(task) and skipped, so that one malformed
+    # file does not end the whole run.
+    for task in tasks:
+        try:
+            result = func(task)
+        except Exception as exception:
+            _errors.append(TaskError(
+                file=name(task), error=type(exception).__name__,
+                message=str(exception), traceback=traceback.format_exc()))
+        else:
+            yield result
+
+
+def collect_errors():
+    # Failures recorded since the last call, to send to the main process.
+    errors = list(_errors)
+    _errors.clear()
+    return errors
+
+
+def errors_path(outfile):
+    return f'{outfile}.errors.jsonl'
+
+
+def write_errors(outfile, errors):
+    # Replace the sidecar file of failed TEI files next to the output. A
+    # run without failures removes it.
+    filename = errors_path(outfile)
+    if not errors:
+        if os.path.exists(filename):
+            os.remove(filename)
+        return
+    tmp_filename = f'{filename}.tmp'
+    with open(tmp_filename, 'w', encoding='utf-8') as errors_file:
+        for error in errors:
+            errors_file.write(json.dumps(asdict(error), ensure_ascii=False))
+            errors_file.write('\n')
+    os.replace(tmp_filename, filename)
+
+
+def read_errors(outfile):
+    filename = errors_path(outfile)
+    if not os.path.exists(filename):
+        return []
+    with open(filename, encoding='utf-8') as errors_file:
+        return [TaskError(**json.loads(line)) for line in errors_file]
+
+
+def report_errors(outfile, errors, shown=10):
+    for error in errors[:shown]:
+        print(f"Failed {error.file}: {error.error}: {error.message}")
+    if errors:
+        print(f"{len(errors)} files failed, see {errors_path(outfile)}")
@@ -0,0 +1,121 @@
+import heapq
+import json
+import os
+from pathlib import Path
+
+from parse_cache import file_digest, file_stat
+from pipeline import read_csv_rows
+
+
+def manifest_path(outfile):
+    return f'{outfile}.manifest.json'
+
+
+def tei_id(tei_file):
+    # Same as TEIFile.basename without parsing the file.
+    name = Path(tei_file).name
+    if name.endswith('.tei.xml'):
+        return name[0:-8]
+    return Path(tei_file).stem
+
+
+def file_entry(filename):
+    size, mtime = file_stat(filename)
+    return {'size': size, 'mtime': mtime, 'digest': file_digest(filename)}
+
+
+def file_changed(filename, entry):
+    if not os.path.exists(filename):
+        return True
+    size, mtime = file_stat(filename)
+    if size != entry['size']:
+        return True
+    if mtime == entry['mtime']:
+        return False
+    # Touched but possibly unchanged: compare the content.
+    return file_digest(filename) != entry['digest']
+
+
+class Manifest(object):
+    def __init__(self, settings, entries=None):
+        # Maps the name of each processed TEI file to the size, mtime and
+        # content hash of all its input files, e.g. TEI and pdftotext.
+        # Runs with other settings cannot reuse the output.
+        self.settings = settings
+        self.entries = entries or {}
+
+    @classmethod
+    def load(cls, filename, settings):
+        if not os.path.exists(filename):
+            return cls(settings)
+        with open(filename) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest['settings'] != settings:
+            return cls(settings)
+        return cls(settings, manifest['entries'])
+
+    def save(self, filename):
+        tmp_filename = f'{filename}.tmp'
+        with open(tmp_filename, 'w') as manifest_file:
+            json.dump({'settings': self.settings, 'entries': self.entries},
+                      manifest_file, indent=1, sort_keys=True)
+        os.replace(tmp_filename, filename)
+
+    def changed(self, tei_file, input_files):
+        entry = self.entries.get(Path(tei_file).name)
+        if entry is None:
+            return True
+        input_files = [os.path.abspath(f) for f in input_files]
+        if sorted(entry) != sorted(input_files):
+            return True
+        return any(file_changed(f, entry[f]) for f in input_files)
+
+    def update(self, tei_file, input_files):
+        self.entries[Path(tei_file).name] = {
+            os.path.abspath(f): file_entry(f) for f in input_files
+        }
+
+    def deleted(self, tei_files):
+        names = set(Path(tei_file).name for tei_file in tei_files)
+        return [name for name in self.entries if name not in names]
+
+    def remove(self, names):
+        for name in names:
+            self.entries.pop(name, None)
+
+
+def load_manifest(outfile, settings):
+    # Without a previous output, all TEI files need to be processed.
+    if not os.path.exists(outfile):
+        return Manifest(settings)
+    return Manifest.load(manifest_path(outfile), settings)
+
+
+def changed_teis(manifest, teis, inputs):
+    # Split TEI files into those to process and the names of deleted files,
+    # and record the state of the files to process in the manifest.
+    changed = [tei for tei in teis if manifest.changed(tei, inputs(tei))]
+    deleted = manifest.deleted(teis)
+    for tei in changed:
+        manifest.update(tei, inputs(tei))
+    manifest.remove(deleted)
+    return changed, deleted
+
+
+def merge_with_previous(outfile, rows, processed, deleted):
+    # Merge rows of the processed TEI files, in the order of their file
+    # names, with the rows of unchanged TEI files from the previous output.
+    # The result has the order of an ordered full run.
+    if not os.path.exists(outfile):
+        return rows
+    replaced_ids = set(tei_id(tei_file) for tei_file in processed + deleted)
+    # The previous output may come from an unordered run. Sorting takes
+    # linear time if it is already in order.
+    previous_rows = sorted((row for row in read_csv_rows(outfile)
+                            if row[0] not in replaced_ids), key=row_order)
+    return heapq.merge(previous_rows, rows, key=row_order)
+
+
+def row_order(row):
+    # Rows start with the ID, i.e. the TEI file name without extension.
+    return f'{row[0]}.tei.xml'
@@ -1,17 +1,89 @@
 #!/usr/bin/env python
 import argparse
+import itertools
+import os
+import time
+from dataclasses import asdict
+from functools import partial
 from pathlib import Path
-from multiprocessing.pool import Pool
 
-import pandas as pd
+from checkpoint import Checkpoint, checkpoint_batches
+from failures import isolated, read_errors, report_errors, write_errors
+from incremental import (changed_teis, load_manifest, manifest_path,
+                         merge_with_previous, row_order, tei_id)
+from parse_cache import ParseCache, open_cache
+from pipeline import (OUTPUT_FORMATS, columns_to_rows, create_pool,
+                      imap_batches, output_format, records_to_columns,
+                      report_busy_times, rows_to_columns, task_size,
+                      write_column_batches, write_csv)
+from prefetch import Prefetcher
+from progress import DEFAULT_INTERVAL, open_progress
+from sharding import (parse_shard, shard_path, shard_teis,
+                      write_shard_manifest)
+from stage_timings import StageTimings, document, init_timings
+from teireader import PARSERS, TEIFile
+
+
+CSV_COLUMNS = ['ID', 'DOI', 'Title', 'Journal']
+# Columnar formats also store the authors as a list.
+RECORD_SCHEMA = [('ID', 'string'), ('DOI', 'string'), ('Title', 'string'),
+                 ('Journal', 'string'), ('Authors', 'list<person>')]
 
-from teireader import TEIFile
 
 def set_up_argparser():
     parser = argparse.ArgumentParser()
     parser.add_argument('inputdir', help="input directory containing TEI XML files")
     parser.add_argument('outfile',
                         help="output file as CSV with information about the TEI articles")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS,
+                        help="output format, by default from the outfile extension or csv")
+    parser.add_argument('--parser', choices=PARSERS, default='soup',
+                        help="TEI parser backend: lxml streams the teiHeader, "
+                             "header stops reading at </teiHeader>")
+    parser.add_argument('--cache',
+                        help="SQLite file to cache parsed TEI fields across runs")
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help="maximal size of the cache in MB")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only process new or changed TEI files and merge "
+                             "them into the existing output")
+    parser.add_argument('--workers', type=int,
+                        help="number of worker processes, by default the number of CPUs")
+    parser.add_argument('--chunksize', type=int, default=16,
+                        help="number of TEI files sent to a worker at once")
+    parser.add_argument('--maxtasksperchild', type=int,
+                        help="replace a worker after so many chunks, e.g. to "
+                             "bound its memory")
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help="read up to so many input files at once ahead of "
+                             "the workers, e.g. on slow network storage")
+    parser.add_argument('--ordered', action='store_true',
+                        help="write rows in the order of the TEI file names")
+    parser.add_argument('--checkpoint', action='store_true',
+                        help="keep the rows of finished batches next to the "
+                             "output and resume a stopped run from them")
+    parser.add_argument('--retry-failed', action='store_true',
+                        help="only process the TEI files that failed in the "
+                             "last run and merge them into the existing output")
+    parser.add_argument('--shard', type=parse_shard,
+                        help="only process shard i/N of the TEI files, e.g. on "
+                             "one of N hosts, into a shard of the output to "
+                             "merge with sharding.py", metavar='i/N')
+    parser.add_argument('--progress-interval', type=float,
+                        default=DEFAULT_INTERVAL,
+                        help="seconds between progress reports")
+    parser.add_argument('--progress-log',
+                        help="append progress reports to this file instead of "
+                             "stderr")
+    parser.add_argument('--quiet', action='store_true',
+                        help="do not report progress")
+    parser.add_argument('--timings', action='store_true',
+                        help="report the time per stage and the slowest files")
+    parser.add_argument('--slowest', type=int, default=10,
+                        help="number of slowest files to report with --timings")
+    parser.add_argument('--profile-dir',
+                        help="write a cProfile dump per worker process to this "
+                             "directory")
     return parser
 
 
@@ -19,30 +91,162 @@ def all_teis(input_dir):
     return sorted(Path(input_dir).glob('*.tei.xml'))
 
 
-def tei_to_csv_entry(tei_file):
-    tei = TEIFile(tei_file)
-    print(f"Handled {tei_file}")
-    return tei.basename(), tei.doi(), tei.title, tei.published_in()
+def init_worker(cache_file=None, cache_size=None, timings=False,
+                profile_dir=None):
+    # Open the cache connection once per worker, not per task.
+    open_cache(cache_file, cache_size)
+    init_timings(timings, profile_dir)
+
+
+def tei_to_csv_entry(tei_file, parser='soup', cache_file=None, cache_size=None):
+    with document(tei_file):
+        cache = open_cache(cache_file, cache_size)
+        tei = TEIFile(tei_file, parser, cache)
+        entry = tei.basename(), tei.doi(), tei.title, tei.published_in()
+        tei.update_cache()
+        return entry
+
+
+def tei_to_record(tei_file, parser='soup', cache_file=None, cache_size=None):
+    with document(tei_file):
+        cache = open_cache(cache_file, cache_size)
+        tei = TEIFile(tei_file, parser, cache)
+        record = {
+            'ID': tei.basename(),
+            'DOI': tei.doi(),
+            'Title': tei.title,
+            'Journal': tei.published_in(),
+            'Authors': [asdict(author) for author in tei.authors()]
+        }
+        tei.update_cache()
+        return record
+
+
+def tei_batch_to_csv_columns(tei_files, parser='soup', cache_file=None,
+                             cache_size=None):
+    # CSV rows of a batch of TEI files, as a list per column. TEI files
+    # that fail are left out and reported separately.
+    to_entry = partial(tei_to_csv_entry, parser=parser, cache_file=cache_file,
+                       cache_size=cache_size)
+    return rows_to_columns(CSV_COLUMNS, isolated(to_entry, tei_files))
+
+
+def tei_batch_to_record_columns(tei_files, parser='soup', cache_file=None,
+                                cache_size=None):
+    to_record = partial(tei_to_record, parser=parser, cache_file=cache_file,
+                        cache_size=cache_size)
+    columns = [name for name, _ in RECORD_SCHEMA]
+    return records_to_columns(columns, isolated(to_record, tei_files))
 
 
 def main():
     parser = set_up_argparser()
     args = parser.parse_args()
-    
-    result_csv = pd.DataFrame(columns=['ID', 'DOI','Title', 'Journal'])
+
+    file_format = output_format(args.outfile, args.format)
+    for option in ['incremental', 'checkpoint', 'retry_failed']:
+        if getattr(args, option) and file_format != 'csv':
+            parser.error(f"--{option.replace('_', '-')} only supports csv output")
+    if args.incremental and args.retry_failed:
+        parser.error("--retry-failed cannot be combined with --incremental")
 
     teis = all_teis(args.inputdir)
+    input_count = len(teis)
+    if args.shard:
+        # Outputs, manifests and checkpoints of a shard are its own.
+        teis = shard_teis(teis, *args.shard)
+        args.outfile = shard_path(args.outfile, *args.shard)
+    all_shard_teis = teis
+    deleted_teis = []
+    if args.incremental:
+        manifest = load_manifest(args.outfile, {'parser': args.parser})
+        teis, deleted_teis = changed_teis(manifest, teis, lambda tei: [tei])
+    if args.retry_failed:
+        failed = set(Path(error.file).name for error in read_errors(args.outfile))
+        teis = [tei for tei in teis if tei.name in failed]
+    # TEI files whose rows replace those in the previous output.
+    processed_teis = teis
+    checkpoint = None
+    if args.checkpoint:
+        settings = {'inputdir': os.path.abspath(args.inputdir),
+                    'parser': args.parser, 'incremental': args.incremental,
+                    'retry_failed': args.retry_failed}
+        checkpoint = Checkpoint.open(args.outfile, settings)
+        teis = [tei for tei in teis if tei_id(tei) not in checkpoint.done]
+
+    cache_size = args.cache_size * 1024 ** 2
+    # Workers send back the results of a chunk of tasks at once, as columns.
+    if file_format == 'csv':
+        to_columns = tei_batch_to_csv_columns
+    else:
+        to_columns = tei_batch_to_record_columns
+    batch_task = partial(to_columns, parser=args.parser, cache_file=args.cache,
+                         cache_size=cache_size)
+    # Plain strings are cheaper to send to the workers than paths.
+    tasks = [str(tei) for tei in teis]
+    sizes = [task_size([tei]) for tei in teis]
+    prefetcher = None
+    if args.prefetch:
+        prefetcher = Prefetcher(lambda tei: [tei], args.prefetch)
+    stage_timings = StageTimings() if args.timings else None
+    progress = open_progress(len(teis), args.progress_interval,
+                             args.progress_log, args.quiet)
+    busy_times = {}
+    errors = []
+    start = time.perf_counter()
+    with create_pool(args.workers, args.maxtasksperchild, init_worker,
+                     (args.cache, cache_size, args.timings,
+                      args.profile_dir)) as pool, progress:
+        # Merging with the previous output needs the rows in order.
+        ordered = args.ordered or args.incremental or args.retry_failed
+        batches = imap_batches(pool, batch_task, tasks, sizes, args.chunksize,
+                               ordered, busy_times, prefetcher, stage_timings,
+                               progress, errors)
+        if file_format == 'csv':
+            row_batches = (list(columns_to_rows(batch)) for batch in batches)
+            if checkpoint is not None:
+                checkpoint_batches(checkpoint, row_batches, errors)
+                checkpoint.close()
+                errors = checkpoint.errors
+                entries = checkpoint.rows()
+                if ordered:
+                    # Rows of a resumed run follow those of the earlier runs.
+                    entries = sorted(entries, key=row_order)
+            else:
+                entries = itertools.chain.from_iterable(row_batches)
+            if args.incremental or args.retry_failed:
+                entries = merge_with_previous(
+                    args.outfile, entries, processed_teis, deleted_teis)
+            write_csv(args.outfile, CSV_COLUMNS, entries)
+        else:
+            write_column_batches(args.outfile, file_format, RECORD_SCHEMA,
+                                 batches)
+        # Leaving the block terminates the workers, e.g. after an error.
+        # Otherwise let them finish cleanly.
+        pool.close()
+        pool.join()
+        progress.finish()
+    report_busy_times(busy_times, time.perf_counter() - start)
+    if stage_timings is not None:
+        stage_timings.report(args.slowest)
+    write_errors(args.outfile, errors)
+    report_errors(args.outfile, errors)
+    if checkpoint is not None:
+        checkpoint.remove()
+    print(f"Done with {file_format}")
+    if args.incremental:
+        # Failed TEI files count as changed in the next run.
+        manifest.remove(set(Path(error.file).name for error in errors))
+        manifest.save(manifest_path(args.outfile))
+    if args.shard:
+        write_shard_manifest(args.outfile, args.shard, file_format,
+                             {'tool': 'main', 'parser': args.parser},
+                             ordered, all_shard_teis, input_count, errors)
 
-    pool = Pool()
-    csv_entries = pool.map(tei_to_csv_entry, teis)
-    print(csv_entries)
-    
-    print("Done with parsing")
-    result_csv = pd.DataFrame(csv_entries, columns=['ID', 'DOI','Title', 'Journal'])
-    print("Done with appending")
+    if args.cache:
+        # Evict entries beyond the cache size.
+        ParseCache(args.cache, cache_size).close()
 
-    result_csv.to_csv(args.outfile, index=False)
-    print("Done with csv")
 
 if __name__ == '__main__':
     main()
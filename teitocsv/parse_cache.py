@@ -0,0 +1,146 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+import zlib
+from functools import lru_cache
+
+from prefetch import prefetched_bytes
+
+
+# Bump when the extraction of any cached field changes, so that old
+# entries are parsed again.
+CACHE_VERSION = 3
+
+DEFAULT_MAX_SIZE = 1024 ** 3
+# Evict least recently used entries every so many writes.
+EVICT_EVERY = 100
+
+
+def bytes_digest(contents):
+    return hashlib.blake2b(contents, digest_size=16).hexdigest()
+
+
+def file_digest(filename, chunk_size=1024 * 1024):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as content:
+        for chunk in iter(lambda: content.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_stat(filename):
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class ParseCache(object):
+    def __init__(self, filename, max_size=DEFAULT_MAX_SIZE):
+        # Fields extracted from a file, keyed by kind and path. An entry is
+        # valid as long as size and mtime, or otherwise the content hash of
+        # the file are unchanged.
+        self.filename = filename
+        self.max_size = max_size
+        self._writes = 0
+        self.connection = sqlite3.connect(str(filename), timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'kind TEXT, path TEXT, version INTEGER, size INTEGER, '
+            'mtime INTEGER, digest TEXT, data BLOB, nbytes INTEGER, '
+            'accessed REAL, PRIMARY KEY (kind, path))')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self.connection.commit()
+
+    def get(self, path, kind):
+        contents = prefetched_bytes(path)
+        path = os.path.abspath(path)
+        row = self.connection.execute(
+            'SELECT version, size, mtime, digest, data FROM entries '
+            'WHERE kind = ? AND path = ?', (kind, path)).fetchone()
+        if not row:
+            return None
+        version, size, mtime, digest, data = row
+        if version != CACHE_VERSION:
+            return None
+
+        if contents is not None:
+            # Read ahead from slow storage: compare the prefetched content
+            # instead of touching the file again.
+            if len(contents) != size or bytes_digest(contents) != digest:
+                return None
+            current_mtime = mtime
+        else:
+            current_size, current_mtime = file_stat(path)
+            if current_size != size:
+                return None
+            if current_mtime != mtime:
+                # Touched but possibly unchanged: compare the content.
+                if file_digest(path) != digest:
+                    return None
+        with self.connection:
+            self.connection.execute(
+                'UPDATE entries SET mtime = ?, accessed = ? '
+                'WHERE kind = ? AND path = ?',
+                (current_mtime, time.time(), kind, path))
+        return pickle.loads(zlib.decompress(data))
+
+    def put(self, path, kind, fields):
+        contents = prefetched_bytes(path)
+        path = os.path.abspath(path)
+        if contents is not None:
+            # Without an mtime, the first get without prefetching compares
+            # the content once and stores the mtime.
+            size, mtime, digest = len(contents), None, bytes_digest(contents)
+        else:
+            size, mtime = file_stat(path)
+            digest = file_digest(path)
+        data = zlib.compress(
+            pickle.dumps(fields, protocol=pickle.HIGHEST_PROTOCOL))
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (kind, path, CACHE_VERSION, size, mtime, digest, data,
+                 len(data), time.time()))
+        self._writes += 1
+        if self._writes % EVICT_EVERY == 0:
+            self.evict()
+
+    def size(self):
+        (total, ) = self.connection.execute(
+            'SELECT COALESCE(SUM(nbytes), 0) FROM entries').fetchone()
+        return total
+
+    def evict(self):
+        # Drop outdated entries, then least recently used ones until the
+        # cache fits into max_size.
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM entries WHERE version != ?', (CACHE_VERSION, ))
+            excess = self.size() - self.max_size
+            if excess <= 0:
+                return
+            rows = self.connection.execute(
+                'SELECT kind, path, nbytes FROM entries ORDER BY accessed')
+            evicted = []
+            for kind, path, nbytes in rows:
+                if excess <= 0:
+                    break
+                evicted.append((kind, path))
+                excess -= nbytes
+            self.connection.executemany(
+                'DELETE FROM entries WHERE kind = ? AND path = ?', evicted)
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+
+
+@lru_cache(maxsize=None)
+def open_cache(filename, max_size=DEFAULT_MAX_SIZE):
+    # One cache connection per process, e.g. per pool worker.
+    if not filename:
+        return None
+    return ParseCache(filename, max_size)
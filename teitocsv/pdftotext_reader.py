@@ -1,7 +1,16 @@
+import mmap
 import re
 import itertools
 
 from bacteria_regex import BacteriaMatcher
+from prefetch import prefetched_bytes
+from stage_timings import timed
+
+# Bytes of a pdftotext file read first to find the leading words. Grows as
+# long as the file has more words and the head is too short.
+HEAD_SIZE = 16 * 1024
+WORD_DELIMITERS = re.compile(rb'[ \n]')
+
 
 def read_text_file(filename, delimiter=' ', strip='\n'):
     with open(filename, 'rb') as txt:
@@ -12,6 +21,26 @@ def read_text_file(filename, delimiter=' ', strip='\n'):
         return delimiter.join(res)
 
 
+def map_file(filename):
+    # Read-only memory map of the file, or empty bytes for an empty file.
+    # Prefetched contents are used as they are.
+    contents = prefetched_bytes(filename)
+    if contents is not None:
+        return contents
+    with open(filename, 'rb') as txt:
+        if not txt.seek(0, 2):
+            return b''
+        return mmap.mmap(txt.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def decode_lines(data, final=True):
+    # Same as read_text_file on the bytes of a file. Without final, the data
+    # is only the start of the file and a last line break is kept.
+    if final and data.endswith(b'\n'):
+        data = data[:-1]
+    return data.replace(b'\n', b' ').decode('utf-8', 'ignore')
+
+
 def digital_object_identifier(text):
     pattern = r'\b(10[.][0-9]{4,}(?:[.][0-9]+)*/(?:(?!["&\'<>])\S)+)\b'
     regex = re.compile(pattern)
@@ -25,22 +54,87 @@ def digital_object_identifier(text):
 
 
 class PDFToText(object):
-    def __init__(self, filename):
+    __slots__ = ['filename', 'cache', '_data', '_text', '_fields',
+                 '_fields_changed']
+
+    def __init__(self, filename, cache=None):
+        # The file is mapped and only decoded if a field needs the full text.
         self.filename = filename
-        self.text = read_text_file(filename)
+        self.cache = cache
+        self._data = None
+        self._text = None
+        self._fields = {}
+        self._fields_changed = False
+        if cache is not None:
+            self._fields = cache.get(filename, 'pdftotext') or {}
+
+    def update_cache(self):
+        if self.cache is not None and self._fields_changed:
+            self.cache.put(self.filename, 'pdftotext', self._fields)
+            self._fields_changed = False
+
+    def _field(self, name, extract):
+        # Extracted once, including empty values.
+        if name not in self._fields:
+            with timed(f'pdftotext_{name}'):
+                self._fields[name] = extract()
+            self._fields_changed = True
+        return self._fields[name]
+
+    @property
+    def data(self):
+        if self._data is None:
+            with timed('pdftotext_map', lambda: len(self._data)):
+                self._data = map_file(self.filename)
+        return self._data
+
+    @property
+    def text(self):
+        # Same as read_text_file.
+        if self._text is None:
+            data = self.data
+            with timed('pdftotext_decode', lambda: len(data)):
+                self._text = decode_lines(data[:])
+        return self._text
 
     def accession_numbers(self):
-        return BacteriaMatcher.accession_numbers(self.text)
+        return self._field('accession_numbers',
+                           self._extract_accession_numbers)
+
+    def _extract_accession_numbers(self):
+        matcher = BacteriaMatcher.accession_no_matcher
+        if self._text is None and matcher.scans_bytes(self.data):
+            # Scan the mapped file without decoding it.
+            return matcher.accession_numbers(self.data)
+        return matcher.accession_numbers(self.text)
 
     def text_until(self, word_count=1000, delimiter=' '):
         if not word_count:
             raise RuntimeError("Word count needs to be a positive number")
+        if delimiter == ' ' and self._text is None:
+            return self._head_until(word_count)
         words = self.text.split(delimiter)
         sliced_words = itertools.islice(words, word_count)
         return delimiter.join(sliced_words)
 
+    def _head_until(self, word_count):
+        # Text before the word_count-th space, decoding only the head of the
+        # file. Line breaks become spaces in the text.
+        data = self.data
+        size = HEAD_SIZE
+        while True:
+            head = data[:size]
+            delimiters = WORD_DELIMITERS.finditer(head)
+            end = next(itertools.islice(delimiters, word_count - 1, None), None)
+            if end:
+                return decode_lines(head[:end.start()], final=False)
+            if size >= len(data):
+                return decode_lines(head)
+            size *= 4
+
     def doi(self):
+        return self._field('doi', self._extract_doi)
+
+    def _extract_doi(self):
         text = self.text_until(1000)
         return digital_object_identifier(text)
-
-
@@ -0,0 +1,325 @@
+import csv
+import itertools
+import json
+import os
+import time
+from dataclasses import dataclass
+from functools import partial
+from multiprocessing.pool import Pool
+from pathlib import Path
+
+from failures import collect_errors
+from prefetch import PrefetchedBatch
+from stage_timings import collect_timings
+
+
+OUTPUT_FORMATS = ['csv', 'jsonl', 'parquet', 'arrow']
+SUFFIX_FORMATS = {
+    '.jsonl': 'jsonl',
+    '.parquet': 'parquet',
+    '.arrow': 'arrow',
+    '.feather': 'arrow'
+}
+# Records per Parquet row group or Arrow record batch.
+ROW_GROUP_SIZE = 10000
+
+
+def create_pool(workers=None, maxtasksperchild=None, initializer=None,
+                initargs=()):
+    # workers defaults to the number of CPUs. With maxtasksperchild, workers
+    # are replaced after so many tasks and run the initializer again.
+    if workers is not None and workers < 1:
+        raise RuntimeError(f"Need at least one worker, got {workers}")
+    if maxtasksperchild is not None and maxtasksperchild < 1:
+        raise RuntimeError(
+            f"Need at least one task per worker, got {maxtasksperchild}")
+    return Pool(workers, initializer, initargs, maxtasksperchild)
+
+
+def imap_results(pool, func, tasks, chunksize=1, ordered=False):
+    # Results as soon as workers finish them, or in the order of the tasks.
+    if ordered:
+        return pool.imap(func, tasks, chunksize)
+    else:
+        return pool.imap_unordered(func, tasks, chunksize)
+
+
+def task_size(files):
+    # Bytes of all existing input files of a task.
+    return sum(os.path.getsize(f) for f in files if os.path.exists(f))
+
+
+def size_chunks(tasks, sizes, chunksize=1):
+    # Longest processing time first: dispatch the largest tasks first, so
+    # that no large task is left for the end of the run while the other
+    # workers idle. A chunk holds up to chunksize tasks but not much more
+    # than the average bytes of a chunk, so large tasks travel alone.
+    order = sorted(range(len(tasks)), key=lambda i: sizes[i], reverse=True)
+    number_of_chunks = -(-len(tasks) // chunksize)
+    budget = sum(sizes) / number_of_chunks if number_of_chunks else 0
+    chunks = []
+    chunk = []
+    chunk_bytes = 0
+    for i in order:
+        chunk.append(tasks[i])
+        chunk_bytes += sizes[i]
+        if len(chunk) == chunksize or chunk_bytes >= budget:
+            chunks.append(chunk)
+            chunk = []
+            chunk_bytes = 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def name_chunks(tasks, chunksize=1):
+    return [tasks[i:i + chunksize] for i in range(0, len(tasks), chunksize)]
+
+
+@dataclass
+class BatchResult:
+    pid: int
+    tasks: int
+    seconds: float
+    result: object
+    timings: list
+    errors: list
+
+
+def run_batch(batch_func, chunk):
+    start = time.perf_counter()
+    result = batch_func(chunk)
+    seconds = time.perf_counter() - start
+    return BatchResult(os.getpid(), len(chunk), seconds, result,
+                       collect_timings(), collect_errors())
+
+
+def map_tasks(func, chunk):
+    return [func(task) for task in chunk]
+
+
+def imap_batches(pool, batch_func, tasks, sizes, chunksize=1, ordered=False,
+                 busy_times=None, prefetcher=None, stage_timings=None,
+                 progress=None, errors=None):
+    # Results of batch_func on chunks of up to chunksize tasks, one result
+    # per chunk. Largest tasks first with results as soon as workers finish
+    # them, or in the order of the tasks. busy_times sums up the seconds
+    # each worker process spends on tasks. With a Prefetcher, the files of
+    # the tasks are read ahead in the main process and sent along with the
+    # tasks. stage_timings collects the timings of workers that record them,
+    # progress counts the finished tasks and errors collects the failures
+    # of tasks that batch_func skipped.
+    if busy_times is None:
+        busy_times = {}
+    tasks = list(tasks)
+    if ordered:
+        chunks = name_chunks(tasks, chunksize)
+    else:
+        chunks = size_chunks(tasks, sizes, chunksize)
+    if prefetcher is not None:
+        chunks = prefetcher.prefetch_chunks(chunks)
+        batch_func = PrefetchedBatch(batch_func)
+    if ordered:
+        results = pool.imap(partial(run_batch, batch_func), chunks)
+    else:
+        results = pool.imap_unordered(partial(run_batch, batch_func), chunks)
+    for batch in results:
+        busy_times[batch.pid] = busy_times.get(batch.pid, 0) + batch.seconds
+        if stage_timings is not None:
+            stage_timings.add(batch.timings)
+        if progress is not None:
+            progress.update(batch.tasks, len(batch.errors))
+        if errors is not None:
+            errors.extend(batch.errors)
+        yield batch.result
+
+
+def imap_scheduled(pool, func, tasks, sizes, chunksize=1, ordered=False,
+                   busy_times=None, prefetcher=None, stage_timings=None,
+                   progress=None):
+    # Same as imap_batches with the result of func for each task.
+    batches = imap_batches(pool, partial(map_tasks, func), tasks, sizes,
+                           chunksize, ordered, busy_times, prefetcher,
+                           stage_timings, progress)
+    for results in batches:
+        yield from results
+
+
+def rows_to_columns(columns, rows):
+    # Rows as a list of values per column, which is smaller and faster to
+    # send between processes than the rows.
+    batch = {column: [] for column in columns}
+    values = list(batch.values())
+    for row in rows:
+        for column_values, value in zip(values, row):
+            column_values.append(value)
+    return batch
+
+
+def records_to_columns(columns, records):
+    rows = ([record[column] for column in columns] for record in records)
+    return rows_to_columns(columns, rows)
+
+
+def columns_to_rows(batch):
+    return zip(*batch.values())
+
+
+def columns_to_records(batch):
+    columns = list(batch)
+    for row in zip(*batch.values()):
+        yield dict(zip(columns, row))
+
+
+def column_groups(batches, size=ROW_GROUP_SIZE):
+    # Column batches regrouped into batches of size rows and a last smaller
+    # one.
+    group = None
+    rows = 0
+    for batch in batches:
+        if group is None:
+            group = {column: [] for column in batch}
+        for column, values in batch.items():
+            group[column].extend(values)
+        rows += len(next(iter(batch.values()), []))
+        while rows >= size:
+            yield {column: values[:size] for column, values in group.items()}
+            group = {column: values[size:] for column, values in group.items()}
+            rows -= size
+    if rows:
+        yield group
+
+
+def report_busy_times(busy_times, wall_time):
+    # Workers that idle while others are still busy show up as low
+    # utilization.
+    for worker, (pid, seconds) in enumerate(sorted(busy_times.items())):
+        utilization = seconds / wall_time if wall_time else 0
+        print(f"Worker {worker} (pid {pid}) busy {seconds:.2f}s "
+              f"of {wall_time:.2f}s ({utilization:.0%})")
+
+
+def write_csv(outfile, columns, rows):
+    # Write rows as they arrive into a temporary file, which replaces the
+    # output when complete. Same format as DataFrame.to_csv(index=False).
+    tmp_outfile = f'{outfile}.tmp'
+    with open(tmp_outfile, 'w', newline='', encoding='utf-8') as csv_file:
+        writer = csv.writer(csv_file, lineterminator='\n')
+        writer.writerow(columns)
+        writer.writerows(rows)
+    os.replace(tmp_outfile, outfile)
+
+
+def read_csv_rows(csv_filename):
+    with open(csv_filename, newline='', encoding='utf-8') as csv_file:
+        reader = csv.reader(csv_file)
+        # Skip the header.
+        next(reader, None)
+        yield from reader
+
+
+def output_format(outfile, requested_format=None):
+    # Use the requested format, otherwise guess it from the file extension.
+    if requested_format:
+        return requested_format
+    return SUFFIX_FORMATS.get(Path(outfile).suffix.lower(), 'csv')
+
+
+def write_jsonl(outfile, records):
+    tmp_outfile = f'{outfile}.tmp'
+    with open(tmp_outfile, 'w', encoding='utf-8') as jsonl_file:
+        for record in records:
+            jsonl_file.write(json.dumps(record, ensure_ascii=False))
+            jsonl_file.write('\n')
+    os.replace(tmp_outfile, outfile)
+
+
+def arrow_schema(schema):
+    # schema is a list of (name, type) with the types string, bool, int64,
+    # list<string> and list<person>.
+    import pyarrow as pa
+
+    person = pa.struct([('firstname', pa.string()),
+                        ('middlename', pa.string()),
+                        ('surname', pa.string())])
+    types = {
+        'string': pa.string(),
+        'bool': pa.bool_(),
+        'int64': pa.int64(),
+        'list<string>': pa.list_(pa.string()),
+        'list<person>': pa.list_(person)
+    }
+    return pa.schema([(name, types[type_name]) for name, type_name in schema])
+
+
+def record_batches(records, size=ROW_GROUP_SIZE):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def open_arrow_writer(outfile, schema, file_format):
+    # A Parquet or Arrow IPC writer of the schema, with a table per write.
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError(
+            f"Writing {file_format} needs pyarrow: pip install pyarrow")
+
+    schema = arrow_schema(schema)
+    if file_format == 'parquet':
+        writer = pq.ParquetWriter(outfile, schema)
+    else:
+        writer = pa.ipc.new_file(outfile, schema)
+    return writer, schema
+
+
+def write_arrow(outfile, schema, records, file_format='parquet',
+                batch_size=ROW_GROUP_SIZE):
+    # Write records in batches, as Parquet row groups or as an Arrow IPC file.
+    tmp_outfile = f'{outfile}.tmp'
+    writer, schema = open_arrow_writer(tmp_outfile, schema, file_format)
+    import pyarrow as pa
+
+    with writer:
+        for batch in record_batches(records, batch_size):
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+    os.replace(tmp_outfile, outfile)
+
+
+def write_arrow_columns(outfile, schema, batches, file_format='parquet',
+                        batch_size=ROW_GROUP_SIZE):
+    # Same as write_arrow for the records of column batches.
+    tmp_outfile = f'{outfile}.tmp'
+    writer, schema = open_arrow_writer(tmp_outfile, schema, file_format)
+    import pyarrow as pa
+
+    with writer:
+        for group in column_groups(batches, batch_size):
+            writer.write_table(pa.Table.from_pydict(group, schema=schema))
+    os.replace(tmp_outfile, outfile)
+
+
+def write_records(outfile, file_format, schema, records):
+    if file_format == 'jsonl':
+        write_jsonl(outfile, records)
+    elif file_format in ['parquet', 'arrow']:
+        write_arrow(outfile, schema, records, file_format)
+    else:
+        raise RuntimeError(f"Unknown output format {file_format}")
+
+
+def write_column_batches(outfile, file_format, schema, batches):
+    # Same as write_records for the records of column batches.
+    if file_format in ['parquet', 'arrow']:
+        write_arrow_columns(outfile, schema, batches, file_format)
+    else:
+        records = itertools.chain.from_iterable(
+            columns_to_records(batch) for batch in batches)
+        write_records(outfile, file_format, schema, records)
@@ -0,0 +1,147 @@
+import asyncio
+import io
+import itertools
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Contents of files read ahead of a task, by path, in each worker process.
+# Readers take the bytes from here instead of opening the file.
+_prefetched = {}
+
+# Files read at once and tasks read ahead of the pool.
+DEFAULT_CONCURRENCY = 16
+DEFAULT_BUFFERED = 64
+
+
+def open_binary(filename):
+    contents = _prefetched.get(os.fspath(filename))
+    if contents is not None:
+        return io.BytesIO(contents)
+    return open(filename, 'rb')
+
+
+def open_text(filename):
+    # Same as open(filename, 'r'), e.g. the same newline translation.
+    contents = _prefetched.get(os.fspath(filename))
+    if contents is not None:
+        return io.TextIOWrapper(io.BytesIO(contents))
+    return open(filename, 'r')
+
+
+def prefetched_bytes(filename):
+    return _prefetched.get(os.fspath(filename))
+
+
+def read_bytes(filename):
+    # Contents of the file, or None if it does not exist.
+    try:
+        with open(filename, 'rb') as content:
+            return content.read()
+    except FileNotFoundError:
+        return None
+
+
+class PrefetchedBatch(object):
+    def __init__(self, batch_func):
+        # Runs batch_func on a batch of tasks, with the prefetched contents
+        # of their files available to the readers.
+        self.batch_func = batch_func
+
+    def __call__(self, prefetched_tasks):
+        for _, contents in prefetched_tasks:
+            _prefetched.update((path, data) for path, data in contents.items()
+                               if data is not None)
+        try:
+            return self.batch_func([task for task, _ in prefetched_tasks])
+        finally:
+            _prefetched.clear()
+
+
+class _Failure(object):
+    def __init__(self, exception):
+        self.exception = exception
+
+
+_DONE = object()
+
+
+class Prefetcher(object):
+    def __init__(self, paths, concurrency=DEFAULT_CONCURRENCY,
+                 buffered=DEFAULT_BUFFERED, read_file=read_bytes):
+        # Reads the files paths(task) of tasks ahead of their processing.
+        # An event loop in a background thread reads up to concurrency files
+        # at once on threads, and up to buffered tasks ahead of the consumer.
+        self.paths = paths
+        self.concurrency = concurrency
+        self.buffered = buffered
+        self.read_file = read_file
+
+    def prefetch(self, tasks):
+        # Yield (task, contents) in the order of the tasks, where contents
+        # maps each file of the task to its bytes or None.
+        results = queue.Queue(maxsize=self.buffered)
+
+        def run():
+            try:
+                asyncio.run(_read_ahead(
+                    tasks, self.paths, self.read_file, self.concurrency,
+                    self.buffered, results))
+            except Exception as exception:
+                results.put(_Failure(exception))
+            else:
+                results.put(_DONE)
+
+        # A daemon, since a consumer that stops early leaves it blocked.
+        reader = threading.Thread(target=run, daemon=True)
+        reader.start()
+        while True:
+            result = results.get()
+            if result is _DONE:
+                break
+            if isinstance(result, _Failure):
+                raise result.exception
+            yield result
+        reader.join()
+
+    def prefetch_chunks(self, chunks):
+        # The same chunks of tasks, prefetched.
+        chunks = list(chunks)
+        prefetched = self.prefetch(itertools.chain.from_iterable(chunks))
+        for chunk in chunks:
+            yield list(itertools.islice(prefetched, len(chunk)))
+
+
+async def _read_ahead(tasks, paths, read_file, concurrency, buffered, results):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    readers = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def read(path):
+        async with semaphore:
+            return await loop.run_in_executor(readers, read_file, path)
+
+    async def read_task(task):
+        task_paths = [os.fspath(path) for path in paths(task)]
+        contents = await asyncio.gather(*(read(path) for path in task_paths))
+        return task, dict(zip(task_paths, contents))
+
+    async def put_oldest():
+        result = await pending.popleft()
+        # Blocks while the consumer is buffered tasks behind.
+        await loop.run_in_executor(None, results.put, result)
+
+    pending = deque()
+    try:
+        for task in tasks:
+            pending.append(asyncio.ensure_future(read_task(task)))
+            if len(pending) >= buffered:
+                await put_oldest()
+        while pending:
+            await put_oldest()
+    finally:
+        readers.shutdown(wait=False)
+
@@ -0,0 +1,87 @@
+import sys
+import time
+
+
+DEFAULT_INTERVAL = 10.0
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m"
+    if minutes:
+        return f"{minutes}m {seconds:02d}s"
+    return f"{seconds}s"
+
+
+class Progress(object):
+    def __init__(self, total, interval=DEFAULT_INTERVAL, stream=None,
+                 clock=time.monotonic, close_stream=False):
+        # Counts of handled files, reported at most every interval seconds
+        # to stream. Without a stream nothing is reported.
+        self.total = total
+        self.interval = interval
+        self.stream = stream
+        self.close_stream = close_stream
+        self.clock = clock
+        self.done = 0
+        self.errors = 0
+        self.start = clock()
+        self._last_report = self.start
+
+    def update(self, done=1, errors=0):
+        self.done += done
+        self.errors += errors
+        now = self.clock()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self.report(now)
+
+    def status(self, now=None):
+        if now is None:
+            now = self.clock()
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0
+        share = self.done / self.total if self.total else 1
+        line = (f"Handled {self.done}/{self.total} files ({share:.1%}), "
+                f"{rate:.1f} files/s")
+        if rate and self.done < self.total:
+            eta = (self.total - self.done) / rate
+            line += f", ETA {format_duration(eta)}"
+        else:
+            line += f", took {format_duration(elapsed)}"
+        return f"{line}, {self.errors} errors"
+
+    def report(self, now=None):
+        if self.stream is None:
+            return
+        print(self.status(now), file=self.stream, flush=True)
+
+    def finish(self):
+        self.report()
+        self.close()
+
+    def close(self):
+        # Close a log file, also when the run fails before finish.
+        if self.close_stream:
+            self.close_stream = False
+            self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_progress(total, interval=DEFAULT_INTERVAL, log_file=None,
+                  quiet=False):
+    # Progress to stderr, appended to log_file, or silent.
+    if quiet:
+        return Progress(total, interval)
+    if log_file:
+        stream = open(log_file, 'a', encoding='utf-8')
+        return Progress(total, interval, stream, close_stream=True)
+    return Progress(total, interval, sys.stderr)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+import argparse
+import csv
+import hashlib
+import heapq
+import itertools
+import json
+import os
+from pathlib import Path
+
+from failures import errors_path, read_errors, report_errors, write_errors
+from incremental import Manifest, manifest_path, row_order
+from pipeline import (ROW_GROUP_SIZE, read_csv_rows, record_batches,
+                      write_csv, write_jsonl)
+
+
+def parse_shard(value):
+    # 'i/N' as (i, N) with 0 <= i < N, for argparse.
+    try:
+        index, count = (int(number) for number in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Shard {value} is not of the form i/N, e.g. 0/4")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(
+            f"Shard {value} needs 0 <= i < N")
+    return index, count
+
+
+def shard_of(tei_file, count):
+    # Same shard for the same file name on every host and run, unlike
+    # hash() which differs between processes.
+    name = Path(tei_file).name.encode('utf-8')
+    digest = hashlib.blake2b(name, digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count
+
+
+def shard_teis(teis, index, count):
+    return [tei for tei in teis if shard_of(tei, count) == index]
+
+
+def shard_path(outfile, index, count):
+    # Output of a shard next to the final output, with the same suffix,
+    # e.g. out.shard-0-of-4.csv for out.csv.
+    outfile = Path(outfile)
+    return str(outfile.with_name(
+        f'{outfile.stem}.shard-{index}-of-{count}{outfile.suffix}'))
+
+
+def shard_manifest_path(shard_file):
+    return f'{shard_file}.shard.json'
+
+
+def write_shard_manifest(shard_file, shard, file_format, settings, ordered,
+                         teis, inputs, errors):
+    # What a shard run wrote, for merge_shards. settings tell runs of
+    # different tools or options apart, but hold no paths, which may differ
+    # between hosts. inputs is the number of TEI files of all shards.
+    index, count = shard
+    manifest = {'shard': index, 'shards': count, 'format': file_format,
+                'settings': settings, 'ordered': ordered,
+                'teis': sorted(Path(tei).name for tei in teis),
+                'inputs': inputs, 'errors': len(errors)}
+    tmp_filename = f'{shard_manifest_path(shard_file)}.tmp'
+    with open(tmp_filename, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.replace(tmp_filename, shard_manifest_path(shard_file))
+
+
+def read_shard_manifests(outfile, count):
+    manifests = []
+    for index in range(count):
+        filename = shard_manifest_path(shard_path(outfile, index, count))
+        if not os.path.exists(filename):
+            raise RuntimeError(
+                f"Shard {index}/{count} of {outfile} is missing: run it with "
+                f"--shard {index}/{count}")
+        with open(filename) as manifest_file:
+            manifests.append(json.load(manifest_file))
+
+    first = manifests[0]
+    for manifest in manifests[1:]:
+        for key in ['format', 'settings', 'inputs']:
+            if manifest[key] != first[key]:
+                raise RuntimeError(
+                    f"Shard {manifest['shard']}/{count} has {key} "
+                    f"{manifest[key]}, but shard 0/{count} {first[key]}")
+    # The shards of one input split its TEI files by name.
+    names = [name for manifest in manifests for name in manifest['teis']]
+    if len(names) != len(set(names)):
+        raise RuntimeError(f"Shards of {outfile} share TEI files")
+    if len(names) != first['inputs']:
+        raise RuntimeError(
+            f"Shards of {outfile} have {len(names)} of {first['inputs']} TEI "
+            f"files: were they run on different inputs?")
+    return manifests
+
+
+def csv_header(csv_filename):
+    with open(csv_filename, newline='', encoding='utf-8') as csv_file:
+        return next(csv.reader(csv_file), [])
+
+
+def read_jsonl(jsonl_filename):
+    with open(jsonl_filename, encoding='utf-8') as jsonl_file:
+        for line in jsonl_file:
+            yield json.loads(line)
+
+
+def record_order(record):
+    return row_order([record['ID']])
+
+
+def _import_pyarrow(file_format):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError(
+            f"Merging {file_format} needs pyarrow: pip install pyarrow")
+    return pa, pq
+
+
+def arrow_batches(filename, file_format):
+    pa, pq = _import_pyarrow(file_format)
+    if file_format == 'parquet':
+        parquet_file = pq.ParquetFile(filename)
+        return parquet_file.schema_arrow, parquet_file.iter_batches(
+            ROW_GROUP_SIZE)
+    reader = pa.ipc.open_file(filename)
+    return reader.schema, (reader.get_batch(number)
+                           for number in range(reader.num_record_batches))
+
+
+def merge_arrow(outfile, shard_files, file_format, ordered):
+    # Batches of the shards one after another, or merged by ID as records.
+    pa, pq = _import_pyarrow(file_format)
+    shards = [arrow_batches(shard_file, file_format)
+              for shard_file in shard_files]
+    schema = shards[0][0]
+    tmp_outfile = f'{outfile}.tmp'
+    if file_format == 'parquet':
+        writer = pq.ParquetWriter(tmp_outfile, schema)
+    else:
+        writer = pa.ipc.new_file(tmp_outfile, schema)
+    with writer:
+        if ordered:
+            records = heapq.merge(*(
+                (record for batch in batches for record in batch.to_pylist())
+                for _, batches in shards), key=record_order)
+            for batch in record_batches(records):
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+        else:
+            for _, batches in shards:
+                for batch in batches:
+                    writer.write_table(pa.Table.from_batches([batch], schema))
+    os.replace(tmp_outfile, outfile)
+
+
+def merge_outputs(outfile, shard_files, file_format, ordered):
+    # With all shards ordered, the output is in the order of an unsharded
+    # ordered run. Otherwise shard after shard.
+    if file_format == 'csv':
+        columns = csv_header(shard_files[0])
+        if any(csv_header(shard_file) != columns
+               for shard_file in shard_files[1:]):
+            raise RuntimeError(f"Shards of {outfile} have different columns")
+        shards = [read_csv_rows(shard_file) for shard_file in shard_files]
+        if ordered:
+            rows = heapq.merge(*shards, key=row_order)
+        else:
+            rows = itertools.chain.from_iterable(shards)
+        write_csv(outfile, columns, rows)
+    elif file_format == 'jsonl':
+        shards = [read_jsonl(shard_file) for shard_file in shard_files]
+        if ordered:
+            records = heapq.merge(*shards, key=record_order)
+        else:
+            records = itertools.chain.from_iterable(shards)
+        write_jsonl(outfile, records)
+    else:
+        merge_arrow(outfile, shard_files, file_format, ordered)
+
+
+def merge_manifests(outfile, shard_files):
+    # Manifests of incremental shard runs as one for outfile, so that a
+    # later unsharded --incremental run only processes changed files.
+    filenames = [manifest_path(shard_file) for shard_file in shard_files]
+    if not all(os.path.exists(filename) for filename in filenames):
+        # A manifest of an earlier merge no longer describes the output.
+        if os.path.exists(manifest_path(outfile)):
+            os.remove(manifest_path(outfile))
+        return False
+    manifests = []
+    for filename in filenames:
+        with open(filename) as manifest_file:
+            manifests.append(json.load(manifest_file))
+    settings = manifests[0]['settings']
+    if any(manifest['settings'] != settings for manifest in manifests[1:]):
+        # E.g. the pdftotexts directories of different hosts. A later
+        # incremental run then processes all files again.
+        if os.path.exists(manifest_path(outfile)):
+            os.remove(manifest_path(outfile))
+        return False
+    entries = {}
+    for manifest in manifests:
+        entries.update(manifest['entries'])
+    Manifest(settings, entries).save(manifest_path(outfile))
+    return True
+
+
+def shard_files_of(outfile, count):
+    return [shard_path(outfile, index, count) for index in range(count)]
+
+
+def remove_shards(outfile, count):
+    for shard_file in shard_files_of(outfile, count):
+        for filename in [shard_file, shard_manifest_path(shard_file),
+                         manifest_path(shard_file), errors_path(shard_file)]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+def merge_shards(outfile, count):
+    # Combine the outputs, failures and manifests of all count shards of
+    # outfile. Returns the failures.
+    manifests = read_shard_manifests(outfile, count)
+    shard_files = shard_files_of(outfile, count)
+    file_format = manifests[0]['format']
+    ordered = all(manifest['ordered'] for manifest in manifests)
+    merge_outputs(outfile, shard_files, file_format, ordered)
+    errors = [error for shard_file in shard_files
+              for error in read_errors(shard_file)]
+    write_errors(outfile, errors)
+    merge_manifests(outfile, shard_files)
+    return errors
+
+
+def set_up_argparser():
+    parser = argparse.ArgumentParser(
+        description="Merge the outputs of bacteriacsv.py or main.py runs with "
+                    "--shard i/N into one output")
+    parser.add_argument('outfile', help="output file the shards were run with")
+    parser.add_argument('shards', type=int, help="number of shards N")
+    parser.add_argument('--remove', action='store_true',
+                        help="remove the shard outputs after merging")
+    return parser
+
+
+def main():
+    args = set_up_argparser().parse_args()
+    errors = merge_shards(args.outfile, args.shards)
+    report_errors(args.outfile, errors)
+    if args.remove:
+        remove_shards(args.outfile, args.shards)
+    print(f"Merged {args.shards} shards into {args.outfile}")
+
+
+if __name__ == '__main__':
+    main()
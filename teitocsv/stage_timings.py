@@ -0,0 +1,228 @@
+import cProfile
+import os
+import time
+from contextlib import contextmanager
+from multiprocessing.util import Finalize
+
+
+# Timings of the documents handled by this process since the last
+# collect_timings(), or None unless enabled.
+_documents = None
+_document = None
+# Shared timings of the stages outside of any document, in _documents.
+_outside = None
+# Seconds spent in nested stages, per running stage.
+_running = []
+
+
+class DocumentTimings(object):
+    def __init__(self, name):
+        # Seconds and bytes per stage of one document. Stages only count
+        # their own time, not that of stages nested in them. counts holds
+        # other counters, e.g. hits and misses of a memo.
+        self.name = name
+        self.seconds = {}
+        self.bytes = {}
+        self.counts = {}
+
+    def add(self, stage, seconds, size=None):
+        self.seconds[stage] = self.seconds.get(stage, 0) + seconds
+        if size is not None:
+            self.bytes[stage] = self.bytes.get(stage, 0) + size
+
+    def count(self, name, number=1):
+        self.counts[name] = self.counts.get(name, 0) + number
+
+    def total(self):
+        return sum(self.seconds.values())
+
+
+def enable_timings():
+    global _documents, _outside
+    _documents = []
+    _outside = None
+
+
+def disable_timings():
+    # Drop the timings recorded so far and stop recording.
+    global _documents, _outside
+    _documents = None
+    _outside = None
+
+
+def timings_enabled():
+    return _documents is not None
+
+
+@contextmanager
+def document(name):
+    # Attribute the stages within to the document name.
+    global _document
+    if _documents is None:
+        yield
+        return
+    previous = _document
+    _document = DocumentTimings(name)
+    try:
+        yield
+    finally:
+        _documents.append(_document)
+        _document = previous
+
+
+@contextmanager
+def timed(stage, size=None):
+    # Time a stage of the current document. size is called at the end for
+    # the bytes the stage handled, and only if timings are enabled.
+    if _documents is None:
+        yield
+        return
+    _running.append(0)
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        nested = _running.pop()
+        if _running:
+            _running[-1] += seconds
+        _current().add(stage, seconds - nested,
+                       size() if size and not failed else None)
+
+
+def _current():
+    global _outside
+    if _document is None:
+        # Stages outside of a document, e.g. in library use, add up in a
+        # single entry.
+        if _outside is None:
+            _outside = DocumentTimings('')
+            _documents.append(_outside)
+        return _outside
+    return _document
+
+
+def count(name, number=1):
+    # Add to a counter of the current document, if timings are enabled.
+    if _documents is not None:
+        _current().count(name, number)
+
+
+def collect_timings():
+    # Timings recorded since the last call, to send to the main process.
+    global _documents, _outside
+    if _documents is None:
+        return []
+    documents = _documents
+    _documents = []
+    _outside = None
+    return documents
+
+
+def start_profile(directory):
+    # Profile the rest of this process into directory/worker-<pid>.prof,
+    # written when the process exits cleanly.
+    profile = cProfile.Profile()
+    filename = os.path.join(directory, f'worker-{os.getpid()}.prof')
+
+    def dump():
+        profile.disable()
+        profile.dump_stats(filename)
+
+    os.makedirs(directory, exist_ok=True)
+    Finalize(profile, dump, exitpriority=10)
+    profile.enable()
+    return profile
+
+
+def init_timings(enabled=False, profile_dir=None):
+    # Set up a worker process for --timings and --profile-dir.
+    if enabled:
+        enable_timings()
+    if profile_dir:
+        start_profile(profile_dir)
+
+
+def percentile(values, share):
+    # Nearest-rank percentile of sorted values.
+    rank = max(1, -(-len(values) * share // 1))
+    return values[int(rank) - 1]
+
+
+class StageTimings(object):
+    def __init__(self):
+        # Timings of all documents, e.g. collected from the pool workers.
+        self.documents = []
+
+    def add(self, documents):
+        self.documents.extend(documents)
+
+    def stage_summary(self):
+        # Per stage: documents, total seconds, p50, p95, max and bytes.
+        seconds = {}
+        sizes = {}
+        for document_timings in self.documents:
+            for stage, stage_seconds in document_timings.seconds.items():
+                seconds.setdefault(stage, []).append(stage_seconds)
+            for stage, size in document_timings.bytes.items():
+                sizes[stage] = sizes.get(stage, 0) + size
+        summary = {}
+        for stage, values in seconds.items():
+            values.sort()
+            summary[stage] = {
+                'documents': len(values),
+                'seconds': sum(values),
+                'p50': percentile(values, 0.5),
+                'p95': percentile(values, 0.95),
+                'max': values[-1],
+                'bytes': sizes.get(stage)
+            }
+        return summary
+
+    def counts(self):
+        totals = {}
+        for document_timings in self.documents:
+            for name, number in document_timings.counts.items():
+                totals[name] = totals.get(name, 0) + number
+        return totals
+
+    def slowest(self, count=10):
+        return sorted(self.documents, key=DocumentTimings.total,
+                      reverse=True)[:count]
+
+    def report(self, slowest=10):
+        summary = self.stage_summary()
+        print("stage                         docs   total s    p50 ms    "
+              "p95 ms    max ms      MB/s")
+        for stage, stats in sorted(summary.items(),
+                                   key=lambda item: -item[1]['seconds']):
+            throughput = ''
+            if stats['bytes'] is not None and stats['seconds']:
+                megabytes = stats['bytes'] / 1024 ** 2
+                throughput = f"{megabytes / stats['seconds']:9.2f}"
+            print(f"{stage:<28} {stats['documents']:5d} "
+                  f"{stats['seconds']:9.3f} {stats['p50'] * 1000:9.2f} "
+                  f"{stats['p95'] * 1000:9.2f} {stats['max'] * 1000:9.2f} "
+                  f"{throughput}")
+        counts = self.counts()
+        for name, number in sorted(counts.items()):
+            print(f"{name:<28} {number:9d}")
+            # Counters name_hits and name_misses give a hit rate.
+            if name.endswith('_misses'):
+                hits = counts.get(f'{name[:-7]}_hits', 0)
+                if hits + number:
+                    print(f"{name[:-7] + '_hit_rate':<28} "
+                          f"{hits / (hits + number):9.1%}")
+        if slowest:
+            print(f"Slowest {slowest} files:")
+        for document_timings in self.slowest(slowest):
+            line = f"{document_timings.total():9.3f}s {document_timings.name}"
+            if document_timings.seconds:
+                stage = max(document_timings.seconds,
+                            key=document_timings.seconds.get)
+                line += f" (mostly {stage})"
+            print(line)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# Synthetic GROBID output for benchmarks: TEI XML files with a header,
+# abstract, body divs and references, and a pdftotext file per paper, e.g.
+#   python synthetic_corpus.py corpus/ --files 1000 --large-share 0.05
+import argparse
+import random
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+
+TEI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<TEI xml:space="preserve" xmlns="http://www.tei-c.org/ns/1.0" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xlink="http://www.w3.org/1999/xlink">
+	<teiHeader xml:lang="en">
+		<fileDesc>
+			<titleStmt>
+				<title level="a" type="main">{title}</title>
+			</titleStmt>
+			<publicationStmt>
+				<publisher/>
+				<availability status="unknown"><licence/></availability>
+			</publicationStmt>
+			<sourceDesc>
+				<biblStruct>
+					<analytic>
+{authors}
+						<title level="a" type="main">{title}</title>
+					</analytic>
+					<monogr>
+						<title level="j" type="main">{journal}</title>
+						<imprint><date type="published" when="{year}">{year}</date></imprint>
+					</monogr>
+{idno}
+				</biblStruct>
+			</sourceDesc>
+		</fileDesc>
+		<profileDesc>
+			<abstract>
+				<div xmlns="http://www.tei-c.org/ns/1.0"><p>{abstract}</p></div>
+			</abstract>
+		</profileDesc>
+	</teiHeader>
+	<text xml:lang="en">
+		<body>
+{divs}
+		</body>
+		<back>
+			<div type="references">
+				<listBibl>
+{references}
+				</listBibl>
+			</div>
+		</back>
+	</text>
+</TEI>"""
+
+AUTHOR_TEMPLATE = """						<author>
+							<persName xmlns="http://www.tei-c.org/ns/1.0"><forename type="first">{first}</forename><surname>{surname}</surname></persName>
+							<affiliation key="aff{number}"><orgName type="institution">University of {city}</orgName></affiliation>
+						</author>"""
+
+REFERENCE_TEMPLATE = """					<biblStruct xml:id="b{number}"><analytic><title level="a" type="main">{title}</title>{idno}</analytic><monogr><title level="j">{journal}</title><imprint><date type="published" when="{year}">{year}</date></imprint></monogr></biblStruct>"""
+
+FIRST_NAMES = ['Anna', 'Ben', 'Chen', 'Dana', 'Emil', 'Fatima', 'Goran',
+               'Hana', 'Ivo', 'Jana', 'Kofi', 'Lena', 'Mateo', 'Nina']
+SURNAMES = ['Aliyu', 'Berg', 'Costa', 'De Maayer', 'Eriksen', 'Fischer',
+            'García', 'Huber', 'Ito', 'Jensen', 'Kowalski', 'Müller']
+CITIES = ['Leipzig', 'Pretoria', 'Uppsala', 'Kyoto', 'Lisbon', 'Halle']
+JOURNALS = ['Standards in Genomic Sciences', 'Microbiome', 'ISME Journal',
+            'Environmental Microbiology', 'Frontiers in Microbiology']
+HEADS = ['Introduction', 'Materials and methods', 'Sampling',
+         'DNA extraction', 'Sequencing', 'Results', 'Discussion']
+
+# Sentences without any feature the matchers look for.
+FILLER = [
+    "Soil samples were collected from {number} sites across the region.",
+    "Community composition differed strongly between the sampled habitats.",
+    "Samples were stored at -80 °C until further processing.",
+    "Alpha diversity increased with the pH of the soil (p < 0.05).",
+    "We thank the field team for their help with the sampling campaign.",
+    "Taxa were assigned with a naïve Bayes classifier trained on SILVA.",
+    "Ordination revealed a clear separation of the rhizosphere samples.",
+]
+ACCESSIONS = [
+    "Reads were deposited in the SRA under accession PRJNA{number:06d}.",
+    "Raw sequences are available under SRR{number:07d} and SRR{next:07d}.",
+    "The data are available in the ENA under ERP{number:06d}.",
+    "Metagenomes are publicly available in MG-RAST.",
+]
+PRIMERS = [
+    "We amplified the V4 region of the 16S rRNA gene with primers 515F and 806R.",
+    "The V3-V4 region was amplified using the primer set 341F/806R.",
+    "PCR used the primers 515f (GTGYCAGCMGCCGCGGTAA) and 806rB.",
+]
+SEQUENCING = [
+    "Libraries were sequenced on an Illumina MiSeq with paired-end reads.",
+    "Amplicons were sequenced on the Illumina HiSeq 2500 platform.",
+]
+
+SMALL_DIVS = 5
+LARGE_DIVS = 400
+
+
+def paragraph(number, rng, sentences=4, accession_density=0.05,
+              primer_density=0.05):
+    # Filler sentences and, with the given probability per paragraph, a
+    # sentence with an accession number or with primers.
+    chosen = [rng.choice(FILLER) for _ in range(sentences)]
+    if rng.random() < accession_density:
+        chosen[rng.randrange(sentences)] = rng.choice(ACCESSIONS)
+    if rng.random() < primer_density:
+        chosen[rng.randrange(sentences)] = rng.choice(PRIMERS)
+        chosen.append(rng.choice(SEQUENCING))
+    return " ".join(sentence.format(number=number, next=number + 1)
+                    for sentence in chosen)
+
+
+def synthetic_paper(number, rng, divs=SMALL_DIVS, paragraphs_per_div=2,
+                    authors=4, references=20, accession_density=0.05,
+                    primer_density=0.05, has_doi=True):
+    # The TEI XML and the pdftotext text of a paper.
+    title = f"Synthetic paper {number} on soil bacteria"
+    journal = rng.choice(JOURNALS)
+    year = rng.randrange(1995, 2024)
+    doi = f"10.1234/bench.{number}"
+
+    author_elems = []
+    names = []
+    for author_number in range(authors):
+        first, surname = rng.choice(FIRST_NAMES), rng.choice(SURNAMES)
+        names.append(f"{first} {surname}")
+        author_elems.append(AUTHOR_TEMPLATE.format(
+            first=first, surname=escape(surname), number=author_number,
+            city=rng.choice(CITIES)))
+
+    def new_paragraph():
+        return paragraph(number, rng, accession_density=accession_density,
+                         primer_density=primer_density)
+
+    abstract = new_paragraph()
+    div_elems = []
+    body = []
+    for div_number in range(divs):
+        head = HEADS[div_number % len(HEADS)]
+        texts = [new_paragraph() for _ in range(paragraphs_per_div)]
+        body.append(head)
+        body.extend(texts)
+        paragraph_elems = "".join(f"<p>{escape(text)}</p>" for text in texts)
+        div_elems.append(
+            f'\t\t\t<div xmlns="http://www.tei-c.org/ns/1.0">'
+            f'<head n="{div_number + 1}">{head}</head>{paragraph_elems}</div>')
+
+    # Without any DOI in the TEI file, readers fall back to the pdftotext
+    # file, otherwise the DOI of a reference may stand in.
+    reference_elems = []
+    for reference in range(references):
+        reference_idno = ''
+        if has_doi:
+            reference_idno = f'<idno type="DOI">10.5555/ref.{reference}</idno>'
+        reference_elems.append(REFERENCE_TEMPLATE.format(
+            number=reference, year=year - 1 - reference % 10,
+            title=f"Earlier work {reference}", journal=rng.choice(JOURNALS),
+            idno=reference_idno))
+    idno = f'\t\t\t\t\t<idno type="DOI">{doi}</idno>' if has_doi else ''
+
+    tei = TEI_TEMPLATE.format(
+        title=title, journal=journal, year=year, idno=idno,
+        authors="\n".join(author_elems), abstract=escape(abstract),
+        divs="\n".join(div_elems), references="\n".join(reference_elems))
+    # pdftotext output: running text in lines, the DOI near the top.
+    lines = [title, ", ".join(names), f"{journal} ({year})", f"doi:{doi}",
+             "Abstract", abstract, *body]
+    pdftotext = "\n".join(lines) + "\n"
+    return tei, pdftotext
+
+
+def write_corpus(directory, files, large_share=0.1, seed=0,
+                 small_divs=SMALL_DIVS, large_divs=LARGE_DIVS,
+                 paragraphs_per_div=2, authors=4, accession_density=0.05,
+                 primer_density=0.05, missing_doi_share=0.1):
+    # Mostly small papers and a few very large ones, as in GROBID output of
+    # articles and theses, each with a pdftotext file. Papers without a DOI
+    # in the header fall back to the pdftotext file.
+    rng = random.Random(seed)
+    for number in range(files):
+        divs = large_divs if rng.random() < large_share else small_divs
+        has_doi = rng.random() >= missing_doi_share
+        tei, pdftotext = synthetic_paper(
+            number, rng, divs, paragraphs_per_div, authors,
+            accession_density=accession_density,
+            primer_density=primer_density, has_doi=has_doi)
+        name = f"paper{number:06d}"
+        (Path(directory) / f"{name}.tei.xml").write_text(tei, encoding='utf-8')
+        (Path(directory) / f"{name}.txt").write_text(pdftotext, encoding='utf-8')
+
+
+def add_corpus_arguments(parser):
+    parser.add_argument('--files', type=int, default=400,
+                        help="number of synthetic TEI files")
+    parser.add_argument('--large-share', type=float, default=0.1,
+                        help="share of large TEI files")
+    parser.add_argument('--small-divs', type=int, default=SMALL_DIVS,
+                        help="body divs of a small TEI file")
+    parser.add_argument('--large-divs', type=int, default=LARGE_DIVS,
+                        help="body divs of a large TEI file")
+    parser.add_argument('--paragraphs', type=int, default=2,
+                        help="paragraphs per div")
+    parser.add_argument('--authors', type=int, default=4,
+                        help="authors per paper")
+    parser.add_argument('--accession-density', type=float, default=0.05,
+                        help="share of paragraphs with an accession number")
+    parser.add_argument('--primer-density', type=float, default=0.05,
+                        help="share of paragraphs with primers")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def write_corpus_from_args(directory, args):
+    write_corpus(directory, args.files, args.large_share, args.seed,
+                 args.small_divs, args.large_divs, args.paragraphs,
+                 args.authors, args.accession_density, args.primer_density)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('outdir', help="directory for the TEI and pdftotext files")
+    add_corpus_arguments(parser)
+    args = parser.parse_args()
+    Path(args.outdir).mkdir(parents=True, exist_ok=True)
+    write_corpus_from_args(args.outdir, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+from dataclasses import dataclass, field
+
+from lxml import etree
+
+from prefetch import open_binary
+
+
+TEI_NAMESPACE = 'http://www.tei-c.org/ns/1.0'
+NAMESPACES = {'tei': TEI_NAMESPACE}
+
+
+def tei_tag(name):
+    return f'{{{TEI_NAMESPACE}}}{name}'
+
+
+HEADER_TAG = tei_tag('teiHeader')
+IDNO_TAG = tei_tag('idno')
+
+
+@dataclass
+class Person:
+    firstname: str
+    middlename: str
+    surname: str
+
+
+@dataclass
+class TEIHeader:
+    doi: str = ''
+    title: str = ''
+    abstract: str = ''
+    # None without a <monogr> in the header, where the soup parser looks
+    # further into the document.
+    published_in: str = ''
+    authors: list = field(default_factory=list)
+
+
+def elem_text(elem, default=''):
+    if elem is None:
+        return default
+    return ''.join(elem.itertext())
+
+
+def elem_stripped_text(elem, separator=' ', default=''):
+    # Same as BeautifulSoup's getText(separator=separator, strip=True).
+    if elem is None:
+        return default
+    strings = (text.strip() for text in elem.itertext())
+    return separator.join(text for text in strings if text)
+
+
+def clear_element(elem):
+    # Free the subtree and all preceding siblings that are already handled.
+    elem.clear(keep_tail=True)
+    parent = elem.getparent()
+    if parent is None:
+        return
+    while elem.getprevious() is not None:
+        del parent[0]
+
+
+def _published_in(header_elem):
+    monogr = header_elem.find('.//tei:monogr', NAMESPACES)
+    if monogr is None:
+        return None
+    title_elem = monogr.find('.//tei:title', NAMESPACES)
+    if title_elem is None:
+        return ''
+
+    if title_elem.get("level") in ['j', 'u', 'm', 's', 'a'] and\
+        title_elem.get("type") == "main":
+        return elem_text(title_elem)
+    else:
+        return ''
+
+
+def _authors(header_elem):
+    analytic = header_elem.find('.//tei:analytic', NAMESPACES)
+    if analytic is None:
+        return []
+
+    result = []
+    for author in analytic.iterfind('.//tei:author', NAMESPACES):
+        persname = author.find('.//tei:persName', NAMESPACES)
+        if persname is None:
+            continue
+        firstname = elem_text(
+            persname.find('.//tei:forename[@type="first"]', NAMESPACES))
+        middlename = elem_text(
+            persname.find('.//tei:forename[@type="middle"]', NAMESPACES))
+        surname = elem_text(persname.find('.//tei:surname', NAMESPACES))
+        result.append(Person(firstname, middlename, surname))
+    return result
+
+
+def header_from_element(header_elem):
+    return TEIHeader(
+        doi=elem_text(
+            header_elem.find('.//tei:idno[@type="DOI"]', NAMESPACES)),
+        title=elem_text(header_elem.find('.//tei:title', NAMESPACES)),
+        abstract=elem_stripped_text(
+            header_elem.find('.//tei:abstract', NAMESPACES)),
+        published_in=_published_in(header_elem),
+        authors=_authors(header_elem)
+    )
+
+
+# Bytes fed to the pull parser per read.
+READ_BUFFER_SIZE = 16 * 1024
+
+
+def iter_tei_events(tei_file, buffer_size=READ_BUFFER_SIZE):
+    # Feed the file to a pull parser in bounded chunks, so that consumers
+    # can stop reading the file as soon as they have what they need.
+    parser = etree.XMLPullParser(
+        events=('start', 'end'), tag=tei_tag('*'), huge_tree=True)
+    with open_binary(tei_file) as tei:
+        while True:
+            chunk = tei.read(buffer_size)
+            if not chunk:
+                break
+            parser.feed(chunk)
+            yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+
+def read_tei_header(tei_file, header_only=False):
+    # With header_only, stop reading the file at </teiHeader>. The DOI is
+    # then taken from the header only. None without a teiHeader in the TEI
+    # namespace.
+    header = None
+    in_header = False
+
+    events = iter_tei_events(tei_file)
+    for event, elem in events:
+        if elem.tag == HEADER_TAG:
+            if event == 'start':
+                in_header = True
+                continue
+            in_header = False
+            header = header_from_element(elem)
+            clear_element(elem)
+            if header.doi or header_only:
+                break
+        elif event == 'end' and not in_header:
+            if header is not None and elem.tag == IDNO_TAG and\
+                elem.get('type') == 'DOI':
+                # The soup parser falls back to the first DOI in the
+                # document, mostly from the references. Mirror that.
+                header.doi = elem_text(elem)
+                break
+            clear_element(elem)
+    events.close()
+    return header
@@ -1,21 +1,36 @@
+import os
 import re
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 
 from bs4 import BeautifulSoup
+from bs4.element import CData, NavigableString, Tag
 
+from accessions import CONTEXT_WINDOW, find_accessions, unique_hits
 from pdftotext_reader import PDFToText
+from prefetch import open_text
+from stage_timings import count, timed
 from bacteria_regex import AccessionNumberMatcher, BacteriaMatcher
+from teiheader_reader import Person, read_tei_header
 
 
+# Parser backends for TEIFile: a full BeautifulSoup tree, a streaming
+# lxml pass over the teiHeader, or the header only without reading the rest
+# of the file.
+PARSERS = ['soup', 'lxml', 'header']
+
 
 def read_tei(tei_file):
-    with open(tei_file, 'r') as tei:
+    with open_text(tei_file) as tei:
         soup = BeautifulSoup(tei, 'lxml')
         return soup
     raise RuntimeError('Cannot generate a soup from the input')
 
 
+def text_size(text):
+    return len(text.encode('utf-8'))
+
+
 def elem_to_text(elem, default=''):
     if elem:
         return elem.getText()
@@ -23,20 +38,134 @@ def elem_to_text(elem, default=''):
         return default
 
 
+# Strings that count as text, as in get_text: no comments and alike.
+TEXT_STRING_TYPES = (NavigableString, CData)
+
+
 @dataclass
-class Person:
-    firstname: str
-    middlename: str
-    surname: str
+class Section:
+    # (start, end) offsets into TEIFile.text of the section, its head and
+    # paragraphs.
+    start: int
+    end: int
+    head: tuple = None
+    paragraphs: list = field(default_factory=list)
+
+
+class BodyTextCollector(object):
+    def __init__(self):
+        # Text of all outermost divs without a type, i.e. neither appendix
+        # nor references, in one depth-first pass. Same as joining their
+        # get_text(separator=' ', strip=True) with spaces, but divs nested
+        # in such a div are part of its text only once.
+        self.pieces = []
+        self.length = 0
+        self.sections = []
+        self._section_strings = 0
+
+    def text(self):
+        return ''.join(self.pieces)
+
+    def _append(self, string):
+        self.pieces.append(string)
+        self.length += len(string)
+
+    def _add_string(self, string):
+        # Offsets of the stripped string, or None if it is blank.
+        stripped = string.strip()
+        if not stripped:
+            return None
+        if self._section_strings:
+            self._append(' ')
+        start = self.length
+        self._append(stripped)
+        self._section_strings += 1
+        return start, self.length
+
+    def find_sections(self, elem):
+        for child in elem.children:
+            if not isinstance(child, Tag):
+                continue
+            if child.name == 'div' and not child.get('type'):
+                self._add_section(child)
+            else:
+                self.find_sections(child)
+
+    def _add_section(self, div):
+        if self.sections:
+            self._append(' ')
+        section = Section(self.length, self.length)
+        self.sections.append(section)
+        self._section_strings = 0
+        # The HTML parser of the soup drops <head> tags but keeps their
+        # text, which then leads the div before its first element.
+        leading = None
+        seen_element = False
+        for child in div.children:
+            if isinstance(child, Tag):
+                seen_element = True
+                self._collect_element(child, section)
+            elif type(child) in TEXT_STRING_TYPES:
+                span = self._add_string(child)
+                if span and not seen_element:
+                    leading = (leading or span)[0], span[1]
+        if section.head is None:
+            section.head = leading
+        section.end = self.length
+
+    def _collect(self, elem, section):
+        for child in elem.children:
+            if isinstance(child, Tag):
+                self._collect_element(child, section)
+            elif type(child) in TEXT_STRING_TYPES:
+                self._add_string(child)
+
+    def _collect_element(self, elem, section):
+        if elem.name not in ['head', 'p']:
+            self._collect(elem, section)
+            return
+        had_strings = self._section_strings
+        start = self.length
+        self._collect(elem, section)
+        if self._section_strings == had_strings:
+            # No text.
+            return
+        if had_strings:
+            # Skip the separator.
+            start += 1
+        if elem.name == 'p':
+            section.paragraphs.append((start, self.length))
+        elif section.head is None:
+            section.head = start, self.length
+
+
+def body_text(body):
+    # Text and sections of the body of a soup.
+    collector = BodyTextCollector()
+    collector.find_sections(body)
+    return collector.text(), collector.sections
 
 
 class TEIFile(object):
-    def __init__(self, filename):
+    # Many instances may be held at once, e.g. by library users.
+    __slots__ = ['filename', 'parser', 'cache', '_soup', '_header', '_fields',
+                 '_fields_changed']
+
+    def __init__(self, filename, parser='soup', cache=None):
+        # The file is only parsed once a field is requested that is missing
+        # from the cache.
+        if parser not in PARSERS:
+            raise RuntimeError(f"Unknown parser {parser}: use one of {PARSERS}")
         self.filename = filename
-        self.soup = read_tei(filename)
-        self._text = None
-        self._title = ''
-        self._abstract = ''
+        self.parser = parser
+        self.cache = cache
+        self._soup = None
+        self._header = None
+        # Extracted fields, possibly from the parse cache.
+        self._fields = {}
+        self._fields_changed = False
+        if cache is not None:
+            self._fields = cache.get(filename, self.cache_kind()) or {}
 
     def basename(self):
         stem = Path(self.filename).stem
@@ -46,7 +175,53 @@ class TEIFile(object):
         else:
             return stem
 
+    def cache_kind(self):
+        return f'tei-{self.parser}'
+
+    def update_cache(self):
+        # Store all fields extracted so far.
+        if self.cache is not None and self._fields_changed:
+            self.cache.put(self.filename, self.cache_kind(), self._fields)
+            self._fields_changed = False
+
+    def _field(self, name, extract):
+        # Extracted once, including empty values.
+        if name not in self._fields:
+            with timed(name):
+                self._fields[name] = extract()
+            self._fields_changed = True
+        return self._fields[name]
+
+    def _file_size(self):
+        return os.path.getsize(self.filename)
+
+    @property
+    def soup(self):
+        # Parsed on first use, also by the lxml backends for the body text.
+        if self._soup is None:
+            with timed('parse', self._file_size):
+                self._soup = read_tei(self.filename)
+        return self._soup
+
+    @property
+    def header(self):
+        # None with the soup parser, and for files without a teiHeader in the
+        # TEI namespace, e.g. without any namespace. The soup reads those by
+        # the names of the tags.
+        if self._header is None and self.parser != 'soup':
+            header_only = self.parser == 'header'
+            with timed('header', self._file_size):
+                # False once there turns out to be no header.
+                self._header = read_tei_header(
+                    self.filename, header_only) or False
+        return self._header or None
+
     def doi(self):
+        return self._field('doi', self._extract_doi)
+
+    def _extract_doi(self):
+        if self.header is not None:
+            return self.header.doi
         idno_elem = self.soup.find('idno', type='DOI')
         if not idno_elem:
             return ''
@@ -55,18 +230,30 @@ class TEIFile(object):
 
     @property
     def title(self):
-        if not self._title:
-            self._title = self.soup.title.getText()
-        return self._title
+        return self._field('title', self._extract_title)
+
+    def _extract_title(self):
+        if self.header is not None:
+            return self.header.title
+        else:
+            return self.soup.title.getText()
 
     @property
     def abstract(self):
-        if not self._abstract:
-            abstract = self.soup.abstract.getText(separator=' ', strip=True)
-            self._abstract = abstract
-        return self._abstract
+        return self._field('abstract', self._extract_abstract)
+
+    def _extract_abstract(self):
+        if self.header is not None:
+            return self.header.abstract
+        else:
+            return self.soup.abstract.getText(separator=' ', strip=True)
 
     def authors(self):
+        return list(self._field('authors', self._extract_authors))
+
+    def _extract_authors(self):
+        if self.header is not None:
+            return list(self.header.authors)
         authors_in_header = self.soup.analytic.find_all('author')
 
         result = []
@@ -82,6 +269,11 @@ class TEIFile(object):
         return result
 
     def published_in(self):
+        return self._field('published_in', self._extract_published_in)
+
+    def _extract_published_in(self):
+        if self.header is not None and self.header.published_in is not None:
+            return self.header.published_in
         title_elem = self.soup.monogr.title
         if not title_elem:
             return ''
@@ -94,36 +286,74 @@ class TEIFile(object):
     
     @property
     def text(self):
-        if not self._text:
-            divs_text = []
-            for div in self.soup.body.find_all("div"):
-                # div is neither an appendix nor references, just plain text.
-                if not div.get("type"):
-                    div_text = div.get_text(separator=' ', strip=True)
-                    divs_text.append(div_text)
+        return self._field('text', self._extract_text)
+
+    def _extract_text(self):
+        text, _ = body_text(self.soup.body)
+        return text
 
-            plain_text = " ".join(divs_text)
-            self._text = plain_text
-        return self._text
+    def sections(self):
+        # Offsets of the sections of text, with their heads and paragraphs.
+        return self._field('sections', self._extract_sections)
+
+    def _extract_sections(self):
+        _, sections = body_text(self.soup.body)
+        return sections
+
+
+@dataclass
+class PaperFeatures:
+    contains_16ness: bool
+    sequencing_method: str
+    has_515_primer: bool
+    has_806_primer: bool
+    gene_regions: list
+    accession_numbers: list
+    data_source: str
 
 
 class BacteriaPaper(TEIFile):
+    __slots__ = ['pdftotext_dir', '_pdftotext', '_matches']
 
-    def __init__(self, filename, pdftotext_directory):
-        super().__init__(filename)
+    def __init__(self, filename, pdftotext_directory, parser='soup', cache=None):
+        super().__init__(filename, parser, cache)
         self.pdftotext_dir = pdftotext_directory
 
-        self._pdftotext = ''
+        self._pdftotext = None
+        # Results of BacteriaMatcher methods by method and field name.
+        self._matches = {}
+
+    def update_cache(self):
+        super().update_cache()
+        if self._pdftotext is not None:
+            self._pdftotext.update_cache()
 
     @property
     def pdftotext(self):
-        if not self._pdftotext:
+        if self._pdftotext is None:
             path_pdftotext = Path(self.pdftotext_dir) / f"{self.basename()}.txt"
-            self._pdftotext = PDFToText(path_pdftotext)
+            self._pdftotext = PDFToText(path_pdftotext, self.cache)
         return self._pdftotext
 
+    def _match(self, matcher, field):
+        # Run each BacteriaMatcher method at most once per field. Hits and
+        # misses show up in the counters of the stage timings.
+        key = matcher, field
+        if key in self._matches:
+            count('match_memo_hits')
+        else:
+            count('match_memo_misses')
+            self._matches[key] = getattr(BacteriaMatcher, matcher)(
+                getattr(self, field))
+            if matcher == 'features':
+                # The fields of the TextFeatures are named after the single
+                # methods, so later calls of those are hits.
+                for name, value in vars(self._matches[key]).items():
+                    self._matches.setdefault((name, field), value)
+        return self._matches[key]
+
     def accession_numbers(self):
-        accession_numbers = BacteriaMatcher.accession_numbers(self.text)
+        accession_numbers = self._match('accession_numbers', 'text')
         if accession_numbers:
             # if accession numbers found return them.
             return accession_numbers
@@ -131,6 +361,17 @@ class BacteriaPaper(TEIFile):
             # Otherwise try to retrieve them from the pdftotext.
             return self.pdftotext.accession_numbers()
 
+    def accession_hits(self, window=CONTEXT_WINDOW):
+        # Accession numbers of both the text and the pdftotext, each with
+        # its first occurrence: text before pdftotext, then by offset.
+        with timed('match_accessions', lambda: text_size(self.text)):
+            hits = find_accessions(self.text, 'tei', window)
+        if os.path.exists(self.pdftotext.filename):
+            pdftotext = self.pdftotext.text
+            with timed('match_accessions', lambda: text_size(pdftotext)):
+                hits.extend(find_accessions(pdftotext, 'pdftotext', window))
+        return unique_hits(hits)
+
     def doi(self):
         doi_from_bs = super().doi()
         if doi_from_bs:
@@ -139,51 +380,70 @@ class BacteriaPaper(TEIFile):
             # Resort pdftotext: try find doi in the beginning of the text.
             return self.pdftotext.doi()
 
-    def _has_match_16ness(self, text):
-        matches = BacteriaMatcher.matches_16ness(self.text)
-        return bool(matches)
+    def _has_match_16ness(self, field):
+        return bool(self._match('matches_16ness', field))
 
     def contains_16ness(self):
-        if self._has_match_16ness(self.title):
-            return True
-        elif self._has_match_16ness(self.abstract):
-            return True
-        else:
-            return self._has_match_16ness(self.text)
-        return False
-
-    def _gene_region_matches(self, text):
-        return BacteriaMatcher.gene_regions(text)
+        # Only the text counts, as in features(). The title and abstract
+        # checks never took effect, since they matched the text as well.
+        return self._has_match_16ness('text')
 
     def gene_regions(self):
-        regions_in_title = self._gene_region_matches(self.title)
-        regions_in_text = self._gene_region_matches(self.text)
+        regions_in_title = self._match('gene_regions', 'title')
+        regions_in_text = self._match('gene_regions', 'text')
         regions = regions_in_title.union(regions_in_text)
         # Sort the results based on the digit: v1 before V6
         return sorted(regions, key=lambda r: r[1])
 
-    def _search_with(self, matcher_func, default_val=''):
-        match = matcher_func(self.title)
+    def _search_with(self, matcher, default_val=''):
+        match = self._match(matcher, 'title')
         if match:
             return match
         else:
-            match = matcher_func(self.text)
+            match = self._match(matcher, 'text')
             if match:
                 return match
             else:
                 return default_val
 
     def sequencing_method(self):
-        return self._search_with(BacteriaMatcher.sequencing_method)
+        return self._search_with('sequencing_method')
 
     def data_source(self):
-        return self._search_with(BacteriaMatcher.data_source)
+        return self._search_with('data_source')
 
     def has_515_primer(self):
-        return self._search_with(BacteriaMatcher.has_515_primer)
+        return self._search_with('has_515_primer')
 
     def has_806_primer(self):
-        return self._search_with(BacteriaMatcher.has_806_primer)
+        return self._search_with('has_806_primer')
+
+    def features(self):
+        # Same results as the methods above, but scans title and text once.
+        with timed('match_title', lambda: text_size(self.title)):
+            title_features = self._match('features', 'title')
+        with timed('match_text', lambda: text_size(self.text)):
+            text_features = self._match('features', 'text')
+
+        regions = title_features.gene_regions.union(text_features.gene_regions)
+        accession_numbers = text_features.accession_numbers
+        if not accession_numbers:
+            accession_numbers = self.pdftotext.accession_numbers()
+
+        # Missing primers are '' as in _search_with.
+        return PaperFeatures(
+            contains_16ness=text_features.matches_16ness,
+            sequencing_method=title_features.sequencing_method or\
+                text_features.sequencing_method,
+            has_515_primer=title_features.has_515_primer or\
+                text_features.has_515_primer or '',
+            has_806_primer=title_features.has_806_primer or\
+                text_features.has_806_primer or '',
+            gene_regions=sorted(regions, key=lambda r: r[1]),
+            accession_numbers=accession_numbers,
+            data_source=title_features.data_source or\
+                text_features.data_source
+        )
 
 
 def main():
@@ -1,8 +1,39 @@
+import contextlib
+import re
+import importlib.util
+import io
+import json
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+from functools import partial
+from pathlib import Path
 
-import bacteria_regex
+import pandas as pd
+from lxml import etree
 
-from pdftotext_reader import digital_object_identifier
+import accessioncsv
+import accessions
+import bacteria_regex
+import batch_matching
+import bacteriacsv
+import checkpoint
+import failures
+
+import incremental
+import parse_cache
+import pipeline
+import pdftotext_reader
+import prefetch
+import progress
+import sharding
+import stage_timings
+import synthetic_corpus
+import text_index
+from pdftotext_reader import PDFToText, digital_object_identifier
+from teireader import PARSERS, BacteriaPaper, TEIFile
 
 
 class TestAccessionNumberMatcher(unittest.TestCase):
@@ -367,5 +398,1343 @@ class DOIfromTextTest(unittest.TestCase):
         self.assertEqual(doi_expected, doi_computed)
 
 
+class BytesEquivalentMatcher(object):
+    # Runs every matcher method on the text and on its UTF-8 bytes, and
+    # checks both give the same result.
+    def __init__(self, matcher, test):
+        self.matcher = matcher
+        self.test = test
+
+    def __getattr__(self, name):
+        method = getattr(self.matcher, name)
+
+        def checked(text, *args):
+            result = method(text, *args)
+            data = text.encode('utf-8')
+            self.test.assertTrue(self.matcher.scans_bytes(data))
+            self.test.assertEqual(result, method(data, *args))
+            return result
+        return checked
+
+
+class BytesAccessionNumberTest(TestAccessionNumberMatcher):
+
+    def setUp(self):
+        super().setUp()
+        self.matcher = BytesEquivalentMatcher(self.matcher, self)
+
+
+class BytesDataSourceTest(DataSourceMatcherTest):
+
+    def setUp(self):
+        super().setUp()
+        self.matcher = BytesEquivalentMatcher(self.matcher, self)
+
+
+class BytesSequencingMethodTest(SequencingMethodTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.matcher = BytesEquivalentMatcher(self.matcher, self)
+
+
+class BytesGeneRegionsTest(GeneRegionsTest):
+
+    def setUp(self):
+        super().setUp()
+        self.matcher = BytesEquivalentMatcher(self.matcher, self)
+
+
+class BytesPrimer515Test(Primer515Test):
+
+    def setUp(self):
+        super().setUp()
+        self.matcher = BytesEquivalentMatcher(self.matcher, self)
+
+
+class BytesPrimer806Test(Primer806Test):
+
+    def setUp(self):
+        super().setUp()
+        self.matcher = BytesEquivalentMatcher(self.matcher, self)
+
+    def test_unicode_quotes_match(self):
+        text = "Rev 5’-GGACTACHVGGGTWTCTAAT-3′ and caf\u00e9"
+        self.check_primer_in(text)
+
+
+class BytesPatternTest(unittest.TestCase):
+
+    def test_non_ascii_text_is_equivalent(self):
+        data = "ﬁeld caf\u00e9 \u2013 PRJNA123456 in the V4 region".encode()
+        self.assertTrue(bacteria_regex.BacteriaMatcher.scans_bytes(data))
+
+    def test_characters_only_str_regex_matches(self):
+        matcher = bacteria_regex.BacteriaMatcher
+        for text in ["SAMN\u212a12", "ERP12345\u0663", "V4\u00a0region",
+                     "V4\x1cregion"]:
+            self.assertFalse(matcher.scans_bytes(text.encode()))
+        self.assertFalse(matcher.scans_bytes(b"PRJ\xffNA123"))
+
+    def test_unsupported_patterns(self):
+        self.assertIsNone(bacteria_regex.BytesPattern(r'\bV4').regex)
+        self.assertIsNone(bacteria_regex.BytesPattern(r'V4 region').regex)
+        self.assertIsNone(bacteria_regex.BytesPattern('3\u2032+').regex)
+
+
+class PDFToTextTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.pdftotext = Path(self.tmpdir.name) / 'sample.txt'
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, data):
+        self.pdftotext.write_bytes(data)
+        return PDFToText(self.pdftotext)
+
+    def test_same_text_as_read_text_file(self):
+        for data in [b'', b'\n', b'a\n\nb\r\n', b'caf\xc3\xa9 \xff end']:
+            pdftotext = self.write(data)
+            self.assertEqual(
+                pdftotext_reader.read_text_file(self.pdftotext),
+                pdftotext.text)
+
+    def test_doi_only_decodes_the_head(self):
+        words = b' '.join(b'word' for _ in range(5000))
+        pdftotext = self.write(b'doi: 10.1186/s40793-016-0190-4\n' + words)
+        self.assertEqual('10.1186/s40793-016-0190-4', pdftotext.doi())
+        self.assertIsNone(pdftotext._text)
+
+    def test_text_until_from_head(self):
+        data = b'a\n\nb ' * 2000
+        text = pdftotext_reader.read_text_file(self.write(data).filename)
+        for word_count in [1, 2, 3, 1000, 10000]:
+            self.assertEqual(' '.join(text.split(' ')[:word_count]),
+                             self.write(data).text_until(word_count))
+
+    def test_doi_after_first_words(self):
+        pdftotext = self.write(b'word\n' * 1000 + b'10.1186/s40793-016-0190-4')
+        self.assertEqual('', pdftotext.doi())
+
+    def test_accession_numbers_from_bytes(self):
+        pdftotext = self.write('ﬁeld PRJNA123456 and SRR1234567\n'.encode())
+        self.assertCountEqual(['PRJNA123456', 'SRR1234567'],
+                              pdftotext.accession_numbers())
+        self.assertIsNone(pdftotext._text)
+
+    def test_accession_numbers_with_lookalikes(self):
+        # re.I matches the Kelvin sign to K, which the bytes regex cannot.
+        pdftotext = self.write('SAMN\u212a12 and SRR1234567\n'.encode())
+        self.assertCountEqual(
+            bacteria_regex.BacteriaMatcher.accession_numbers(pdftotext.text),
+            self.write('SAMN\u212a12 and SRR1234567\n'.encode())
+            .accession_numbers())
+        self.assertIn('SAMN\u212a12', pdftotext.accession_numbers())
+
+
+class FeaturesTest(unittest.TestCase):
+
+    texts = [
+        "This is a text with accession numbers ERS123456 and ERS654321.",
+        "PRJNA123456 and PRJNA123456 again, see SRR1234567 on Figshare.",
+        "We used Illumina MiSeq and 454 pyrosequencing, data on QIITA.",
+        "Solexa was used, then Illumina. Data in MG-RAST and bioproject.",
+        "16S rRNA gene regions V3 and V4 were amplified with 515F/806R.",
+        "The V4 region, the regions V1-V3 and V6 regions were sequenced.",
+        "5'-GTGYCAGCMGCCGCGGTAA-3' and 5'-GGACTACNVGGGTWTCTAAT-3'",
+        "The 16s RNA and 16S  rRNA were sequenced on a HiSeq 2500.",
+        "f515 and fwd 515 and rev806, V5,V6 and V7 regions.",
+        "Bogus, spam, ham and nothing but text.",
+        "Sequenced on an Illum\u0131na platform, see \u0130llumina.",
+        "",
+    ]
+
+    def test_features_match_single_matchers(self):
+        matcher = bacteria_regex.BacteriaMatcher
+        for text in self.texts:
+            features = matcher.features(text)
+            self.assertEqual(bool(matcher.matches_16ness(text)),
+                             features.matches_16ness)
+            self.assertEqual(matcher.sequencing_method(text),
+                             features.sequencing_method)
+            self.assertEqual(matcher.has_515_primer(text),
+                             features.has_515_primer)
+            self.assertEqual(matcher.has_806_primer(text),
+                             features.has_806_primer)
+            self.assertEqual(matcher.gene_regions(text), features.gene_regions)
+            self.assertCountEqual(matcher.accession_numbers(text),
+                                  features.accession_numbers)
+            self.assertEqual(matcher.data_source(text), features.data_source)
+
+
+class LiteralPrefilterTest(unittest.TestCase):
+
+    def test_anchor_expands_small_character_sets(self):
+        literals, before, after = bacteria_regex.pattern_anchor(
+            r'PRJ(E|D|N|C)[A-Z][0-9]+', window=64)
+        self.assertEqual(['prjc', 'prjd', 'prje', 'prjn'], literals)
+        self.assertEqual(0, before)
+
+    def test_anchor_of_grouped_pattern(self):
+        literals, _, _ = bacteria_regex.pattern_anchor(
+            r'(16[sS]\s*rRNA)', window=64)
+        self.assertEqual(['rrna'], literals)
+
+    def test_no_anchor_falls_back_to_full_scan(self):
+        prefilter = bacteria_regex.LiteralPrefilter(['515', r'[vV]\d'])
+        self.assertIsNone(prefilter.anchors)
+        self.assertIsNone(prefilter.windows("V4 and 515"))
+
+    def test_windows_are_merged(self):
+        prefilter = bacteria_regex.LiteralPrefilter(['Figshare'])
+        text = "Data on figshare and FIGSHARE, not on qiita."
+        self.assertEqual([(8, 16), (21, 29)], prefilter.windows(text))
+
+    def test_regex_anchor_windows(self):
+        prefilter = bacteria_regex.RegexPrefilter(r'[vV]\d', [r'[vV]\d'])
+        text = "No region here, but V4 and v6 there."
+        self.assertFalse(prefilter.may_match("no region here"))
+        self.assertEqual([(18, 22), (25, 29)], prefilter.windows(text))
+
+    def test_same_results_without_prefilter(self):
+        matchers = [
+            bacteria_regex.AccessionNumberMatcher,
+            bacteria_regex.DataSourceMatcher,
+            bacteria_regex.Primer515Matcher,
+            bacteria_regex.Primer806Matcher,
+            bacteria_regex.GeneRegionsMatcher
+        ]
+        for matcher_class in matchers:
+            with_prefilter = matcher_class()
+            without_prefilter = matcher_class(prefilter=False)
+            for text in FeaturesTest.texts:
+                self.assertEqual(without_prefilter.matches(text),
+                                 with_prefilter.matches(text))
+                self.assertEqual(without_prefilter.match(text),
+                                 with_prefilter.match(text))
+
+
+SAMPLE_TEI = """<?xml version="1.0" encoding="UTF-8"?>
+<TEI xml:space="preserve" xmlns="http://www.tei-c.org/ns/1.0" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xlink="http://www.w3.org/1999/xlink">
+	<teiHeader xml:lang="en">
+		<fileDesc>
+			<titleStmt>
+				<title level="a" type="main">The genome of the Antarctic &amp; friends</title>
+			</titleStmt>
+			<publicationStmt>
+				<publisher/>
+				<availability status="unknown"><licence/></availability>
+			</publicationStmt>
+			<sourceDesc>
+				<biblStruct>
+					<analytic>
+						<author>
+							<persName xmlns="http://www.tei-c.org/ns/1.0"><forename type="first">Habibu</forename><forename type="middle">A</forename><surname>Aliyu</surname></persName>
+						</author>
+						<author role="corresp"><persName><forename type="first">Pieter</forename><surname>De Maayer</surname></persName></author>
+						<author><orgName>Consortium</orgName></author>
+						<title level="a" type="main">The genome of the Antarctic &amp; friends</title>
+					</analytic>
+					<monogr>
+						<title level="j" type="main">Standards in Genomic Sciences</title>
+						<imprint><date type="published" when="2016">2016</date></imprint>
+					</monogr>
+					<idno type="DOI">10.1186/s40793-016-0190-4</idno>
+				</biblStruct>
+			</sourceDesc>
+		</fileDesc>
+		<profileDesc>
+			<abstract>
+				<div xmlns="http://www.tei-c.org/ns/1.0"><p>We report the <hi rend="italic">genome</hi> sequence.</p><p>Second   paragraph.</p></div>
+			</abstract>
+		</profileDesc>
+	</teiHeader>
+	<text xml:lang="en">
+		<body>
+			<div xmlns="http://www.tei-c.org/ns/1.0"><head n="1">Introduction</head><p>We sequenced the 16S rRNA V4 region with Illumina MiSeq (PRJNA123456).</p></div>
+			<div type="acknowledgement"><p>Thanks.</p></div>
+		</body>
+		<back>
+			<div type="references"><listBibl><biblStruct xml:id="b0"><analytic><title level="a" type="main">Ref</title><idno type="DOI">10.1/ref</idno></analytic><monogr><title level="j">J</title></monogr></biblStruct></listBibl></div>
+		</back>
+	</text>
+</TEI>"""
+
+
+def write_tei(directory, name, text=SAMPLE_TEI):
+    path = Path(directory) / f"{name}.tei.xml"
+    path.write_text(text)
+    return path
+
+
+class TEIParserBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.tei_file = write_tei(self.tmpdir.name, 'sample')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def check_same_header(self, tei_file, parser='lxml'):
+        soup_tei = TEIFile(tei_file, parser='soup')
+        lxml_tei = TEIFile(tei_file, parser=parser)
+        self.assertEqual(soup_tei.doi(), lxml_tei.doi())
+        self.assertEqual(soup_tei.title, lxml_tei.title)
+        self.assertEqual(soup_tei.abstract, lxml_tei.abstract)
+        self.assertEqual(soup_tei.published_in(), lxml_tei.published_in())
+        self.assertEqual(soup_tei.authors(), lxml_tei.authors())
+
+    def test_header_fields_match_soup(self):
+        self.check_same_header(self.tei_file)
+        tei = TEIFile(self.tei_file, parser='lxml')
+        self.assertEqual("10.1186/s40793-016-0190-4", tei.doi())
+        self.assertEqual("The genome of the Antarctic & friends", tei.title)
+
+    def test_doi_falls_back_to_references(self):
+        text = SAMPLE_TEI.replace(
+            '<idno type="DOI">10.1186/s40793-016-0190-4</idno>', '')
+        tei_file = write_tei(self.tmpdir.name, 'no_doi', text)
+        self.check_same_header(tei_file)
+        self.assertEqual("10.1/ref", TEIFile(tei_file, parser='lxml').doi())
+
+    def test_tei_without_namespace(self):
+        text = SAMPLE_TEI.replace(' xmlns="http://www.tei-c.org/ns/1.0"', '')
+        tei_file = write_tei(self.tmpdir.name, 'no_namespace', text)
+        for parser in ['lxml', 'header']:
+            self.check_same_header(tei_file, parser)
+        self.assertEqual("Standards in Genomic Sciences",
+                         TEIFile(tei_file, parser='header').published_in())
+
+    def test_header_without_monogr(self):
+        # The soup takes the first <monogr> of the document, here that of a
+        # reference.
+        header_monogr = re.search(r'\s*<monogr>.*?</monogr>', SAMPLE_TEI,
+                                  re.S).group(0)
+        text = SAMPLE_TEI.replace(header_monogr, '').replace(
+            '<title level="j">J</title>', '<title level="j" type="main">J</title>')
+        tei_file = write_tei(self.tmpdir.name, 'reference_monogr', text)
+        for parser in PARSERS:
+            self.assertEqual('J', TEIFile(tei_file, parser=parser).published_in())
+
+        # Without any, all parsers fail alike.
+        text = re.sub(r'<monogr>.*?</monogr>', '', SAMPLE_TEI, flags=re.S)
+        tei_file = write_tei(self.tmpdir.name, 'no_monogr', text)
+        for parser in PARSERS:
+            with self.assertRaises(AttributeError):
+                TEIFile(tei_file, parser=parser).published_in()
+
+    def test_text_is_parsed_on_demand(self):
+        soup_tei = TEIFile(self.tei_file, parser='soup')
+        lxml_tei = TEIFile(self.tei_file, parser='lxml')
+        self.assertEqual(soup_tei.text, lxml_tei.text)
+
+    def test_header_only_matches_soup(self):
+        soup_tei = TEIFile(self.tei_file, parser='soup')
+        header_tei = TEIFile(self.tei_file, parser='header')
+        self.assertEqual(soup_tei.doi(), header_tei.doi())
+        self.assertEqual(soup_tei.title, header_tei.title)
+        self.assertEqual(soup_tei.published_in(), header_tei.published_in())
+
+    def test_header_only_stops_at_end_of_header(self):
+        # Without a DOI in the header, the lxml parser goes on into the
+        # malformed body. The header parser never reads it.
+        head, _ = SAMPLE_TEI.split('</teiHeader>')
+        head = re.sub(r'<idno type="DOI">[^<]*</idno>', '', head)
+        text = head + '</teiHeader><text><body><p>Broken & <unclosed'
+        tei_file = write_tei(self.tmpdir.name, 'malformed', text)
+        tei = TEIFile(tei_file, parser='header')
+        self.assertEqual("The genome of the Antarctic & friends", tei.title)
+        self.assertEqual('', tei.doi())
+        with self.assertRaises(etree.XMLSyntaxError):
+            TEIFile(tei_file, parser='lxml').doi()
+
+    def test_unknown_parser(self):
+        with self.assertRaises(RuntimeError):
+            TEIFile(self.tei_file, parser='html')
+
+    def test_parsed_on_first_field(self):
+        for parser in PARSERS:
+            tei = TEIFile(self.tei_file, parser=parser)
+            self.assertIsNone(tei._soup)
+            self.assertIsNone(tei._header)
+            tei.title
+            self.assertTrue(tei._soup is not None or tei._header is not None)
+
+    def test_empty_fields_are_memoized(self):
+        no_journal = SAMPLE_TEI.replace('<title level="j" type="main">',
+                                        '<title level="j">')
+        tei = TEIFile(write_tei(self.tmpdir.name, 'no-journal', no_journal))
+        self.assertEqual('', tei.published_in())
+        tei._soup = None
+        # Not parsed again.
+        self.assertEqual('', tei.published_in())
+        self.assertIsNone(tei._soup)
+
+    def test_no_instance_dict(self):
+        paper = BacteriaPaper(self.tei_file, self.tmpdir.name)
+        self.assertFalse(hasattr(paper, '__dict__'))
+
+
+class BodyTextTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_same_text_as_untyped_divs(self):
+        tei = TEIFile(write_tei(self.tmpdir.name, 'sample'))
+        expected = " ".join(
+            div.get_text(separator=' ', strip=True)
+            for div in tei.soup.body.find_all("div") if not div.get("type"))
+        self.assertEqual(expected, tei.text)
+
+    def test_nested_divs_once(self):
+        nested = SAMPLE_TEI.replace(
+            '<div type="acknowledgement">',
+            '<div><p>Outer</p><div><p>Inner</p></div></div>'
+            '<div type="annex"><div><p>Annex</p></div></div>'
+            '<div type="acknowledgement">')
+        tei = TEIFile(write_tei(self.tmpdir.name, 'nested', nested))
+        self.assertTrue(tei.text.endswith('(PRJNA123456). Outer Inner Annex'))
+
+    def test_section_offsets(self):
+        tei = TEIFile(write_tei(self.tmpdir.name, 'sample'))
+        text = tei.text
+        abstract, introduction = tei.sections()
+        self.assertIsNone(abstract.head)
+        self.assertEqual(['We report the genome sequence.',
+                          'Second   paragraph.'],
+                         [text[start:end]
+                          for start, end in abstract.paragraphs])
+        self.assertEqual('Introduction', text[slice(*introduction.head)])
+        self.assertEqual(len(text), introduction.end)
+        self.assertEqual(
+            'We sequenced the 16S rRNA V4 region with Illumina MiSeq '
+            '(PRJNA123456).', text[slice(*introduction.paragraphs[0])])
+
+
+class BacteriaPaperFeaturesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.tei_file = write_tei(self.tmpdir.name, 'sample')
+        pdftotext = Path(self.tmpdir.name) / 'sample.txt'
+        pdftotext.write_text("doi:10.1186/s40793-016-0190-4\nSRR1234567\n")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_features_match_paper_methods(self):
+        paper = BacteriaPaper(self.tei_file, self.tmpdir.name)
+        features = paper.features()
+        self.assertEqual(paper.contains_16ness(), features.contains_16ness)
+        self.assertEqual(paper.sequencing_method(), features.sequencing_method)
+        self.assertEqual(paper.has_515_primer(), features.has_515_primer)
+        self.assertEqual(paper.has_806_primer(), features.has_806_primer)
+        self.assertEqual(paper.gene_regions(), features.gene_regions)
+        self.assertCountEqual(paper.accession_numbers(),
+                              features.accession_numbers)
+        self.assertEqual(paper.data_source(), features.data_source)
+
+    def test_matchers_run_once_per_field(self):
+        stage_timings.enable_timings()
+        try:
+            with stage_timings.document('sample'):
+                paper = BacteriaPaper(self.tei_file, self.tmpdir.name)
+                self.assertTrue(paper.contains_16ness())
+                self.assertTrue(paper.contains_16ness())
+                paper.sequencing_method()
+                paper.sequencing_method()
+                paper.features()
+                paper.features()
+                # Filled in from the features of title and text.
+                self.assertEqual(['v4'], paper.gene_regions())
+            (document_timings, ) = stage_timings.collect_timings()
+        finally:
+            stage_timings.disable_timings()
+        # The sequencing method is found in the text after the title.
+        self.assertEqual({'match_memo_misses': 5, 'match_memo_hits': 7},
+                         document_timings.counts)
+        timings = stage_timings.StageTimings()
+        timings.add([document_timings])
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            timings.report(slowest=0)
+        self.assertIn("match_memo_hit_rate              58.3%",
+                      output.getvalue())
+
+
+class ParseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.tei_file = write_tei(self.tmpdir.name, 'sample')
+        self.cache = parse_cache.ParseCache(
+            Path(self.tmpdir.name) / 'cache.db')
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def test_cached_fields_skip_parsing(self):
+        tei = TEIFile(self.tei_file, cache=self.cache)
+        expected = tei.doi(), tei.title, tei.text
+        tei.update_cache()
+
+        cached_tei = TEIFile(self.tei_file, cache=self.cache)
+        self.assertEqual(expected,
+                         (cached_tei.doi(), cached_tei.title, cached_tei.text))
+        self.assertIsNone(cached_tei._soup)
+
+    def test_missing_field_is_parsed(self):
+        tei = TEIFile(self.tei_file, cache=self.cache)
+        tei.doi()
+        tei.update_cache()
+
+        cached_tei = TEIFile(self.tei_file, cache=self.cache)
+        self.assertEqual("The genome of the Antarctic & friends",
+                         cached_tei.title)
+
+    def test_changed_file_invalidates_entry(self):
+        self.cache.put(self.tei_file, 'tei-soup', {'title': 'Old title'})
+        self.tei_file.write_text(SAMPLE_TEI.replace('friends', 'foes'))
+        self.assertIsNone(self.cache.get(self.tei_file, 'tei-soup'))
+
+    def test_touched_file_keeps_entry(self):
+        self.cache.put(self.tei_file, 'tei-soup', {'title': 'Title'})
+        self.tei_file.write_text(SAMPLE_TEI)
+        self.assertEqual({'title': 'Title'},
+                         self.cache.get(self.tei_file, 'tei-soup'))
+
+    def test_prefetched_contents_replace_file_access(self):
+        tei_file = str(Path(self.tmpdir.name) / 'remote.tei.xml')
+        prefetch._prefetched[tei_file] = SAMPLE_TEI.encode('utf-8')
+        try:
+            # The file itself does not exist, e.g. on slow storage.
+            self.cache.put(tei_file, 'tei-soup', {'title': 'Title'})
+            self.assertEqual({'title': 'Title'},
+                             self.cache.get(tei_file, 'tei-soup'))
+            prefetch._prefetched[tei_file] = b'changed'
+            self.assertIsNone(self.cache.get(tei_file, 'tei-soup'))
+        finally:
+            prefetch._prefetched.clear()
+
+        # Without prefetching, the entry is valid for the same content.
+        Path(tei_file).write_text(SAMPLE_TEI, encoding='utf-8')
+        prefetch._prefetched[tei_file] = SAMPLE_TEI.encode('utf-8')
+        try:
+            self.cache.put(tei_file, 'tei-soup', {'title': 'Title'})
+        finally:
+            prefetch._prefetched.clear()
+        self.assertEqual({'title': 'Title'},
+                         self.cache.get(tei_file, 'tei-soup'))
+
+    def test_evict_least_recently_used(self):
+        other_file = write_tei(self.tmpdir.name, 'other')
+        self.cache.put(self.tei_file, 'tei-soup', {'text': 'a' * 100})
+        self.cache.put(other_file, 'tei-soup', {'text': 'b' * 100})
+        self.cache.get(self.tei_file, 'tei-soup')
+        self.cache.max_size = self.cache.size() - 1
+        self.cache.evict()
+        self.assertIsNotNone(self.cache.get(self.tei_file, 'tei-soup'))
+        self.assertIsNone(self.cache.get(other_file, 'tei-soup'))
+
+
+class IncrementalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.teis = [write_tei(self.tmpdir.name, name)
+                     for name in ['a', 'a-b', 'b']]
+        self.manifest = incremental.Manifest({'parser': 'soup'})
+        incremental.changed_teis(self.manifest, self.teis, lambda tei: [tei])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_only_changed_files_are_processed(self):
+        self.teis[2].write_text(SAMPLE_TEI.replace('friends', 'foes'))
+        # Same content, only touched.
+        self.teis[1].write_text(SAMPLE_TEI)
+        new_tei = write_tei(self.tmpdir.name, 'c')
+        changed, deleted = incremental.changed_teis(
+            self.manifest, self.teis[1:] + [new_tei], lambda tei: [tei])
+        self.assertEqual([self.teis[2], new_tei], changed)
+        self.assertEqual(['a.tei.xml'], deleted)
+
+    def test_manifest_with_other_settings_is_ignored(self):
+        filename = Path(self.tmpdir.name) / 'out.csv.manifest.json'
+        self.manifest.save(filename)
+        manifest = incremental.Manifest.load(filename, {'parser': 'lxml'})
+        self.assertFalse(manifest.entries)
+
+    def test_merge_keeps_order_of_full_run(self):
+        outfile = Path(self.tmpdir.name) / 'out.csv'
+        outfile.write_text("ID,Title\na,Old\na-b,Old\nb,Old\n")
+        merged = incremental.merge_with_previous(
+            outfile, [('a', 'New')], [self.teis[0]], ['b.tei.xml'])
+        self.assertEqual([['a-b', 'Old'], ('a', 'New')], list(merged))
+
+    def test_merge_sorts_unordered_previous_output(self):
+        outfile = Path(self.tmpdir.name) / 'out.csv'
+        outfile.write_text("ID,Title\nd,Old\nb,Old\na,Old\n")
+        merged = incremental.merge_with_previous(
+            outfile, [('c', 'New')], [write_tei(self.tmpdir.name, 'c')], [])
+        self.assertEqual(['a', 'b', 'c', 'd'], [row[0] for row in merged])
+
+
+class WriteCSVTest(unittest.TestCase):
+
+    def test_same_format_as_pandas(self):
+        columns = ['ID', 'Title', '16ness', 'accession']
+        rows = [
+            ('a', 'Title, with "quotes"', True, 'PRJNA1'),
+            ('b', 'Multi\nline', False, ''),
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = Path(tmpdir) / 'out.csv'
+            pipeline.write_csv(outfile, columns, iter(rows))
+            expected = pd.DataFrame(rows, columns=columns).to_csv(index=False)
+            self.assertEqual(expected, outfile.read_text())
+            self.assertEqual([['a', 'Title, with "quotes"', 'True', 'PRJNA1'],
+                              ['b', 'Multi\nline', 'False', '']],
+                             list(pipeline.read_csv_rows(outfile)))
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def test_same_rows_for_all_pool_settings(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tasks = [(str(write_tei(tmpdir, name)), tmpdir)
+                     for name in ['a', 'b', 'c']]
+            expected = [bacteriacsv.tei_to_csv_entries(task) for task in tasks]
+            with pipeline.create_pool(2, 1, bacteriacsv.init_worker) as pool:
+                entries = pipeline.imap_results(
+                    pool, bacteriacsv.tei_to_csv_entries, tasks, 2,
+                    ordered=True)
+                self.assertEqual(expected, list(entries))
+                pool.close()
+                pool.join()
+
+    def test_largest_tasks_first(self):
+        tasks = ['a', 'b', 'c', 'd', 'e']
+        sizes = [1, 50, 2, 30, 1]
+        # About 28 bytes per chunk of two tasks.
+        self.assertEqual([['b'], ['d'], ['c', 'a'], ['e']],
+                         pipeline.size_chunks(tasks, sizes, chunksize=2))
+        self.assertEqual([['a', 'b'], ['c', 'd'], ['e']],
+                         pipeline.name_chunks(tasks, chunksize=2))
+
+    def test_scheduled_results_and_busy_times(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tasks = [(str(write_tei(tmpdir, name)), tmpdir)
+                     for name in ['a', 'b', 'c']]
+            sizes = [1, 3, 2]
+            expected = [bacteriacsv.tei_to_csv_entries(task) for task in tasks]
+            busy_times = {}
+            with pipeline.create_pool(2) as pool:
+                unordered = list(pipeline.imap_scheduled(
+                    pool, bacteriacsv.tei_to_csv_entries, tasks, sizes,
+                    busy_times=busy_times))
+                ordered = list(pipeline.imap_scheduled(
+                    pool, bacteriacsv.tei_to_csv_entries, tasks, sizes,
+                    ordered=True))
+                pool.close()
+                pool.join()
+            self.assertCountEqual(expected, unordered)
+            self.assertEqual(expected, ordered)
+            self.assertTrue(busy_times)
+            self.assertTrue(all(seconds > 0 for seconds in busy_times.values()))
+
+    def test_batches_as_columns(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tasks = [(str(write_tei(tmpdir, name)), tmpdir)
+                     for name in ['a', 'b', 'c']]
+            rows = [row for task in tasks
+                    for row in bacteriacsv.tei_to_csv_entries(task)]
+            with pipeline.create_pool(2) as pool:
+                batches = list(pipeline.imap_batches(
+                    pool, bacteriacsv.tei_batch_to_csv_columns, tasks,
+                    [1, 1, 1], chunksize=2, ordered=True))
+                pool.close()
+                pool.join()
+        self.assertEqual(2, len(batches))
+        self.assertEqual(bacteriacsv.CSV_COLUMNS, list(batches[0]))
+        self.assertEqual(rows, [row for batch in batches
+                                for row in pipeline.columns_to_rows(batch)])
+
+    def test_invalid_pool_settings(self):
+        with self.assertRaises(RuntimeError):
+            pipeline.create_pool(workers=0)
+        with self.assertRaises(RuntimeError):
+            pipeline.create_pool(maxtasksperchild=0)
+
+
+class FailureIsolationTest(unittest.TestCase):
+
+    def test_failing_tasks_are_skipped(self):
+        def invert(number):
+            return 1 / number
+
+        self.assertEqual([1, 0.5], list(failures.isolated(invert, [1, 0, 2])))
+        errors = failures.collect_errors()
+        self.assertEqual(['0'], [error.file for error in errors])
+        self.assertEqual('ZeroDivisionError', errors[0].error)
+        self.assertIn('invert', errors[0].traceback)
+        self.assertEqual([], failures.collect_errors())
+
+    def test_errors_from_workers(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            good = str(write_tei(tmpdir, 'good'))
+            bad = str(write_tei(tmpdir, 'bad', '<TEI><teiHeader/></TEI>'))
+            errors = []
+            with pipeline.create_pool(1) as pool:
+                batches = list(pipeline.imap_batches(
+                    pool, bacteriacsv.tei_batch_to_csv_columns,
+                    [(bad, tmpdir), (good, tmpdir)], [1, 1], chunksize=2,
+                    errors=errors))
+                pool.close()
+                pool.join()
+        self.assertEqual(['good'], batches[0]['ID'])
+        self.assertEqual([bad], [error.file for error in errors])
+
+    def test_errors_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = Path(tmpdir) / 'out.csv'
+            error = failures.TaskError('a.tei.xml', 'KeyError', "'x'", '')
+            failures.write_errors(outfile, [error])
+            self.assertEqual([error], failures.read_errors(outfile))
+            failures.write_errors(outfile, [])
+            self.assertFalse(Path(failures.errors_path(outfile)).exists())
+            self.assertEqual([], failures.read_errors(outfile))
+
+    def test_retry_failed_into_unordered_output(self):
+        def run_main(outfile, *options):
+            subprocess.run(
+                [sys.executable, 'main.py', tmpdir, str(outfile), '--parser',
+                 'lxml', '--workers', '1', '--quiet', *options],
+                cwd=Path(__file__).parent, check=True,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            synthetic_corpus.write_corpus(tmpdir, 5, large_share=0)
+            broken = Path(tmpdir) / 'paper000002.tei.xml'
+            tei = broken.read_text()
+            broken.write_text('<TEI><teiHeader>&')
+            outdir = Path(tmpdir) / 'out'
+            outdir.mkdir()
+            outfile = outdir / 'out.csv'
+            run_main(outfile)
+            self.assertEqual([str(broken)], [
+                error.file for error in failures.read_errors(outfile)])
+            # Rows of an unordered run, in the worst order.
+            header, *lines = outfile.read_text().splitlines(keepends=True)
+            outfile.write_text(header + ''.join(sorted(lines, reverse=True)))
+
+            broken.write_text(tei)
+            run_main(outfile, '--retry-failed')
+            run_main(outdir / 'full.csv', '--ordered')
+            self.assertEqual((outdir / 'full.csv').read_text(),
+                             outfile.read_text())
+            self.assertEqual([], failures.read_errors(outfile))
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.outfile = Path(self.tmpdir.name) / 'out.csv'
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_resume_after_crash(self):
+        run = checkpoint.Checkpoint.open(self.outfile, {'run': 1})
+        error = failures.TaskError('dir/c.tei.xml', 'KeyError', "'x'", '')
+        run.add([('a', '1'), ('a', '2')], [])
+        run.add([('b', 'x,y')], [error])
+        # A crash while writing the next batch.
+        run._partial.write('d,torn')
+        run._partial.flush()
+        run._log.write('{"offset": ')
+        run.close()
+
+        resumed = checkpoint.Checkpoint.open(self.outfile, {'run': 1})
+        self.assertEqual({'a', 'b', 'c'}, resumed.done)
+        self.assertEqual([error], resumed.errors)
+        resumed.add([('e', '')], [])
+        resumed.close()
+        self.assertEqual([['a', '1'], ['a', '2'], ['b', 'x,y'], ['e', '']],
+                         list(resumed.rows()))
+        again = checkpoint.Checkpoint.open(self.outfile, {'run': 1})
+        again.close()
+        self.assertEqual({'a', 'b', 'c', 'e'}, again.done)
+
+    def test_other_settings_start_over(self):
+        run = checkpoint.Checkpoint.open(self.outfile, {'run': 1})
+        run.add([('a', '1')], [])
+        run.close()
+        other = checkpoint.Checkpoint.open(self.outfile, {'run': 2})
+        other.close()
+        self.assertEqual(set(), other.done)
+        self.assertEqual([], list(other.rows()))
+        other.remove()
+        self.assertEqual([], list(Path(self.tmpdir.name).iterdir()))
+
+
+class PrefetchTest(unittest.TestCase):
+
+    def test_prefetched_in_order(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = [str(write_tei(tmpdir, name)) for name in 'abcde']
+            missing = str(Path(tmpdir) / 'missing.txt')
+            prefetcher = prefetch.Prefetcher(lambda path: [path, missing],
+                                             concurrency=2, buffered=2)
+            results = list(prefetcher.prefetch(paths))
+        self.assertEqual(paths, [task for task, _ in results])
+        for path, contents in results:
+            self.assertEqual(SAMPLE_TEI.encode(), contents[path])
+            self.assertIsNone(contents[missing])
+
+    def test_chunks_keep_their_tasks(self):
+        prefetcher = prefetch.Prefetcher(lambda task: [],
+                                         read_file=lambda path: b'')
+        chunks = [['a', 'b'], ['c'], ['d', 'e', 'f']]
+        self.assertEqual(
+            [[(task, {}) for task in chunk] for chunk in chunks],
+            list(prefetcher.prefetch_chunks(chunks)))
+
+    def test_read_errors_are_raised(self):
+        def read_file(path):
+            raise OSError(path)
+
+        prefetcher = prefetch.Prefetcher(lambda task: [task],
+                                         read_file=read_file)
+        with self.assertRaises(OSError):
+            list(prefetcher.prefetch(['a', 'b']))
+
+    def test_batch_reads_prefetched_contents(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tei_file = str(write_tei(tmpdir, 'sample'))
+            task = (tei_file, tmpdir)
+            expected = bacteriacsv.tei_to_csv_entries(task)
+            contents = {path: prefetch.read_bytes(path)
+                        for path in bacteriacsv.paper_files(task)}
+            # The files are gone, only the prefetched contents are left.
+            Path(tei_file).unlink()
+            prefetched_batch = prefetch.PrefetchedBatch(
+                partial(pipeline.map_tasks, bacteriacsv.tei_to_csv_entries))
+            self.assertEqual([expected], prefetched_batch([(task, contents)]))
+        self.assertFalse(prefetch._prefetched)
+
+
+class ProgressTest(unittest.TestCase):
+
+    def test_reports_at_interval(self):
+        now = [0.0]
+        stream = io.StringIO()
+        tracker = progress.Progress(100, interval=10, stream=stream,
+                                    clock=lambda: now[0])
+        now[0] = 5
+        tracker.update(10)
+        self.assertEqual('', stream.getvalue())
+        now[0] = 10
+        tracker.update(10, errors=1)
+        self.assertEqual(
+            "Handled 20/100 files (20.0%), 2.0 files/s, ETA 40s, 1 errors\n",
+            stream.getvalue())
+        now[0] = 12
+        tracker.update(80)
+        tracker.finish()
+        self.assertTrue(stream.getvalue().endswith(
+            "Handled 100/100 files (100.0%), 8.3 files/s, took 12s, 1 errors\n"))
+
+    def test_silent_and_log_file(self):
+        progress.open_progress(3, interval=0, quiet=True).update(3)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            log_file = Path(tmpdir) / 'progress.log'
+            tracker = progress.open_progress(2, interval=0, log_file=log_file)
+            tracker.update(2)
+            tracker.finish()
+            self.assertEqual(2, len(log_file.read_text().splitlines()))
+
+    def test_log_file_closed_on_error(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            log_file = Path(tmpdir) / 'progress.log'
+            tracker = progress.open_progress(2, log_file=log_file)
+            with self.assertRaises(ValueError):
+                with tracker:
+                    raise ValueError("failed run")
+            self.assertTrue(tracker.stream.closed)
+
+    def test_duration(self):
+        self.assertEqual("59s", progress.format_duration(59.9))
+        self.assertEqual("2m 05s", progress.format_duration(125))
+        self.assertEqual("3h 00m", progress.format_duration(3 * 3600 + 30))
+
+
+class StageTimingsTest(unittest.TestCase):
+
+    def tearDown(self):
+        stage_timings.disable_timings()
+
+    def test_disabled_by_default(self):
+        with stage_timings.document('a'):
+            with stage_timings.timed('parse'):
+                pass
+        self.assertEqual([], stage_timings.collect_timings())
+
+    def test_nested_stages_count_once(self):
+        stage_timings.enable_timings()
+        with stage_timings.document('a'):
+            with stage_timings.timed('text', lambda: 3):
+                with stage_timings.timed('parse'):
+                    time.sleep(0.02)
+        documents = stage_timings.collect_timings()
+        self.assertEqual(['a'], [timings.name for timings in documents])
+        seconds = documents[0].seconds
+        self.assertGreaterEqual(seconds['parse'], 0.02)
+        self.assertLess(seconds['text'], 0.02)
+        self.assertEqual({'text': 3}, documents[0].bytes)
+        self.assertEqual([], stage_timings.collect_timings())
+
+    def test_stages_outside_documents_share_one_entry(self):
+        stage_timings.enable_timings()
+        for _ in range(3):
+            with stage_timings.timed('parse'):
+                pass
+            stage_timings.count('match_memo_hits')
+        (outside, ) = stage_timings.collect_timings()
+        self.assertEqual('', outside.name)
+        self.assertEqual({'match_memo_hits': 3}, outside.counts)
+        stage_timings.count('match_memo_hits')
+        (outside, ) = stage_timings.collect_timings()
+        self.assertEqual({'match_memo_hits': 1}, outside.counts)
+
+    def test_summary_and_slowest(self):
+        timings = stage_timings.StageTimings()
+        for number in range(1, 21):
+            document_timings = stage_timings.DocumentTimings(f'doc{number}')
+            document_timings.add('parse', number / 100, size=1000)
+            timings.add([document_timings])
+        summary = timings.stage_summary()['parse']
+        self.assertEqual(20, summary['documents'])
+        self.assertEqual(0.1, summary['p50'])
+        self.assertEqual(0.19, summary['p95'])
+        self.assertEqual(0.2, summary['max'])
+        self.assertEqual(20000, summary['bytes'])
+        self.assertEqual(['doc20', 'doc19'],
+                         [slow.name for slow in timings.slowest(2)])
+
+    def test_collected_from_workers(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tasks = [(str(write_tei(tmpdir, name)), tmpdir)
+                     for name in ['a', 'b', 'c']]
+            timings = stage_timings.StageTimings()
+            with pipeline.create_pool(2, None, bacteriacsv.init_worker,
+                                      (None, None, True)) as pool:
+                list(pipeline.imap_batches(
+                    pool, bacteriacsv.tei_batch_to_csv_columns, tasks,
+                    [1, 1, 1], chunksize=2, stage_timings=timings))
+                pool.close()
+                pool.join()
+        self.assertCountEqual([task[0] for task in tasks],
+                              [document.name for document in timings.documents])
+        summary = timings.stage_summary()
+        self.assertEqual(3, summary['parse']['documents'])
+        self.assertEqual(3, summary['match_text']['documents'])
+
+
+class SyntheticCorpusTest(unittest.TestCase):
+
+    def test_papers_with_features(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            synthetic_corpus.write_corpus(
+                tmpdir, 3, large_share=0, accession_density=1,
+                primer_density=1, missing_doi_share=0)
+            teis = bacteriacsv.all_teis(tmpdir)
+            self.assertEqual(3, len(teis))
+            tei = BacteriaPaper(teis[1], tmpdir)
+            features = tei.features()
+            self.assertEqual("10.1234/bench.1", tei.doi())
+            self.assertEqual(4, len(tei.authors()))
+            self.assertTrue(features.accession_numbers)
+            self.assertTrue(features.has_515_primer)
+            self.assertIn("Materials and methods", tei.text)
+
+    def test_record_has_sorted_accession_numbers(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            synthetic_corpus.write_corpus(tmpdir, 1, large_share=0,
+                                          accession_density=1)
+            tei_file = bacteriacsv.all_teis(tmpdir)[0]
+            record = bacteriacsv.tei_to_record((str(tei_file), tmpdir))
+            self.assertGreater(len(record['accession']), 1)
+            self.assertEqual(sorted(record['accession']), record['accession'])
+
+    def test_doi_from_pdftotext(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            synthetic_corpus.write_corpus(tmpdir, 1, missing_doi_share=1)
+            tei_file = bacteriacsv.all_teis(tmpdir)[0]
+            self.assertEqual('', TEIFile(tei_file).doi())
+            self.assertEqual("10.1234/bench.0",
+                             BacteriaPaper(tei_file, tmpdir).doi())
+
+
+class RecordOutputTest(unittest.TestCase):
+
+    schema = [('ID', 'string'), ('16ness', 'bool'),
+              ('accession', 'list<string>')]
+    records = [
+        {'ID': 'a', '16ness': True, 'accession': ['PRJNA1', 'SRR123456']},
+        {'ID': 'b', '16ness': False, 'accession': []},
+    ]
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_format_from_extension(self):
+        self.assertEqual('parquet', pipeline.output_format('out.parquet'))
+        self.assertEqual('arrow', pipeline.output_format('out.feather'))
+        self.assertEqual('csv', pipeline.output_format('out.txt'))
+        self.assertEqual('jsonl', pipeline.output_format('out.csv', 'jsonl'))
+
+    def test_jsonl_keeps_lists(self):
+        outfile = Path(self.tmpdir.name) / 'out.jsonl'
+        pipeline.write_records(outfile, 'jsonl', self.schema, iter(self.records))
+        lines = outfile.read_text().splitlines()
+        self.assertEqual(self.records, [json.loads(line) for line in lines])
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), "needs pyarrow")
+    def test_parquet_in_row_groups(self):
+        import pyarrow.parquet as pq
+
+        outfile = Path(self.tmpdir.name) / 'out.parquet'
+        records = self.records * 3
+        pipeline.write_arrow(outfile, self.schema, iter(records), 'parquet',
+                             batch_size=4)
+        self.assertEqual(records, pq.read_table(outfile).to_pylist())
+        self.assertEqual(2, pq.ParquetFile(outfile).num_row_groups)
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), "needs pyarrow")
+    def test_arrow_ipc_file(self):
+        import pyarrow as pa
+
+        outfile = Path(self.tmpdir.name) / 'out.arrow'
+        pipeline.write_records(outfile, 'arrow', self.schema, iter(self.records))
+        self.assertEqual(self.records,
+                         pa.ipc.open_file(str(outfile)).read_all().to_pylist())
+
+    def test_column_batches(self):
+        columns = [name for name, _ in self.schema]
+        batch = pipeline.records_to_columns(columns, self.records)
+        self.assertEqual({'ID': ['a', 'b'], '16ness': [True, False],
+                          'accession': [['PRJNA1', 'SRR123456'], []]}, batch)
+        self.assertEqual(self.records, list(pipeline.columns_to_records(batch)))
+        rows = [('a', True, []), ('b', False, ['SRR1'])]
+        self.assertEqual(rows, list(pipeline.columns_to_rows(
+            pipeline.rows_to_columns(columns, rows))))
+
+    def test_column_groups(self):
+        batches = [{'ID': ['a', 'b', 'c']}, {'ID': []}, {'ID': ['d', 'e']}]
+        self.assertEqual([{'ID': ['a', 'b']}, {'ID': ['c', 'd']}, {'ID': ['e']}],
+                         list(pipeline.column_groups(batches, size=2)))
+        self.assertEqual([], list(pipeline.column_groups([])))
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), "needs pyarrow")
+    def test_parquet_from_column_batches(self):
+        import pyarrow.parquet as pq
+
+        columns = [name for name, _ in self.schema]
+        records = self.records * 3
+        batches = [pipeline.records_to_columns(columns, records[i:i + 3])
+                   for i in range(0, len(records), 3)]
+        outfile = Path(self.tmpdir.name) / 'out.parquet'
+        pipeline.write_arrow_columns(outfile, self.schema, iter(batches),
+                                     'parquet', batch_size=4)
+        self.assertEqual(records, pq.read_table(outfile).to_pylist())
+        self.assertEqual(2, pq.ParquetFile(outfile).num_row_groups)
+
+
+class AccessionHitsTest(unittest.TestCase):
+
+    def test_hits_with_offset_and_context(self):
+        text = "Reads in PRJNA123456 and SRR1234567, see prjna123456."
+        hits = accessions.find_accessions(text, 'tei', window=5)
+        self.assertEqual(['PRJNA123456', 'SRR1234567', 'prjna123456'],
+                         [hit.accession for hit in hits])
+        self.assertEqual(['PRJ', 'SRR', 'PRJ'], [hit.type for hit in hits])
+        self.assertEqual(9, hits[0].offset)
+        self.assertEqual("s in PRJNA123456 and ", hits[0].context)
+
+        unique = accessions.unique_hits(hits)
+        self.assertEqual([('PRJNA123456', 2), ('SRR1234567', 1)],
+                         [(hit.accession, hit.occurrences) for hit in unique])
+        self.assertEqual(1, hits[0].occurrences)
+
+    def test_paper_hits_from_tei_and_pdftotext(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tei_file = write_tei(tmpdir, 'a')
+            (Path(tmpdir) / 'a.txt').write_text(
+                "Deposited as SAMN00000001\nand PRJNA123456.\n")
+            hits = BacteriaPaper(tei_file, tmpdir).accession_hits()
+            self.assertEqual([('PRJNA123456', 'tei', 2),
+                              ('SAMN00000001', 'pdftotext', 1)],
+                             [(hit.accession, hit.source, hit.occurrences)
+                              for hit in hits])
+            # Without a pdftotext file only the TEI text is scanned.
+            (Path(tmpdir) / 'a.txt').unlink()
+            hits = BacteriaPaper(tei_file, tmpdir).accession_hits()
+            self.assertEqual(['PRJNA123456'],
+                             [hit.accession for hit in hits])
+
+    def test_long_format_columns(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tei_file = write_tei(tmpdir, 'a')
+            write_tei(tmpdir, 'b', SAMPLE_TEI.replace('PRJNA123456', 'none'))
+            params = [(str(tei), tmpdir)
+                      for tei in bacteriacsv.all_teis(tmpdir)]
+            batch = accessioncsv.tei_batch_to_accession_columns(params)
+            self.assertEqual(accessions.ACCESSION_COLUMNS, list(batch))
+            self.assertEqual(['a'], batch['ID'])
+            self.assertEqual(['PRJNA123456'], batch['accession'])
+            text = TEIFile(tei_file).text
+            offset = batch['offset'][0]
+            self.assertEqual('PRJNA123456', text[offset:offset + 11])
+
+
+class BatchMatchingTest(unittest.TestCase):
+
+    texts = FeaturesTest.texts + [
+        "Illumina MiSeq of the V4 region, PRJNA1 and SRR1234567, 515 f.",
+        # Matched with re: a long s, a vertical tab and Arabic digits.
+        "\u017frr123456 16S rRNA", "V3\x0band V4", "SRR\u0661\u0662\u0663456789",
+        ""]
+
+    def test_same_features_as_row_by_row(self):
+        expected = batch_matching.rows_features(self.texts)
+        self.assertEqual(['PRJNA1', 'SRR1234567'],
+                         expected['accession_numbers'][-5])
+        series = pd.Series(self.texts + [None], index=range(10, 10 + len(
+            self.texts) + 1))
+        frame = batch_matching.text_features_frame(series, chunksize=4)
+        self.assertEqual(list(series.index), list(frame.index))
+        self.assertEqual(batch_matching.row_features(''),
+                         tuple(frame.iloc[-1]))
+        for column in batch_matching.FEATURE_COLUMNS:
+            self.assertEqual(expected[column], list(frame[column])[:-1])
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), "needs pyarrow")
+    def test_arrow_texts(self):
+        import pyarrow as pa
+
+        expected = batch_matching.rows_features(self.texts)
+        texts = pa.chunked_array([self.texts[:3], self.texts[3:]])
+        self.assertEqual(expected,
+                         batch_matching.text_features_columns(texts, 5))
+        # All texts at once with the kernels.
+        kernel_texts = [text for text in self.texts
+                        if text.isascii() and '\x0b' not in text]
+        self.assertEqual(batch_matching.rows_features(kernel_texts),
+                         batch_matching.arrow_features(pa.array(kernel_texts)))
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), "needs pyarrow")
+    def test_hazards_cover_unicode_spaces(self):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        spaces = [chr(code) for code in range(0x3001) if chr(code).isspace()]
+        hazards = pc.match_substring_regex(pa.array(spaces),
+                                           batch_matching.RE2_HAZARDS)
+        self.assertEqual([space not in ' \t\n\r\f' for space in spaces],
+                         hazards.to_pylist())
+
+
+class TextIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        directory = self.tmpdir.name
+        write_tei(directory, 'a')
+        write_tei(directory, 'b', SAMPLE_TEI.replace(
+            '16S rRNA V4 region with Illumina MiSeq (PRJNA123456)',
+            'soil with Solexa'))
+        write_tei(directory, 'c', SAMPLE_TEI.replace('PRJNA123456', 'none'))
+        (Path(directory) / 'b.txt').write_text("Reads at SRR1234567.\n")
+        self.index_file = Path(directory) / 'index.sqlite'
+        text_index.build_index(self.index_file,
+                               bacteriacsv.all_teis(directory), directory,
+                               workers=1, segment_size=2)
+        self.index = text_index.TextIndex(self.index_file)
+
+    def tearDown(self):
+        self.index.close()
+        self.tmpdir.cleanup()
+
+    def test_varints(self):
+        numbers = [0, 1, 127, 128, 300, 2 ** 40]
+        buffer = bytearray()
+        for number in numbers:
+            text_index.encode_varint(number, buffer)
+        self.assertEqual(b'\x00\x01\x7f\x80\x01', bytes(buffer[:5]))
+        self.assertEqual(numbers, list(text_index.decode_varints(buffer)))
+
+    def test_postings_point_at_tokens(self):
+        postings = list(self.index.postings('rrna'))
+        self.assertEqual([0, 2], [posting.doc for posting in postings])
+        text = TEIFile(self.index.document(0)[0]).text
+        (offset, ) = postings[0].fields['text']
+        self.assertEqual('rRNA', text[offset:offset + 4])
+        # Documents across segments.
+        self.assertEqual([0, 1, 2], [posting.doc for posting in
+                                     self.index.postings('genome')])
+        self.assertEqual([1], [posting.doc for posting in
+                               self.index.postings('srr1234567')])
+
+    def test_search(self):
+        self.assertEqual([0, 2], self.index.search("16S rRNA"))
+        self.assertEqual([1], self.index.search("soil Solexa"))
+        self.assertEqual([], self.index.search("soil MiSeq"))
+        self.assertEqual([0, 1, 2], self.index.search("Genome",
+                                                      ['title', 'abstract']))
+        self.assertEqual([], self.index.search("Sequenced", ['title']))
+
+    def test_tokens_containing(self):
+        self.assertEqual(['prjna123456', 'srr1234567'], sorted(
+            self.index.tokens_containing(['prjna', 'srr', 'prjna'])))
+        self.assertEqual([], self.index.tokens_containing([]))
+
+    def test_candidates_narrow_matches(self):
+        patterns = text_index.MATCHER_PATTERNS['accession_numbers']
+        self.assertEqual([0, 1], self.index.candidates(patterns))
+        self.assertEqual([0], self.index.candidates(patterns, ['text']))
+        gene_regions = text_index.MATCHER_PATTERNS['gene_regions']
+        self.assertEqual([0, 1, 2], self.index.candidates(gene_regions))
+        all_docs = sorted(self.index.all_documents())
+        for matcher in text_index.MATCHER_PATTERNS:
+            self.assertEqual(
+                list(self.index.matches(matcher, docs=all_docs)),
+                list(self.index.matches(matcher)))
+        self.assertEqual([(0, 'text', ['PRJNA123456']),
+                          (1, 'pdftotext', ['SRR1234567'])],
+                         list(self.index.matches('accession_numbers')))
+
+
+class ShardingTest(unittest.TestCase):
+
+    def run_tool(self, *args):
+        # As on separate hosts, every shard runs in a process of its own.
+        return subprocess.Popen(
+            [sys.executable, *args], cwd=Path(__file__).parent,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def test_shards_cover_every_file_once(self):
+        teis = [f'/data/paper{number:06d}.tei.xml' for number in range(100)]
+        shards = [sharding.shard_teis(teis, index, 3) for index in range(3)]
+        self.assertEqual(sorted(teis), sorted(sum(shards, [])))
+        self.assertTrue(all(shards))
+        # Only the file name counts, not the directory on a host.
+        self.assertEqual(sharding.shard_of(teis[0], 3),
+                         sharding.shard_of('other/paper000000.tei.xml', 3))
+
+    def test_parse_shard(self):
+        self.assertEqual((1, 4), sharding.parse_shard('1/4'))
+        for value in ['4/4', '-1/4', '0/0', '1', 'a/b']:
+            with self.assertRaises(Exception):
+                sharding.parse_shard(value)
+        self.assertEqual('out.shard-1-of-4.csv',
+                         sharding.shard_path('out.csv', 1, 4))
+
+    def write_shards(self, outfile, shard_teis, inputs):
+        # inputs is the number of input files each shard saw.
+        for index, (teis, input_count) in enumerate(zip(shard_teis, inputs)):
+            shard_file = sharding.shard_path(outfile, index, len(shard_teis))
+            pipeline.write_csv(shard_file, ['ID'], [])
+            sharding.write_shard_manifest(
+                shard_file, (index, len(shard_teis)), 'csv',
+                {'tool': 'bacteriacsv'}, True, teis, input_count, [])
+
+    def test_shards_of_other_hosts_are_merged(self):
+        names = [f'paper{number}.tei.xml' for number in range(6)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = Path(tmpdir) / 'out.csv'
+            # Same file names in another directory on each host.
+            self.write_shards(outfile, [
+                [f'/host{index}/{name}'
+                 for name in sharding.shard_teis(names, index, 2)]
+                for index in range(2)], [6, 6])
+            self.assertEqual([], sharding.merge_shards(outfile, 2))
+
+    def test_shards_of_other_inputs_are_not_merged(self):
+        names = [f'paper{number}.tei.xml' for number in range(6)]
+        shards = [sharding.shard_teis(names, index, 2) for index in range(2)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = Path(tmpdir) / 'out.csv'
+            # A file missing from the input of one shard.
+            self.write_shards(outfile, [shards[0], shards[1][1:]], [6, 6])
+            with self.assertRaises(RuntimeError):
+                sharding.merge_shards(outfile, 2)
+            # Inputs with a different number of files.
+            self.write_shards(outfile, shards, [6, 7])
+            with self.assertRaises(RuntimeError):
+                sharding.merge_shards(outfile, 2)
+
+    def test_stale_manifest_is_removed(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = Path(tmpdir) / 'out.csv'
+            shard_files = sharding.shard_files_of(outfile, 2)
+            incremental.Manifest({}).save(incremental.manifest_path(outfile))
+            incremental.Manifest({}).save(
+                incremental.manifest_path(shard_files[0]))
+            self.assertFalse(sharding.merge_manifests(outfile, shard_files))
+            self.assertFalse(
+                Path(incremental.manifest_path(outfile)).exists())
+
+    def test_manifests_of_other_settings_are_not_merged(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = Path(tmpdir) / 'out.csv'
+            shard_files = sharding.shard_files_of(outfile, 2)
+            incremental.Manifest({}).save(incremental.manifest_path(outfile))
+            for shard_file, pdftotexts in zip(shard_files, ['/a', '/b']):
+                incremental.Manifest({'pdftotexts': pdftotexts}).save(
+                    incremental.manifest_path(shard_file))
+            self.assertFalse(sharding.merge_manifests(outfile, shard_files))
+            self.assertFalse(
+                Path(incremental.manifest_path(outfile)).exists())
+
+    def test_merged_shards_equal_unsharded_run(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            synthetic_corpus.write_corpus(tmpdir, 12, large_share=0,
+                                          accession_density=0)
+            outdir = Path(tmpdir) / 'out'
+            outdir.mkdir()
+            common = ['bacteriacsv.py', tmpdir, tmpdir]
+            options = ['--ordered', '--workers', '1', '--quiet']
+            with self.assertRaises(RuntimeError):
+                sharding.merge_shards(outdir / 'sharded.csv', 2)
+
+            runs = [self.run_tool(*common, str(outdir / 'full.csv'), *options)]
+            runs += [self.run_tool(*common, str(outdir / 'sharded.csv'),
+                                   *options, '--shard', f'{index}/2')
+                     for index in range(2)]
+            self.assertEqual([0, 0, 0], [run.wait() for run in runs])
+            merge = self.run_tool('sharding.py', str(outdir / 'sharded.csv'),
+                                  '2', '--remove')
+            self.assertEqual(0, merge.wait())
+
+            self.assertEqual((outdir / 'full.csv').read_text(),
+                             (outdir / 'sharded.csv').read_text())
+            self.assertEqual(['full.csv', 'sharded.csv'],
+                             sorted(path.name for path in outdir.iterdir()))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import time
+from dataclasses import dataclass
+from functools import partial
+
+from bacteria_regex import BacteriaMatcher, LiteralPrefilter, lowercase_text
+from bacteriacsv import all_teis, init_worker, pdftotext_path, tei_inputs
+from failures import isolated, report_errors
+from parse_cache import open_cache
+from pdftotext_reader import PDFToText
+from pipeline import create_pool, imap_batches, task_size
+from progress import DEFAULT_INTERVAL, open_progress
+from teireader import TEIFile
+
+
+# Bump when the tokens or the encoding of the postings change.
+INDEX_VERSION = 2
+
+FIELDS = ['title', 'abstract', 'text', 'pdftotext']
+TOKEN = re.compile(r'\w+')
+NON_TOKEN = re.compile(r'\W+')
+# Documents per segment of a posting list, to bound the memory of a build.
+DEFAULT_SEGMENT_SIZE = 1000
+
+# Patterns of each BacteriaMatcher method. A document can only match if it
+# contains the anchors LiteralPrefilter finds in them.
+MATCHER_PATTERNS = {
+    'accession_numbers': BacteriaMatcher.accession_no_matcher.patterns,
+    'data_source': BacteriaMatcher.data_source_matcher.patterns,
+    'matches_16ness': [BacteriaMatcher.gene_region_16ness.pattern],
+    'gene_regions': BacteriaMatcher.gene_regions_matcher.patterns,
+    'sequencing_method':
+        BacteriaMatcher.sequencing_matcher.miseq_hiseq_matcher.patterns +
+        [BacteriaMatcher.sequencing_matcher.illumina_regex.pattern] +
+        BacteriaMatcher.sequencing_matcher.patterns,
+    'has_515_primer': BacteriaMatcher.primer_515.patterns,
+    'has_806_primer': BacteriaMatcher.primer_806.patterns
+}
+
+
+def encode_varint(number, buffer):
+    # Seven bits per byte, lowest first. The high bit marks more bytes.
+    while number >= 0x80:
+        buffer.append(number & 0x7f | 0x80)
+        number >>= 7
+    buffer.append(number)
+
+
+def decode_varints(data):
+    number = 0
+    shift = 0
+    for byte in data:
+        number |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            yield number
+            number = 0
+            shift = 0
+
+
+def read_fields(tei_file, pdftotext_file, fields=FIELDS, cache=None):
+    # Text of the fields of a document. The pdftotext field is left out
+    # without a pdftotext file.
+    tei = TEIFile(tei_file, cache=cache)
+    texts = {}
+    for field in fields:
+        if field != 'pdftotext':
+            texts[field] = getattr(tei, field)
+    tei.update_cache()
+    if 'pdftotext' in fields and pdftotext_file and\
+            os.path.exists(pdftotext_file):
+        pdftotext = PDFToText(pdftotext_file, cache)
+        texts['pdftotext'] = pdftotext.text
+        pdftotext.update_cache()
+    return texts
+
+
+def document_postings(texts):
+    # Encoded postings of each token of a document: the number of fields,
+    # then per field its position in FIELDS, the number of occurrences and
+    # their offsets as deltas. Tokens are lowercased runs of word characters
+    # with offsets into the field. Also returns whether the tokens are exact,
+    # which they are not if lowering changes offsets or misses
+    # case-insensitive matches.
+    occurrences = {}
+    exact = True
+    for field_id, field in enumerate(FIELDS):
+        text = texts.get(field)
+        if not text:
+            continue
+        lowered = lowercase_text(text)
+        if lowered is None:
+            exact = False
+            lowered = text.lower()
+        for match in TOKEN.finditer(lowered):
+            by_field = occurrences.setdefault(match.group(), {})
+            by_field.setdefault(field_id, []).append(match.start())
+
+    postings = {}
+    for token, by_field in occurrences.items():
+        buffer = bytearray()
+        encode_varint(len(by_field), buffer)
+        for field_id, offsets in by_field.items():
+            encode_varint(field_id, buffer)
+            encode_varint(len(offsets), buffer)
+            previous = 0
+            for offset in offsets:
+                encode_varint(offset - previous, buffer)
+                previous = offset
+        postings[token] = bytes(buffer)
+    return postings, exact
+
+
+def index_document(param, cache_file=None, cache_size=None):
+    tei_file, pdftotexts_directory = param
+    pdftotext_file = str(pdftotext_path(tei_file, pdftotexts_directory))
+    cache = open_cache(cache_file, cache_size)
+    texts = read_fields(tei_file, pdftotext_file, cache=cache)
+    if 'pdftotext' not in texts:
+        pdftotext_file = ''
+    postings, exact = document_postings(texts)
+    return tei_file, pdftotext_file, postings, exact
+
+
+def index_batch(params, cache_file=None, cache_size=None):
+    # Postings of a batch of TEI files. TEI files that fail are left out
+    # and reported separately.
+    to_postings = partial(index_document, cache_file=cache_file,
+                          cache_size=cache_size)
+    return list(isolated(to_postings, params, lambda param: param[0]))
+
+
+def create_schema(connection):
+    connection.execute(
+        'CREATE TABLE meta (key TEXT PRIMARY KEY, value)')
+    connection.execute(
+        'CREATE TABLE documents (id INTEGER PRIMARY KEY, tei_file TEXT, '
+        'pdftotext_file TEXT, exact INTEGER)')
+    # A posting list is split into segments of documents from first_doc on.
+    connection.execute(
+        'CREATE TABLE postings (token TEXT, first_doc INTEGER, '
+        'documents INTEGER, data BLOB, PRIMARY KEY (token, first_doc)) '
+        'WITHOUT ROWID')
+    # Distinct tokens, to find tokens by substring without reading postings.
+    connection.execute(
+        'CREATE TABLE tokens (token TEXT PRIMARY KEY) WITHOUT ROWID')
+    connection.execute(
+        'INSERT INTO meta VALUES (?, ?)', ('version', INDEX_VERSION))
+
+
+class IndexWriter(object):
+    def __init__(self, filename, segment_size=DEFAULT_SEGMENT_SIZE):
+        # Builds a new index next to filename, which replaces filename on
+        # close. Documents get increasing IDs in the order they are added.
+        # Each token collects the postings of up to segment_size documents
+        # in memory: the ID as delta to the previous document, or to the
+        # first of the segment, followed by the document postings.
+        self.filename = filename
+        self.segment_size = segment_size
+        self._tmp_filename = f'{filename}.tmp'
+        if os.path.exists(self._tmp_filename):
+            os.remove(self._tmp_filename)
+        self.connection = sqlite3.connect(self._tmp_filename)
+        create_schema(self.connection)
+        self.documents = 0
+        self._segment_start = 0
+        # Per token: first and last document and the encoded postings.
+        self._segment = {}
+
+    def add(self, tei_file, pdftotext_file, postings, exact=True):
+        doc = self.documents
+        self.documents += 1
+        self.connection.execute(
+            'INSERT INTO documents VALUES (?, ?, ?, ?)',
+            (doc, tei_file, pdftotext_file, exact))
+        for token, data in postings.items():
+            segment = self._segment.get(token)
+            if segment is None:
+                segment = self._segment[token] = [doc, doc, 0, bytearray()]
+            encode_varint(doc - segment[1], segment[3])
+            segment[3] += data
+            segment[1] = doc
+            segment[2] += 1
+        if self.documents - self._segment_start >= self.segment_size:
+            self.flush()
+
+    def flush(self):
+        self.connection.executemany(
+            'INSERT INTO postings VALUES (?, ?, ?, ?)',
+            ((token, first_doc, documents, bytes(data))
+             for token, (first_doc, _, documents, data)
+             in self._segment.items()))
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO tokens VALUES (?)',
+            ((token, ) for token in self._segment))
+        self.connection.commit()
+        self._segment = {}
+        self._segment_start = self.documents
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+        os.replace(self._tmp_filename, self.filename)
+
+
+@dataclass
+class Posting:
+    doc: int
+    # Offsets of the token per field name.
+    fields: dict
+
+
+def decode_postings(first_doc, data, fields=None):
+    # Postings of a segment, only with the given fields if any. Documents
+    # without any of the fields are skipped.
+    numbers = decode_varints(data)
+    doc = first_doc
+    for delta in numbers:
+        doc += delta
+        offsets = {}
+        for _ in range(next(numbers)):
+            field = FIELDS[next(numbers)]
+            count = next(numbers)
+            field_offsets = []
+            offset = 0
+            for _ in range(count):
+                offset += next(numbers)
+                field_offsets.append(offset)
+            if fields is None or field in fields:
+                offsets[field] = field_offsets
+        if offsets:
+            yield Posting(doc, offsets)
+
+
+def query_tokens(text):
+    # Tokens of a query, the same as for the indexed text.
+    return TOKEN.findall(text.lower())
+
+
+def literal_pieces(literal):
+    # Word character runs of an anchor literal. Every occurrence of the
+    # literal has each run within a single token.
+    return [piece for piece in NON_TOKEN.split(literal) if piece]
+
+
+class TextIndex(object):
+    def __init__(self, filename):
+        if not os.path.exists(filename):
+            raise RuntimeError(f"No text index at {filename}")
+        self.filename = filename
+        self.connection = sqlite3.connect(str(filename))
+        (version, ) = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if version != INDEX_VERSION:
+            raise RuntimeError(
+                f"Text index {filename} has version {version}, not "
+                f"{INDEX_VERSION}: build it again")
+
+    def __len__(self):
+        (count, ) = self.connection.execute(
+            'SELECT COUNT(*) FROM documents').fetchone()
+        return count
+
+    def document(self, doc):
+        # TEI and pdftotext file of a document, the latter '' if missing.
+        return self.connection.execute(
+            'SELECT tei_file, pdftotext_file FROM documents WHERE id = ?',
+            (doc, )).fetchone()
+
+    def all_documents(self):
+        return set(doc for (doc, ) in self.connection.execute(
+            'SELECT id FROM documents'))
+
+    def inexact_documents(self):
+        # Documents whose tokens may miss case-insensitive matches.
+        return set(doc for (doc, ) in self.connection.execute(
+            'SELECT id FROM documents WHERE NOT exact'))
+
+    def postings(self, token, fields=None):
+        rows = self.connection.execute(
+            'SELECT first_doc, data FROM postings WHERE token = ? '
+            'ORDER BY first_doc', (token, ))
+        for first_doc, data in rows:
+            yield from decode_postings(first_doc, data, fields)
+
+    def documents_with(self, token, fields=None):
+        return set(posting.doc for posting in self.postings(token, fields))
+
+    def tokens_containing(self, pieces):
+        # Tokens that contain any of the pieces, in one scan of the tokens.
+        pieces = sorted(set(pieces))
+        if not pieces:
+            return []
+        condition = ' OR '.join(['instr(token, ?) > 0'] * len(pieces))
+        return [token for (token, ) in self.connection.execute(
+            f'SELECT token FROM tokens WHERE {condition}', pieces)]
+
+    def search(self, query, fields=None):
+        # Sorted IDs of the documents with all tokens of the query.
+        docs = None
+        for token in query_tokens(query):
+            with_token = self.documents_with(token, fields)
+            docs = with_token if docs is None else docs & with_token
+            if not docs:
+                break
+        return sorted(docs or [])
+
+    def candidates(self, patterns, fields=None):
+        # Sorted IDs of the documents that may match any of the patterns,
+        # from the anchors LiteralPrefilter uses to skip text. Without an
+        # anchor in every pattern, all documents are candidates.
+        anchors = LiteralPrefilter(patterns).anchors
+        if anchors is None:
+            return sorted(self.all_documents())
+        longest_pieces = []
+        for literals, _, _ in anchors:
+            for literal in literals:
+                pieces = literal_pieces(literal)
+                if not pieces:
+                    return sorted(self.all_documents())
+                # The longest run is the most selective.
+                longest_pieces.append(max(pieces, key=len))
+        docs = self.inexact_documents()
+        for token in self.tokens_containing(longest_pieces):
+            docs.update(self.documents_with(token, fields))
+        return sorted(docs)
+
+    def matches(self, matcher, fields=None, cache=None, docs=None):
+        # (document, field, result) for each field of the documents on which
+        # the BacteriaMatcher method finds something, by default of its
+        # candidates. The fields are read again from the indexed files.
+        matcher_func = getattr(BacteriaMatcher, matcher)
+        fields = fields or FIELDS
+        if docs is None:
+            docs = self.candidates(MATCHER_PATTERNS[matcher], fields)
+        for doc in docs:
+            tei_file, pdftotext_file = self.document(doc)
+            texts = read_fields(tei_file, pdftotext_file, fields, cache)
+            for field in fields:
+                if not texts.get(field):
+                    continue
+                result = matcher_func(texts[field])
+                if result:
+                    yield doc, field, result
+
+    def close(self):
+        self.connection.close()
+
+
+def build_index(index_file, teis, pdftotexts_directory, workers=None,
+                chunksize=16, cache_file=None, cache_size=None,
+                segment_size=DEFAULT_SEGMENT_SIZE, progress=None, errors=None):
+    # Index the TEI files in their order, with the pdftotext file of each.
+    tasks = [(str(tei), pdftotexts_directory) for tei in teis]
+    sizes = [task_size(tei_inputs(tei, pdftotexts_directory)) for tei in teis]
+    writer = IndexWriter(index_file, segment_size)
+    batch_task = partial(index_batch, cache_file=cache_file,
+                         cache_size=cache_size)
+    with create_pool(workers, None, init_worker,
+                     (cache_file, cache_size)) as pool:
+        batches = imap_batches(pool, batch_task, tasks, sizes, chunksize,
+                               ordered=True, progress=progress, errors=errors)
+        for batch in batches:
+            for tei_file, pdftotext_file, postings, exact in batch:
+                writer.add(tei_file, pdftotext_file, postings, exact)
+        pool.close()
+        pool.join()
+    writer.close()
+    return writer.documents
+
+
+def set_up_argparser():
+    parser = argparse.ArgumentParser(
+        description="Inverted index over the title, abstract, text and "
+                    "pdftotext of TEI files")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help="index a directory of TEI files")
+    build.add_argument('inputdir', help="input directory containing TEI XML files")
+    build.add_argument('pdftotexts', help="directory containing pdftotext files")
+    build.add_argument('index', help="SQLite file of the index")
+    build.add_argument('--cache',
+                       help="SQLite file to cache parsed TEI and pdftotext fields across runs")
+    build.add_argument('--cache-size', type=int, default=1024,
+                       help="maximal size of the cache in MB")
+    build.add_argument('--workers', type=int,
+                       help="number of worker processes, by default the number of CPUs")
+    build.add_argument('--chunksize', type=int, default=16,
+                       help="number of TEI files sent to a worker at once")
+    build.add_argument('--segment-size', type=int, default=DEFAULT_SEGMENT_SIZE,
+                       help="documents per stored segment of a posting list")
+    build.add_argument('--progress-interval', type=float,
+                       default=DEFAULT_INTERVAL,
+                       help="seconds between progress reports")
+    build.add_argument('--quiet', action='store_true',
+                       help="do not report progress")
+
+    search = commands.add_parser(
+        'search', help="list the documents with all words of a query")
+    search.add_argument('index', help="SQLite file of the index")
+    search.add_argument('query', help="words to search for")
+    search.add_argument('--fields', nargs='+', choices=FIELDS,
+                        help="only search these fields")
+
+    match = commands.add_parser(
+        'match', help="run a BacteriaMatcher method on the candidate documents")
+    match.add_argument('index', help="SQLite file of the index")
+    match.add_argument('matcher', choices=sorted(MATCHER_PATTERNS))
+    match.add_argument('--fields', nargs='+', choices=FIELDS,
+                       help="only match these fields")
+    match.add_argument('--cache',
+                       help="SQLite file of parsed fields, e.g. the one of the build")
+    return parser
+
+
+def main():
+    args = set_up_argparser().parse_args()
+
+    if args.command == 'build':
+        teis = all_teis(args.inputdir)
+        progress = open_progress(len(teis), args.progress_interval,
+                                 quiet=args.quiet)
+        errors = []
+        start = time.perf_counter()
+        documents = build_index(
+            args.index, teis, args.pdftotexts, args.workers, args.chunksize,
+            args.cache, args.cache_size * 1024 ** 2, args.segment_size,
+            progress, errors)
+        progress.finish()
+        report_errors(args.index, errors)
+        print(f"Indexed {documents} documents in "
+              f"{time.perf_counter() - start:.1f}s")
+        return
+
+    index = TextIndex(args.index)
+    start = time.perf_counter()
+    if args.command == 'search':
+        for doc in index.search(args.query, args.fields):
+            tei_file, _ = index.document(doc)
+            print(tei_file)
+        print(f"Searched in {time.perf_counter() - start:.3f}s",
+              file=sys.stderr)
+    else:
+        candidates = index.candidates(MATCHER_PATTERNS[args.matcher],
+                                      args.fields or FIELDS)
+        lookup = time.perf_counter() - start
+        cache = open_cache(args.cache)
+        matches = index.matches(args.matcher, args.fields, cache, candidates)
+        for doc, field, result in matches:
+            tei_file, _ = index.document(doc)
+            print(f"{tei_file}\t{field}\t{result}")
+        print(f"{len(candidates)} of {len(index)} documents are candidates, "
+              f"found in {lookup:.3f}s, matched in "
+              f"{time.perf_counter() - start - lookup:.3f}s", file=sys.stderr)
+    index.close()
+
+
+if __name__ == '__main__':
+    main()